@@ -43,9 +43,10 @@ CREATE TABLE IF NOT EXISTS "Patient" (
 DROP TABLE IF EXISTS "available_time";
 CREATE TABLE IF NOT EXISTS "available_time" (
 	"StaffID"	varchar(10) NOT NULL CHECK("StaffID" LIKE 'G%'),
-	"Timeslot"	datetime NOT NULL,
+	"Timeslot"	INTEGER NOT NULL,
 	FOREIGN KEY("StaffID") REFERENCES "Users"("ID") ON DELETE CASCADE ON UPDATE CASCADE
 );
+CREATE INDEX IF NOT EXISTS "available_time_timeslot" ON "available_time" ("Timeslot", "StaffID");
 DROP TABLE IF EXISTS "GP";
 CREATE TABLE IF NOT EXISTS "GP" (
 	"ID"	varchar(10),
@@ -63,7 +64,7 @@ CREATE TABLE IF NOT EXISTS "Visit" (
 	"BookingNo"	INTEGER,
 	"NHSNo"	varchar(10) NOT NULL CHECK("NHSNo" BETWEEN 1000000000 AND 9999999999),
 	"StaffID"	varchar(10) NOT NULL,
-	"Timeslot"	datetime NOT NULL,
+	"Timeslot"	INTEGER NOT NULL,
 	"PatientInfo"	BLOB,
 	"Confirmed"	char(1) NOT NULL DEFAULT 'P' CHECK("Confirmed" IN ('T', 'F', 'P')),
 	"Attended"	char(1) CHECK("Attended" IN ('T', 'F')),
@@ -75,7 +76,67 @@ CREATE TABLE IF NOT EXISTS "Visit" (
 	FOREIGN KEY("NHSNo") REFERENCES "Patient"("NHSNo") ON DELETE CASCADE ON UPDATE CASCADE,
 	FOREIGN KEY("StaffID") REFERENCES "GP"("ID") ON DELETE CASCADE ON UPDATE CASCADE
 );
+CREATE INDEX IF NOT EXISTS "visit_staff_timeslot" ON "Visit" ("StaffID", "Timeslot");
+DROP TABLE IF EXISTS "visit_search_index";
+CREATE TABLE IF NOT EXISTS "visit_search_index" (
+	"Token"	BLOB NOT NULL,
+	"Field"	char(1) NOT NULL CHECK("Field" IN ('D', 'N')),
+	"BookingNo"	INTEGER NOT NULL,
+	PRIMARY KEY("Token","Field","BookingNo"),
+	FOREIGN KEY("BookingNo") REFERENCES "Visit"("BookingNo") ON DELETE CASCADE ON UPDATE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS "visit_search_index_booking" ON "visit_search_index" ("BookingNo", "Field");
+DROP TABLE IF EXISTS "availability_rule";
+CREATE TABLE IF NOT EXISTS "availability_rule" (
+	"RuleID"	INTEGER,
+	"StaffID"	varchar(10) NOT NULL,
+	"Weekday"	INTEGER NOT NULL CHECK("Weekday" BETWEEN 0 AND 6),
+	"StartTime"	char(5) NOT NULL,
+	"EndTime"	char(5) NOT NULL,
+	"ValidFrom"	date,
+	"ValidUntil"	date,
+	PRIMARY KEY("RuleID"),
+	FOREIGN KEY("StaffID") REFERENCES "GP"("ID") ON DELETE CASCADE ON UPDATE CASCADE
+);
+CREATE INDEX IF NOT EXISTS "availability_rule_staff" ON "availability_rule" ("StaffID", "Weekday");
+DROP TABLE IF EXISTS "availability_exception";
+CREATE TABLE IF NOT EXISTS "availability_exception" (
+	"ExceptionID"	INTEGER,
+	"StaffID"	varchar(10) NOT NULL,
+	"ExceptionDate"	date NOT NULL,
+	"StartTime"	char(5),
+	"EndTime"	char(5),
+	"Reason"	text,
+	PRIMARY KEY("ExceptionID"),
+	FOREIGN KEY("StaffID") REFERENCES "GP"("ID") ON DELETE CASCADE ON UPDATE CASCADE
+);
+CREATE INDEX IF NOT EXISTS "availability_exception_staff" ON "availability_exception" ("StaffID", "ExceptionDate");
+DROP TABLE IF EXISTS "slot_hold";
+CREATE TABLE IF NOT EXISTS "slot_hold" (
+	"StaffID"	varchar(10) NOT NULL,
+	"Timeslot"	INTEGER NOT NULL,
+	"NHSNo"	varchar(10) NOT NULL,
+	"ExpiresAt"	REAL NOT NULL,
+	PRIMARY KEY("StaffID","Timeslot")
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS "slot_hold_expiry" ON "slot_hold" ("ExpiresAt");
+DROP TABLE IF EXISTS "notification_outbox";
+CREATE TABLE IF NOT EXISTS "notification_outbox" (
+	"NotificationID"	INTEGER,
+	"NHSNo"	varchar(10) NOT NULL,
+	"BookingNo"	INTEGER NOT NULL,
+	"StaffID"	varchar(10) NOT NULL,
+	"Timeslot"	INTEGER NOT NULL,
+	"Kind"	text NOT NULL CHECK("Kind" IN ('cancelled', 'reassigned')),
+	"NewStaffID"	varchar(10),
+	"NewTimeslot"	INTEGER,
+	"CreatedAt"	REAL NOT NULL,
+	"DeliveredAt"	REAL,
+	PRIMARY KEY("NotificationID")
+);
+CREATE INDEX IF NOT EXISTS "notification_outbox_patient" ON "notification_outbox" ("NHSNo", "DeliveredAt");
 INSERT INTO "UserGroup" ("UserType") VALUES ('GP');
 INSERT INTO "UserGroup" ("UserType") VALUES ('Admin');
 INSERT INTO "UserGroup" ("UserType") VALUES ('Patient');
+PRAGMA user_version = 5;
 COMMIT;
@@ -1,7 +1,10 @@
 from encryption import EncryptionHelper
 from iohandler import Parser, Paging
-from database import SQLQuery
+from database import SQLQuery, SQLTransaction
 from main import User, MenuHelper
+from userprofile import ProfileStore
+from slotindex import FreeSlotIndex
+from gp import GP
 from typing import Tuple
 
 import logging
@@ -11,6 +14,8 @@ logger = logging.getLogger("main.Admin")
 class Admin(User):
     """Navigate through Admin features and functionality once logged in."""
 
+    __slots__ = ()
+
     def main_menu(self) -> None:
         """
         Main Menu for Admin-type users.
@@ -20,7 +25,8 @@ class Admin(User):
             print("You're currently viewing main menu options for Admin {0}.".format(self.username))
             user_input = Parser.selection_parser(
                 options={"A": "View Records", "B": "Add New GP or Patient", "C": "Edit GP or Patient",
-                         "D": "Delete Existing GP or Patient", "--logout": "logout"})
+                         "D": "Delete Existing GP or Patient", "E": "Cancel or Move a GP's Bookings",
+                         "--logout": "logout"})
             if user_input == "--logout":
                 logger.info("User Logged Out")
                 Parser.user_quit()
@@ -33,6 +39,9 @@ class Admin(User):
             elif user_input == "C":
                 logger.info("Admin editing existing patient/GP")
                 self.edit_gp_patient()
+            elif user_input == "E":
+                logger.info("Admin cancelling bookings of a GP")
+                self.cancel_gp_bookings()
             else:
                 logger.info("Admin deletion of account that has been deactivated")
                 self.delete_gp_patient()
@@ -243,16 +252,36 @@ class Admin(User):
                 if user_type == "GP":
                     SQLQuery("DELETE FROM GP WHERE ID=:who").commit({"who": selected_id})
                     SQLQuery("DELETE FROM available_time WHERE StaffID=:who").commit({"who": selected_id})
+                    FreeSlotIndex.invalidate()
                 else:
                     SQLQuery("DELETE FROM Patient WHERE NHSNo=:who").commit({"who": selected_id})
-                    SQLQuery("DELETE FROM Visit WHERE NHSNo=:who").commit({"who": selected_id})
+                    # the search index rows of the visits go in the same transaction as the visits
+                    SQLTransaction().add("DELETE FROM visit_search_index WHERE BookingNo IN (SELECT BookingNo "
+                                         "FROM Visit WHERE NHSNo = ?)", (selected_id,)
+                                         ).add("DELETE FROM Visit WHERE NHSNo = ?", (selected_id,)).commit()
 
                 delete_query = SQLQuery("DELETE FROM Users WHERE username=?")
                 delete_query.commit(parameters=(selected_user,))
+                ProfileStore.invalidate(selected_id)
                 print("{0} {1} deleted from the necessary tables.\n".format(user_type, selected_user))
                 Parser.print_clean()
                 return True
 
+    def cancel_gp_bookings(self) -> bool:
+        """
+        Cancel, or move to other GPs, all bookings of a GP over a date range, e.g. when the GP is off sick.
+        """
+        gp_accounts = list(SQLQuery("SELECT username, ID FROM Users WHERE UserType = 'GP'").fetch_all())
+        if len(gp_accounts) == 0:
+            Parser.print_clean("No GP accounts exist.\n")
+            return False
+        full_accounts_table, _ = self.list_accounts(gp_accounts)
+        selected_user_number = Parser.selection_parser(options=full_accounts_table)
+        if selected_user_number == "--back":
+            return False
+        username, staff_id = gp_accounts[int(selected_user_number) - 1]
+        return GP.cancel_range_menu(staff_id, username, self.user_type)
+
     @staticmethod
     def list_accounts(all_results) -> Tuple[dict, list]:
         """
@@ -277,6 +306,7 @@ class Admin(User):
         try:
             SQLQuery("UPDATE Users SET {0} = ? WHERE username = ?".format(parameter)).commit((new_parameter_value,
                                                                                               selected_user))
+            ProfileStore.invalidate(username=selected_user)
             logger.info("Updated record in database")
             return True
         except DatabaseError:
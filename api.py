@@ -0,0 +1,438 @@
+import datetime
+import hmac
+import json
+import logging
+import re
+import secrets
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from booking import BookingService
+from events import EventLog
+from exceptions import DBRecordError, BookingError, AccessError
+from reassignment import ReassignmentEngine
+
+logger = logging.getLogger("main.API")
+
+
+class LatencyMetrics:
+    """
+    Request latency per route, keeping the last SAMPLE_SIZE durations of every route for the percentiles.
+    """
+
+    SAMPLE_SIZE = 1000
+
+    def __init__(self):
+        self._routes = {}  # route -> [requests, errors, recent durations in ms]
+        self._lock = threading.Lock()
+
+    def record(self, route, duration, error=False) -> None:
+        """
+        :param str route: route name, e.g. "POST /bookings"
+        :param float duration: duration of the request in seconds
+        :param bool error: True if the request failed
+        """
+        with self._lock:
+            entry = self._routes.setdefault(route, [0, 0, deque(maxlen=LatencyMetrics.SAMPLE_SIZE)])
+            entry[0] += 1
+            entry[1] += error
+            entry[2].append(duration * 1000)
+
+    def summary(self) -> dict:
+        """
+        :return: route -> requests, errors and mean, p50, p95 and max latency in ms
+        """
+        with self._lock:
+            routes = {route: (requests, errors, sorted(durations))
+                      for route, (requests, errors, durations) in self._routes.items()}
+        return {route: {"requests": requests, "errors": errors,
+                        "mean_ms": round(statistics.mean(durations), 3),
+                        "p50_ms": round(durations[int(0.5 * (len(durations) - 1))], 3),
+                        "p95_ms": round(durations[int(0.95 * (len(durations) - 1))], 3),
+                        "max_ms": round(durations[-1], 3)}
+                for route, (requests, errors, durations) in routes.items()}
+
+
+class APISessions:
+    """
+    Sessions of the users logged in through the API. POST /sessions checks the credentials with the
+    AuthenticationService and returns a token, which every other request sends as "Authorization: Bearer
+    <token>" and which ties it to that user and their role.
+    """
+
+    SESSION_SECONDS = 15 * 60
+
+    _sessions = {}  # token -> (user ID, user type, expiry time)
+    _lock = threading.Lock()
+
+    @staticmethod
+    def create(user_id, user_type) -> str:
+        """
+        :param str user_id: ID of the authenticated user
+        :param str user_type: Patient, GP or Admin
+        :return: token of the new session
+        """
+        token = secrets.token_urlsafe(32)
+        now = time.monotonic()
+        with APISessions._lock:
+            for expired in [key for key, (_, _, expiry) in APISessions._sessions.items() if expiry <= now]:
+                del APISessions._sessions[expired]
+            APISessions._sessions[token] = (user_id, user_type, now + APISessions.SESSION_SECONDS)
+        return token
+
+    @staticmethod
+    def user(authorization):
+        """
+        :param str authorization: value of the Authorization header
+        :return: (user ID, user type) of the session, None if the token is missing, unknown or expired
+        """
+        if not authorization or not authorization.startswith("Bearer "):
+            return None
+        with APISessions._lock:
+            session = APISessions._sessions.get(authorization[len("Bearer "):].strip())
+        if session is None or session[2] <= time.monotonic():
+            return None
+        return session[:2]
+
+
+class BookingAPI:
+    """
+    Routes of the JSON API, every one of them calls BookingService. A handler receives the URL match,
+    the query parameters, the JSON body and the (user ID, user type) of the session, and returns
+    (HTTP status, JSON serialisable payload).
+
+    Every route but POST /sessions needs a session of one of the roles listed in ROUTES. Patients and GPs
+    only act for themselves: the nhs_no or staff_id of a request, if given, must be the ID of the session.
+
+    POST   /sessions                          {"username", "password"}
+    GET    /availability?date=YYYY-MM-DD[&days=N][&gp=ID]
+    GET    /availability/earliest?[count=N][&gender=M|F|N][&speciality=text][&min_rating=N]
+    GET    /gps
+    POST   /gps/<id>/bookings/cancel          {"start", "end"[, "drop_slots"][, "reassign_to"]}
+    POST   /gps/<id>/bookings/reassign        {"start", "end"[, "same_gender"][, "same_speciality"][, "max_shift_days"]
+                                               [, "restore_slots"]}
+    POST   /bookings                          {"staff_id", "timeslot"[, "patient_info"][, "nhs_no"]}
+    POST   /bookings/<no>/cancel              [{"nhs_no"}]
+    POST   /bookings/<no>/check-in            [{"nhs_no"}]
+    POST   /bookings/<no>/confirm             [{"staff_id"}]
+    POST   /bookings/confirm                  {"booking_nos"[, "staff_id"]}
+    POST   /bookings/<no>/reject              [{"staff_id"}]
+    GET    /bookings/<no>/prescriptions
+    GET    /metrics
+    """
+
+    ANY_ROLE = ("Patient", "GP", "Admin")
+
+    @staticmethod
+    def own_id(user, requested=None) -> str:
+        """
+        :param tuple user: (user ID, user type) of the session
+        :param requested: nhs_no or staff_id sent with the request, if any
+        :return: ID of the session user
+        :raises AccessError: if the request is made for another user
+        """
+        if requested is not None and str(requested) != str(user[0]):
+            raise AccessError("Requests can only be made for your own account.")
+        return user[0]
+
+    @staticmethod
+    def managed_gp(match, user) -> str:
+        """
+        :param dict match: URL match holding the staff_id
+        :param tuple user: (user ID, user type) of the session
+        :return: the staff_id, a GP can only manage their own bookings, an admin those of every GP
+        :raises AccessError: if a GP asks for the bookings of another GP
+        """
+        return match["staff_id"] if user[1] == "Admin" else BookingAPI.own_id(user, match["staff_id"])
+
+    @staticmethod
+    def login(match, query, body, user):
+        from auth import AuthenticationService
+        status, profile = AuthenticationService.authenticate(str(body["username"]), str(body["password"]))
+        if status == AuthenticationService.LOCKED:
+            return 429, {"error": "Too many failed attempts for this account, try again later"}
+        if status != AuthenticationService.SUCCESS:
+            # a deactivated account is reported like wrong credentials, so accounts cannot be probed
+            return 401, {"error": "Invalid username or password"}
+        return 201, {"token": APISessions.create(profile.ID, profile.user_type), "user_type": profile.user_type,
+                     "expires_in": APISessions.SESSION_SECONDS}
+
+    @staticmethod
+    def availability(match, query, body, user):
+        selected_date = datetime.date.fromisoformat(query["date"])
+        days = int(query.get("days", 1))
+        if not 1 <= days <= 31:
+            raise ValueError("days must be between 1 and 31")
+        nhs_no = user[0] if user[1] == "Patient" else None
+        rows = BookingService.search_availability(selected_date, days, query.get("gp", '%'), nhs_no)
+        return 200, [{"staff_id": staff_id, "first_name": first_name, "last_name": last_name, "timeslot": timeslot}
+                     for first_name, last_name, timeslot, staff_id in rows]
+
+    @staticmethod
+    def earliest(match, query, body, user):
+        count = int(query.get("count", 10))
+        if not 1 <= count <= 100:
+            raise ValueError("count must be between 1 and 100")
+        gender = query.get("gender")
+        if gender not in (None, "M", "F", "N"):
+            raise ValueError("gender must be M, F or N")
+        min_rating = int(query["min_rating"]) if "min_rating" in query else None
+        nhs_no = user[0] if user[1] == "Patient" else None
+        rows = BookingService.find_earliest(count, gender, query.get("speciality"), min_rating, nhs_no)
+        return 200, [{"staff_id": staff_id, "first_name": first_name, "last_name": last_name, "timeslot": timeslot}
+                     for first_name, last_name, timeslot, staff_id in rows]
+
+    @staticmethod
+    def gps(match, query, body, user):
+        return 200, [{"staff_id": gp[7], "first_name": gp[0], "last_name": gp[1], "introduction": gp[2],
+                      "clinic_address": gp[3], "clinic_postcode": gp[4], "gender": gp[5], "rating": gp[6]}
+                     for gp in BookingService.available_gps()]
+
+    @staticmethod
+    def cancel_range(match, query, body, user):
+        staff_id = BookingAPI.managed_gp(match, user)
+        start, end = datetime.date.fromisoformat(body["start"]), datetime.date.fromisoformat(body["end"])
+        if end < start:
+            raise ValueError("end must not be before start")
+        report = BookingService.cancel_range(staff_id, start, end, bool(body.get("drop_slots")),
+                                             body.get("reassign_to"))
+        return 200, {"staff_id": staff_id, **report}
+
+    @staticmethod
+    def reassign(match, query, body, user):
+        staff_id = BookingAPI.managed_gp(match, user)
+        start, end = datetime.date.fromisoformat(body["start"]), datetime.date.fromisoformat(body["end"])
+        if end < start:
+            raise ValueError("end must not be before start")
+        max_shift_days = int(body.get("max_shift_days", ReassignmentEngine.MAX_SHIFT_DAYS))
+        if not 0 <= max_shift_days <= 31:
+            raise ValueError("max_shift_days must be between 0 and 31")
+        report = ReassignmentEngine.reassign(staff_id, start, end, bool(body.get("same_gender", True)),
+                                             bool(body.get("same_speciality")), max_shift_days,
+                                             bool(body.get("restore_slots")))
+        return 200, {"staff_id": staff_id, **report}
+
+    @staticmethod
+    def book(match, query, body, user):
+        booking_no = BookingService.book(BookingAPI.own_id(user, body.get("nhs_no")), body["staff_id"],
+                                         body["timeslot"], body.get("patient_info"))
+        return 201, {"booking_no": booking_no, "confirmed": "P"}
+
+    @staticmethod
+    def cancel(match, query, body, user):
+        BookingService.cancel(BookingAPI.own_id(user, body.get("nhs_no")), int(match["booking_no"]))
+        return 200, {"booking_no": int(match["booking_no"]), "cancelled": True}
+
+    @staticmethod
+    def check_in(match, query, body, user):
+        BookingService.check_in(BookingAPI.own_id(user, body.get("nhs_no")), int(match["booking_no"]))
+        return 200, {"booking_no": int(match["booking_no"]), "attended": "T"}
+
+    @staticmethod
+    def confirm(match, query, body, user):
+        BookingService.confirm(BookingAPI.own_id(user, body.get("staff_id")), int(match["booking_no"]))
+        return 200, {"booking_no": int(match["booking_no"]), "confirmed": "T"}
+
+    @staticmethod
+    def confirm_many(match, query, body, user):
+        staff_id = BookingAPI.own_id(user, body.get("staff_id"))
+        if not isinstance(body["booking_nos"], list):
+            raise ValueError("booking_nos must be a list")
+        return 200, {"staff_id": staff_id, **BookingService.confirm_many(staff_id, body["booking_nos"])}
+
+    @staticmethod
+    def reject(match, query, body, user):
+        BookingService.reject(BookingAPI.own_id(user, body.get("staff_id")), int(match["booking_no"]))
+        return 200, {"booking_no": int(match["booking_no"]), "confirmed": "F"}
+
+    @staticmethod
+    def prescriptions(match, query, body, user):
+        # the diagnosis, notes and instructions are clinical free text, they are only shown in the application
+        visit, prescriptions = BookingService.prescriptions(BookingAPI.own_id(user, query.get("nhs_no")),
+                                                            int(match["booking_no"]))
+        return 200, {"booking_no": visit[0], "prescriptions": [{"drug_name": drug_name, "quantity": quantity}
+                                                               for _, drug_name, quantity, _ in prescriptions]}
+
+    @staticmethod
+    def route_name(pattern) -> str:
+        """
+        :param pattern: compiled route pattern
+        :return: the route with its groups as placeholders, e.g. "/bookings/<booking_no>/confirm"
+        """
+        return re.sub(r"[(][?]P<(\w+)>[^)]*[)]", r"<\1>", pattern.pattern)
+
+    # (method, path, handler, roles allowed), None for the routes which need no session
+    ROUTES = (
+        ("POST", re.compile(r"/sessions"), "login", None),
+        ("GET", re.compile(r"/availability"), "availability", ANY_ROLE),
+        ("GET", re.compile(r"/availability/earliest"), "earliest", ANY_ROLE),
+        ("GET", re.compile(r"/gps"), "gps", ANY_ROLE),
+        ("POST", re.compile(r"/gps/(?P<staff_id>[^/]+)/bookings/cancel"), "cancel_range", ("GP", "Admin")),
+        ("POST", re.compile(r"/gps/(?P<staff_id>[^/]+)/bookings/reassign"), "reassign", ("GP", "Admin")),
+        ("POST", re.compile(r"/bookings"), "book", ("Patient",)),
+        ("POST", re.compile(r"/bookings/(?P<booking_no>\d+)/cancel"), "cancel", ("Patient",)),
+        ("POST", re.compile(r"/bookings/(?P<booking_no>\d+)/check-in"), "check_in", ("Patient",)),
+        ("POST", re.compile(r"/bookings/(?P<booking_no>\d+)/confirm"), "confirm", ("GP",)),
+        ("POST", re.compile(r"/bookings/confirm"), "confirm_many", ("GP",)),
+        ("POST", re.compile(r"/bookings/(?P<booking_no>\d+)/reject"), "reject", ("GP",)),
+        ("GET", re.compile(r"/bookings/(?P<booking_no>\d+)/prescriptions"), "prescriptions", ("Patient",)),
+    )
+
+
+class APIRequestHandler(BaseHTTPRequestHandler):
+    """
+    Dispatches requests to BookingAPI and reports errors as JSON {"error": message}.
+    """
+
+    # HTTP/1.0: the connection is closed after every response, so a worker is never held by an idle client
+    protocol_version = "HTTP/1.0"
+    # maximum accepted size of a request body
+    MAX_BODY = 64 * 1024
+
+    def do_GET(self) -> None:
+        self.dispatch("GET")
+
+    def do_POST(self) -> None:
+        self.dispatch("POST")
+
+    def dispatch(self, method) -> None:
+        started = time.perf_counter()
+        url = urlsplit(self.path)
+        # unknown paths share one metrics entry, so clients cannot grow the metrics without bound
+        route = f"{method} (unknown)"
+        status, payload = 404, {"error": "Not found"}
+        try:
+            if not self.server.authorised(self.headers.get("X-API-Key")):
+                status, payload = 401, {"error": "Missing or invalid API key"}
+            elif method == "GET" and url.path == "/metrics":
+                route = "GET /metrics"
+                user = APISessions.user(self.headers.get("Authorization"))
+                if user is None or user[1] != "Admin":
+                    status, payload = 403, {"error": "Only administrators can read the metrics"}
+                else:
+                    status, payload = 200, self.server.metrics.summary()
+            else:
+                for route_method, pattern, handler_name, roles in BookingAPI.ROUTES:
+                    match = pattern.fullmatch(url.path)
+                    if match and route_method == method:
+                        route = f"{method} {BookingAPI.route_name(pattern)}"
+                        user = APISessions.user(self.headers.get("Authorization"))
+                        if roles is not None and user is None:
+                            status, payload = 401, {"error": "Missing or expired session, log in first"}
+                        elif roles is not None and user[1] not in roles:
+                            status, payload = 403, {"error": "This request is not allowed for your account"}
+                        else:
+                            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                            handler = getattr(BookingAPI, handler_name)
+                            status, payload = handler(match.groupdict(), query, self.read_body(), user)
+                        break
+        except BookingError as e:
+            status, payload = 409, {"error": str(e)}
+        except AccessError as e:
+            status, payload = 403, {"error": str(e)}
+        except DBRecordError:
+            status, payload = 404, {"error": "No such booking"}
+        except (KeyError, ValueError, TypeError) as e:
+            status, payload = 400, {"error": f"Invalid request: {e}"}
+        except Exception:
+            logger.exception(f"Unexpected error in {route}")
+            status, payload = 500, {"error": "Internal server error"}
+        self.send_json(status, payload)
+        duration = time.perf_counter() - started
+        self.server.metrics.record(route, duration, error=status >= 400)
+        EventLog.record("api", route, duration=duration, status=status)
+
+    def read_body(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > APIRequestHandler.MAX_BODY:
+            raise ValueError("request body too large")
+        if length == 0:
+            return {}
+        body = json.loads(self.rfile.read(length))
+        if not isinstance(body, dict):
+            raise ValueError("the body must be a JSON object")
+        return body
+
+    def send_json(self, status, payload) -> None:
+        data = json.dumps(payload, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args) -> None:
+        logger.debug("%s - %s" % (self.address_string(), format % args))
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTPServer handling the connections on a fixed pool of worker threads instead of a thread per request.
+    """
+
+    def __init__(self, address, workers=8, api_key=None):
+        """
+        :param tuple address: (host, port) to listen on
+        :param int workers: number of worker threads
+        :param str api_key: key every request must send in the X-API-Key header
+        :raises ValueError: if no key is given
+        """
+        if not api_key:
+            raise ValueError("the API cannot be served without an API key")
+        super().__init__(address, APIRequestHandler)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api")
+        self.metrics = LatencyMetrics()
+        self.api_key = api_key
+
+    def authorised(self, api_key) -> bool:
+        return api_key is not None and hmac.compare_digest(api_key, self.api_key)
+
+    def process_request(self, request, client_address) -> None:
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    """
+    If the file is run, it serves the JSON API, e.g. python api.py --port 8080 --api-key secret
+    """
+    import argparse
+    import os
+    from loghandler import LogPipeline
+
+    parser = argparse.ArgumentParser(description="Serve the booking JSON API.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on, only local by default")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--api-key", default=os.environ.get("GP_API_KEY"),
+                        help="key required in the X-API-Key header, default is $GP_API_KEY, required")
+    arguments = parser.parse_args()
+    if not arguments.api_key:
+        parser.error("an API key is required, pass --api-key or set GP_API_KEY")
+
+    LogPipeline.configure()
+    from migrations import Migrations
+    Migrations.apply()
+    api_server = PooledHTTPServer((arguments.host, arguments.port), arguments.workers, arguments.api_key)
+    print(f"GP system API listening on http://{arguments.host}:{arguments.port}, press Ctrl+C to stop.")
+    try:
+        api_server.serve_forever()
+    except KeyboardInterrupt:
+        print("API stopped.")
+    finally:
+        api_server.server_close()
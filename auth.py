@@ -0,0 +1,93 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from database import Database
+from encryption import PasswordHelper
+from userprofile import UserProfile, ProfileStore
+
+
+class AuthenticationService:
+    """
+    Checks credentials with a single statement per attempt and keeps the failed attempts in memory.
+    After MAX_ATTEMPTS failures for a username, further attempts are refused without querying the
+    database until LOCKOUT_SECONDS have passed since the last failure.
+    """
+
+    SUCCESS = "success"
+    DEACTIVATED = "deactivated"
+    INVALID = "invalid"
+    LOCKED = "locked"
+
+    MAX_ATTEMPTS = 5
+    LOCKOUT_SECONDS = 300
+
+    # One indexed lookup by username (the column is UNIQUE) which also counts the login when the password is
+    # correct and the account is active. First logins are counted by User.handle_login_count, once the first
+    # login questions have been answered.
+    QUERY = ("UPDATE Users SET LoginCount = LoginCount + (passCode = ? AND Deactivated = 'F' AND LoginCount > 0) "
+             "WHERE username = ? RETURNING passCode, {0}"
+             ).format(", ".join(UserProfile.PLAIN_COLUMNS + UserProfile.ENCRYPTED_COLUMNS))
+
+    _failures = OrderedDict()  # username -> (failed attempts, expiry time), least recently failed first
+    _lock = threading.Lock()
+
+    @staticmethod
+    def authenticate(username, password):
+        """
+        :param str username: username entered
+        :param str password: password entered, in plain text
+        :return: (status, UserProfile) where status is one of SUCCESS, DEACTIVATED, INVALID or LOCKED,
+                 the profile is None unless the password was correct
+        """
+        if AuthenticationService.remaining_attempts(username) == 0:
+            return AuthenticationService.LOCKED, None
+        password_hash = PasswordHelper.hash_pw(password)
+        try:
+            connection = Database().connection()
+            # the connection context manager commits the update
+            with connection:
+                row = connection.execute(AuthenticationService.QUERY, (password_hash, username)).fetchone()
+        except sqlite3.Error:
+            row = None
+        if row is None or row[0] != password_hash:
+            AuthenticationService.record_failure(username)
+            return AuthenticationService.INVALID, None
+        with AuthenticationService._lock:
+            AuthenticationService._failures.pop(username, None)
+        # the returned row is up to date, so the session does not have to query the profile again
+        profile = ProfileStore.add(row[1:])
+        if profile.deactivated == "T":
+            return AuthenticationService.DEACTIVATED, profile
+        return AuthenticationService.SUCCESS, profile
+
+    @staticmethod
+    def record_failure(username) -> None:
+        """
+        :param str username: username of the failed attempt
+        """
+        now = time.monotonic()
+        with AuthenticationService._lock:
+            AuthenticationService._evict(now)
+            attempts, _ = AuthenticationService._failures.pop(username, (0, None))
+            AuthenticationService._failures[username] = (attempts + 1, now + AuthenticationService.LOCKOUT_SECONDS)
+
+    @staticmethod
+    def remaining_attempts(username) -> int:
+        """
+        :param str username: username to check
+        :return: number of attempts left before the username is locked
+        """
+        with AuthenticationService._lock:
+            AuthenticationService._evict(time.monotonic())
+            attempts, _ = AuthenticationService._failures.get(username, (0, None))
+        return max(0, AuthenticationService.MAX_ATTEMPTS - attempts)
+
+    @staticmethod
+    def _evict(now) -> None:
+        # failures are kept in order of expiry, so the expired ones are at the front
+        while AuthenticationService._failures:
+            username, (_, expiry) = next(iter(AuthenticationService._failures.items()))
+            if expiry > now:
+                break
+            del AuthenticationService._failures[username]
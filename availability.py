@@ -0,0 +1,235 @@
+import datetime
+import sqlite3
+from database import Database, SQLQuery, Timeslot, TimeslotCodec
+from slotbitmap import SlotBitmap
+from slotindex import FreeSlotIndex
+
+delta = datetime.timedelta
+
+
+class AvailabilityTemplate:
+    """
+    Recurring weekly availability of a GP: weekday rules ("every Monday 09:00-12:00") with optional
+    validity dates, and exceptions (holidays or blocked hours on a date). materialise() turns them
+    into available_time slots for the bookable period in a single transaction.
+    """
+
+    WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+    SLOT_MINUTES = 15
+    # working hours accepted by Parser.time_parser
+    DAY_START = datetime.time(8, 30)
+    DAY_END = datetime.time(19, 0)
+    # Parser.date_parser accepts dates up to 182 days ahead
+    HORIZON_DAYS = 182
+
+    # created by Migrations.availability_templates on databases which predate them
+    TABLE_SCRIPT = """
+        CREATE TABLE IF NOT EXISTS availability_rule (
+            RuleID INTEGER PRIMARY KEY,
+            StaffID varchar(10) NOT NULL,
+            Weekday INTEGER NOT NULL CHECK(Weekday BETWEEN 0 AND 6),
+            StartTime char(5) NOT NULL,
+            EndTime char(5) NOT NULL,
+            ValidFrom date,
+            ValidUntil date
+        );
+        CREATE INDEX IF NOT EXISTS availability_rule_staff ON availability_rule (StaffID, Weekday);
+        CREATE TABLE IF NOT EXISTS availability_exception (
+            ExceptionID INTEGER PRIMARY KEY,
+            StaffID varchar(10) NOT NULL,
+            ExceptionDate date NOT NULL,
+            StartTime char(5),
+            EndTime char(5),
+            Reason text
+        );
+        CREATE INDEX IF NOT EXISTS availability_exception_staff ON availability_exception (StaffID, ExceptionDate);
+        """
+
+    # available_time has no unique key, a slot added or booked since it was generated is skipped, not duplicated,
+    # {0} is SlotBitmap.slot_available()
+    MATERIALISE_QUERY = ("INSERT INTO available_time (StaffID, Timeslot) SELECT ?, ? WHERE NOT {0} AND NOT EXISTS "
+                         "(SELECT 1 FROM Visit WHERE StaffID = ? AND Timeslot = ? AND Confirmed != 'F')")
+
+    @staticmethod
+    def validate_hours(start_time, end_time) -> None:
+        """
+        :param time start_time: start of the first slot
+        :param time end_time: end of the last slot
+        :raises ValueError: if the range is empty, outside working hours or not on quarter hours
+        """
+        for value in (start_time, end_time):
+            if value.minute % AvailabilityTemplate.SLOT_MINUTES or value.second:
+                raise ValueError("Appointments are limited to 15 min sessions!")
+        if not AvailabilityTemplate.DAY_START <= start_time < end_time <= AvailabilityTemplate.DAY_END:
+            raise ValueError("The range must be within the working hours 8:30 - 19:00 and end after it starts.")
+
+    @staticmethod
+    def add_rule(staff_id, weekday, start_time, end_time, valid_from=None, valid_until=None) -> int:
+        """
+        :param str staff_id: ID of the GP
+        :param int weekday: 0 for Monday to 6 for Sunday
+        :param time start_time: start of the first slot
+        :param time end_time: end of the last slot
+        :param date valid_from: first date the rule applies to, None for no limit
+        :param date valid_until: last date the rule applies to, None for no limit
+        :return: RuleID of the new rule
+        """
+        AvailabilityTemplate.validate_hours(start_time, end_time)
+        return SQLQuery("INSERT INTO availability_rule (StaffID, Weekday, StartTime, EndTime, ValidFrom, ValidUntil) "
+                        "VALUES (?, ?, ?, ?, ?, ?)").commit((staff_id, weekday, start_time.strftime("%H:%M"),
+                                                             end_time.strftime("%H:%M"), valid_from, valid_until))
+
+    @staticmethod
+    def add_exception(staff_id, exception_date, start_time=None, end_time=None, reason=None) -> int:
+        """
+        :param str staff_id: ID of the GP
+        :param date exception_date: date of the exception
+        :param time start_time: start of the blocked hours, None blocks the whole day (holiday)
+        :param time end_time: end of the blocked hours
+        :param str reason: optional note, e.g. "Holiday"
+        :return: ExceptionID of the new exception
+        """
+        if start_time is not None:
+            AvailabilityTemplate.validate_hours(start_time, end_time)
+            start_time, end_time = start_time.strftime("%H:%M"), end_time.strftime("%H:%M")
+        return SQLQuery("INSERT INTO availability_exception (StaffID, ExceptionDate, StartTime, EndTime, Reason) "
+                        "VALUES (?, ?, ?, ?, ?)").commit((staff_id, exception_date, start_time, end_time, reason))
+
+    @staticmethod
+    def rules(staff_id) -> list:
+        """
+        :param str staff_id: ID of the GP
+        :return: [RuleID, Weekday, StartTime, EndTime, ValidFrom, ValidUntil] rows ordered by weekday and time
+        """
+        return SQLQuery("SELECT RuleID, Weekday, StartTime, EndTime, ValidFrom, ValidUntil FROM availability_rule "
+                        "WHERE StaffID = ? ORDER BY Weekday, StartTime").fetch_all(parameters=(staff_id,))
+
+    @staticmethod
+    def exceptions(staff_id, from_date=None) -> list:
+        """
+        :param str staff_id: ID of the GP
+        :param date from_date: only exceptions on or after this date, default is today
+        :return: [ExceptionID, ExceptionDate, StartTime, EndTime, Reason] rows ordered by date
+        """
+        return SQLQuery("SELECT ExceptionID, ExceptionDate, StartTime, EndTime, Reason FROM availability_exception "
+                        "WHERE StaffID = ? AND ExceptionDate >= ? ORDER BY ExceptionDate, StartTime"
+                        ).fetch_all(parameters=(staff_id, from_date or datetime.date.today()))
+
+    @staticmethod
+    def remove_rule(staff_id, rule_id) -> None:
+        """
+        Remove a rule, the slots it already generated stay available.
+
+        :param str staff_id: ID of the GP owning the rule
+        :param int rule_id: RuleID of the rule
+        """
+        SQLQuery("DELETE FROM availability_rule WHERE StaffID = ? AND RuleID = ?").commit((staff_id, rule_id))
+
+    @staticmethod
+    def remove_exception(staff_id, exception_id) -> None:
+        """
+        :param str staff_id: ID of the GP owning the exception
+        :param int exception_id: ExceptionID of the exception
+        """
+        SQLQuery("DELETE FROM availability_exception WHERE StaffID = ? AND ExceptionID = ?"
+                 ).commit((staff_id, exception_id))
+
+    @staticmethod
+    def generate_slots(rules, exceptions, start_date, end_date):
+        """
+        Yield the slots of the rules between the two dates, leaving out the exceptions.
+
+        :param list rules: rows as returned by AvailabilityTemplate.rules
+        :param list exceptions: rows as returned by AvailabilityTemplate.exceptions
+        :param date start_date: first date
+        :param date end_date: last date, inclusive
+        :return: generator of slot start datetimes in ascending order
+        """
+        rules_by_weekday = {}
+        for _, weekday, start_time, end_time, valid_from, valid_until in rules:
+            rules_by_weekday.setdefault(weekday, []).append((start_time, end_time, valid_from or "", valid_until))
+        blocked = {}
+        for _, exception_date, start_time, end_time, _ in exceptions:
+            # a whole-day exception is stored without times
+            blocked.setdefault(str(exception_date), []).append((start_time or "00:00", end_time or "24:00"))
+        step = delta(minutes=AvailabilityTemplate.SLOT_MINUTES)
+        day = start_date
+        while day <= end_date:
+            day_text = day.isoformat()
+            slots = set()
+            for start_time, end_time, valid_from, valid_until in rules_by_weekday.get(day.weekday(), ()):
+                if valid_from <= day_text and (valid_until is None or day_text <= valid_until):
+                    slot = Timeslot.combine(day, datetime.time.fromisoformat(start_time))
+                    end = Timeslot.combine(day, datetime.time.fromisoformat(end_time))
+                    while slot < end:
+                        slots.add(slot)
+                        slot += step
+            for slot in sorted(slots):
+                time_text = slot.strftime("%H:%M")
+                if not any(start <= time_text < end for start, end in blocked.get(day_text, ())):
+                    yield slot
+            day += delta(days=1)
+
+    @staticmethod
+    def materialise(staff_id, start_date=None, end_date=None) -> dict:
+        """
+        Add the slots of the GP's rules to available_time in one transaction, skipping slots which are
+        already available or already booked (pending or confirmed). A slot added or booked by another
+        session while the slots were generated is skipped too, the other slots are still added.
+
+        :param str staff_id: ID of the GP
+        :param date start_date: first date, default is today (slots already started are skipped)
+        :param date end_date: last date, default is HORIZON_DAYS from today
+        :return: {"added": number of slots added, "existing": number already available,
+                  "booked": list of booked timeslots which were skipped, "skipped": list of timeslots added or
+                  booked meanwhile, "committed": False on database error}
+        """
+        today = datetime.date.today()
+        start_date = max(start_date or today, today)
+        end_date = min(end_date or today + delta(days=AvailabilityTemplate.HORIZON_DAYS),
+                       today + delta(days=AvailabilityTemplate.HORIZON_DAYS))
+        # one query each for the template and for what is already in the period
+        rules = AvailabilityTemplate.rules(staff_id)
+        exceptions = AvailabilityTemplate.exceptions(staff_id, start_date)
+        period = (staff_id, TimeslotCodec.start_of(start_date), TimeslotCodec.start_of(end_date + delta(days=1)))
+        existing = {row[0] for row in SQLQuery("SELECT Timeslot FROM available_time WHERE StaffID = ? AND "
+                                               "Timeslot >= ? AND Timeslot < ?").fetch_all(parameters=period)}
+        booked = {row[0] for row in SQLQuery("SELECT Timeslot FROM Visit WHERE StaffID = ? AND Timeslot >= ? AND "
+                                             "Timeslot < ? AND Confirmed != 'F'").fetch_all(parameters=period)}
+        now = datetime.datetime.now()
+        report = {"added": 0, "existing": 0, "booked": [], "skipped": [], "committed": True}
+        new_slots = []
+        for slot in AvailabilityTemplate.generate_slots(rules, exceptions, start_date, end_date):
+            if slot <= now:
+                continue
+            if slot in existing:
+                report["existing"] += 1
+            elif slot in booked:
+                report["booked"].append(slot)
+            else:
+                new_slots.append((staff_id, slot))
+        if not new_slots:
+            return report
+        added = []
+        query = AvailabilityTemplate.MATERIALISE_QUERY.format(SlotBitmap.slot_available())
+        connection = Database().connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for _, slot in new_slots:
+                inserted = connection.execute(query,
+                                              (staff_id, slot, staff_id, slot, staff_id, slot)).rowcount
+                (added if inserted else report["skipped"]).append(slot)
+            connection.commit()
+        except sqlite3.Error:
+            if connection.in_transaction:
+                connection.rollback()
+            report["committed"] = False
+            report["skipped"] = []
+            return report
+        except BaseException:
+            if connection.in_transaction:
+                connection.rollback()
+            raise
+        report["added"] = len(added)
+        FreeSlotIndex.add_many(staff_id, added)
+        return report
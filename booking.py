@@ -0,0 +1,406 @@
+import datetime
+import logging
+import sqlite3
+import time
+from cache import cache
+from database import Database, SQLQuery, SQLTransaction, Timeslot, TimeslotCodec
+from encryption import EncryptionHelper
+from exceptions import DBRecordError, BookingError
+from holds import SlotHold
+from notifications import NotificationOutbox
+from search import VisitSearchIndex
+from slotbitmap import SlotBitmap
+from slotindex import FreeSlotIndex
+
+logger = logging.getLogger("main.Booking")
+
+delta = datetime.timedelta
+
+
+class BookingService:
+    """
+    Booking and schedule operations without any user interaction, shared by the menus
+    (Patient, GP) and the HTTP API (api.py). Rule violations raise BookingError and unknown
+    bookings raise DBRecordError, the caller decides how to report them.
+    """
+
+    # bookable days start tomorrow and end WINDOW_DAYS days from today
+    WINDOW_DAYS = 15
+    # patients can cancel up to CANCEL_DAYS days before the appointment
+    CANCEL_DAYS = 5
+    # patients can check in up to CHECK_IN_HOURS before or after the appointment
+    CHECK_IN_HOURS = 1
+    TIMESLOT_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    # The visit is only inserted while the slot is still available and not held by another patient, and the
+    # statements run in one IMMEDIATE transaction, so two patients booking the same slot cannot both succeed.
+    # {0} is SlotBitmap.slot_available(), the statements are constant for a storage, so the connection's
+    # statement cache prepares them once.
+    BOOK_QUERY = ("INSERT INTO Visit (NHSNo, StaffID, Timeslot, PatientInfo, Confirmed, Attended) "
+                  "SELECT ?, ?, ?, ?, 'P', 'F' WHERE {0} AND NOT EXISTS (SELECT 1 FROM slot_hold "
+                  "WHERE StaffID = ? AND Timeslot = ? AND NHSNo != ? AND ExpiresAt > ?) RETURNING BookingNo")
+    RELEASE_HOLD_QUERY = "DELETE FROM slot_hold WHERE StaffID = ? AND Timeslot = ?"
+
+    # statements of cancel_range, the period parameters are (StaffID, first Timeslot, end Timeslot exclusive)
+    # {0} is SlotBitmap.slot_available("?", "Visit.Timeslot"). A booking is only moved onto a slot no other
+    # patient holds, and not if the patient has another booking at that time. Rejected visits are kept, they
+    # are the patient's history.
+    REASSIGN_RANGE_QUERY = ("UPDATE Visit SET StaffID = ?, Confirmed = 'P' WHERE StaffID = ? AND Timeslot >= ? "
+                            "AND Timeslot < ? AND Confirmed != 'F' AND {0} AND NOT EXISTS (SELECT 1 FROM slot_hold "
+                            "WHERE slot_hold.StaffID = ? AND slot_hold.Timeslot = Visit.Timeslot "
+                            "AND slot_hold.NHSNo != Visit.NHSNo AND slot_hold.ExpiresAt > ?) AND NOT EXISTS "
+                            "(SELECT 1 FROM Visit other WHERE other.NHSNo = Visit.NHSNo AND other.Timeslot = "
+                            "Visit.Timeslot AND other.BookingNo != Visit.BookingNo AND other.Confirmed != 'F') "
+                            "RETURNING BookingNo, NHSNo, Timeslot")
+    CANCEL_RANGE_QUERY = ("DELETE FROM Visit WHERE StaffID = ? AND Timeslot >= ? AND Timeslot < ? "
+                          "AND Confirmed != 'F' RETURNING BookingNo, NHSNo, Timeslot")
+    FREE_RANGE_QUERY = "SELECT Timeslot FROM available_time WHERE StaffID = ? AND Timeslot >= ? AND Timeslot < ?"
+    DROP_RANGE_QUERY = "DELETE FROM available_time WHERE StaffID = ? AND Timeslot >= ? AND Timeslot < ?"
+    RESTORE_SLOT_QUERY = "INSERT INTO available_time (StaffID, Timeslot) VALUES (?, ?)"
+
+    @staticmethod
+    def load_available_gps() -> list:
+        """
+        :return: details of the GPs having availability in the bookable window
+        """
+        today = TimeslotCodec.start_of(datetime.date.today())
+        return SQLQuery("SELECT users.firstName, users.lastName, GP.Introduction, GP.ClinicAddress, "
+                        "GP.ClinicPostcode, GP.Gender, GP.Rating, users.ID FROM (GP INNER JOIN users ON "
+                        "GP.ID = users.ID) WHERE users.ID IN ( SELECT DISTINCT StaffID FROM available_time "
+                        "WHERE Timeslot >= ? AND Timeslot <= ? )"
+                        ).fetch_all(parameters=(today + delta(days=1), today + delta(days=BookingService.WINDOW_DAYS)),
+                                    decrypter=EncryptionHelper())
+
+    @staticmethod
+    def available_gps() -> list:
+        """
+        :return: details of the GPs having availability in the bookable window, from the session cache
+        """
+        return cache.get_or_load(("gp_list", datetime.date.today()), BookingService.load_available_gps)
+
+    @staticmethod
+    def load_gp_attributes() -> dict:
+        """
+        :return: StaffID -> (Gender, Speciality, Rating) of all GPs
+        """
+        return {staff_id: (gender, speciality or "", rating or 0) for staff_id, gender, speciality, rating in
+                SQLQuery("SELECT ID, Gender, Speciality, Rating FROM GP").fetch_all(decrypter=EncryptionHelper())}
+
+    @staticmethod
+    def find_earliest(count=10, gender=None, speciality=None, min_rating=None, nhs_no=None) -> list:
+        """
+        Find the earliest bookable slots of the GPs matching the filters, across all GPs.
+
+        :param int count: maximum number of slots
+        :param str gender: 'M', 'F' or 'N', any gender by default
+        :param str speciality: text the GP's speciality must contain (case-insensitive), any by default
+        :param int min_rating: minimum rating of the GP, any by default
+        :param nhs_no: NHS number of the patient searching, slots held by other patients are left out
+        :return: available slots as [firstName, lastName, Timeslot, StaffID] rows, ordered by Timeslot
+        """
+        attributes = cache.get_or_load(("gp_attributes", datetime.date.today()), BookingService.load_gp_attributes)
+        staff_ids = [staff_id for staff_id, (gp_gender, gp_speciality, rating) in attributes.items()
+                     if (gender is None or gp_gender == gender)
+                     and (not speciality or speciality.casefold() in gp_speciality.casefold())
+                     and (min_rating is None or rating >= min_rating)]
+        tomorrow = TimeslotCodec.start_of(datetime.date.today() + delta(days=1))
+        held = SlotHold.held(nhs_no)
+        # enough slots that count are left once the held ones are taken out
+        slots = FreeSlotIndex.earliest(count + len(held), tomorrow, staff_ids)
+        return FreeSlotIndex.rows([slot for slot in slots if slot not in held][:count])
+
+    @staticmethod
+    def search_availability(selected_date, selected_delta=1, gp_id='%', nhs_no=None) -> list:
+        """
+        Scopes from tomorrow on are answered by the FreeSlotIndex instead of queried.
+
+        :param date selected_date: start of the time scope
+        :param int selected_delta: number of days of the time scope
+        :param str gp_id: ID of the GP, all GPs by default
+        :param nhs_no: NHS number of the patient searching, slots held by other patients are left out
+        :return: available slots as [firstName, lastName, Timeslot, StaffID] rows, ordered by Timeslot
+        """
+        end_date = selected_date + delta(days=selected_delta)
+        held = SlotHold.held(nhs_no)
+        if datetime.date.today() < selected_date:
+            slots = FreeSlotIndex.between(TimeslotCodec.start_of(selected_date), TimeslotCodec.start_of(end_date),
+                                          None if gp_id == '%' else gp_id)
+            return FreeSlotIndex.rows([slot for slot in slots if slot not in held])
+        result = SQLQuery("SELECT firstName, lastName, Timeslot, available_time.StaffID FROM "
+                          "(available_time JOIN Users ON available_time.StaffID = Users.ID) WHERE "
+                          "available_time.StaffID LIKE ? AND Timeslot >= ? AND Timeslot <= ? ORDER BY Timeslot"
+                          ).fetch_all(parameters=(gp_id, TimeslotCodec.start_of(selected_date),
+                                                  TimeslotCodec.start_of(end_date)), decrypter=EncryptionHelper())
+        return [row for row in result if (row[2], row[3]) not in held]
+
+    @staticmethod
+    def invalidate_availability() -> None:
+        """
+        Drop the cached list of GPs having availability after slots were added or removed.
+        The FreeSlotIndex is updated by the write paths themselves.
+        """
+        cache.invalidate("gp_list")
+
+    @staticmethod
+    def book(nhs_no, staff_id, timeslot, patient_info=None) -> int:
+        """
+        Book the slot and take it out of the availability in a single transaction.
+
+        :param nhs_no: NHS number of the patient
+        :param str staff_id: ID of the GP
+        :param timeslot: datetime of the timeslot, or the text 'YYYY-MM-DD HH:MM:SS'
+        :param str patient_info: optional description of the illness for the GP
+        :return: BookingNo of the new pending booking
+        :raises BookingError: if the slot is not bookable, not available or held by another patient
+        """
+        timeslot = Timeslot.strptime(str(timeslot), BookingService.TIMESLOT_FORMAT)
+        if timeslot.date() <= datetime.date.today():
+            raise BookingError("Appointments can only be booked from tomorrow.")
+        info = None if patient_info is None else EncryptionHelper().encrypt_compressed(patient_info)
+        connection = Database().connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(BookingService.BOOK_QUERY.format(SlotBitmap.slot_available()),
+                                     (nhs_no, staff_id, timeslot, info, staff_id, timeslot, staff_id, timeslot, nhs_no,
+                                      time.time())).fetchone()
+            if row is not None:
+                connection.execute(SlotBitmap.take_slot_query(), (staff_id, timeslot))
+                connection.execute(BookingService.RELEASE_HOLD_QUERY, (staff_id, timeslot))
+                connection.commit()
+            else:
+                connection.rollback()
+        except sqlite3.Error as e:
+            if connection.in_transaction:
+                connection.rollback()
+            logger.error(f"Booking could not be saved: {e}")
+            raise BookingError("The booking could not be saved.")
+        except BaseException:
+            if connection.in_transaction:
+                connection.rollback()
+            raise
+        # the slot is gone either way, even if the index of this process still listed it
+        FreeSlotIndex.remove(staff_id, timeslot)
+        if row is None:
+            raise BookingError("This timeslot is not available.")
+        BookingService.invalidate_availability()
+        # the new booking is pending, the GP's list of bookings to confirm is out of date
+        cache.discard(("pending", staff_id))
+        logger.info("Appointment booked")
+        return row[0]
+
+    @staticmethod
+    def find_booking(booking_no, nhs_no=None, staff_id=None) -> list:
+        """
+        :param int booking_no: BookingNo of the booking
+        :param nhs_no: if given, the booking must belong to this patient
+        :param str staff_id: if given, the booking must be with this GP
+        :return: [BookingNo, NHSNo, StaffID, Timeslot, Confirmed, Attended]
+        :raises DBRecordError: if there is no such booking
+        """
+        result = SQLQuery("SELECT BookingNo, NHSNo, StaffID, Timeslot, Confirmed, Attended FROM Visit "
+                          "WHERE BookingNo = ? AND NHSNo LIKE ? AND StaffID LIKE ?"
+                          ).fetch_all(parameters=(booking_no, '%' if nhs_no is None else nhs_no,
+                                                  '%' if staff_id is None else staff_id))
+        if not result:
+            raise DBRecordError
+        return list(result[0])
+
+    @staticmethod
+    def cancel(nhs_no, booking_no) -> None:
+        """
+        Delete the booking and make its timeslot available again.
+
+        :param nhs_no: NHS number of the patient owning the booking
+        :param int booking_no: BookingNo of the booking
+        :raises BookingError: if the appointment is less than CANCEL_DAYS days away
+        """
+        booking = BookingService.find_booking(booking_no, nhs_no=nhs_no)
+        if booking[3] < datetime.datetime.now() + delta(days=BookingService.CANCEL_DAYS):
+            raise BookingError(f"Appointments can only be cancelled {BookingService.CANCEL_DAYS} days before them.")
+        cancelled = SQLTransaction().add("DELETE FROM Visit WHERE BookingNo = ?", (booking_no,)
+                                         ).add(VisitSearchIndex.REMOVE_QUERY, (booking_no,)
+                                         ).add("INSERT INTO available_time (StaffID, Timeslot) VALUES (?, ?)",
+                                               (booking[2], booking[3])).commit()
+        if not cancelled:
+            raise BookingError("The booking could not be cancelled.")
+        FreeSlotIndex.add(booking[2], booking[3])
+        BookingService.invalidate_availability()
+        cache.discard(("pending", booking[2]))
+
+    @staticmethod
+    def cancel_range(staff_id, start_date, end_date, drop_slots=False, reassign_to=None) -> dict:
+        """
+        Cancel all upcoming bookings of a GP over a date range in one transaction, e.g. when the GP is off
+        sick, and add a notification for every patient affected to the NotificationOutbox. Rejected visits
+        are kept.
+
+        :param str staff_id: ID of the GP
+        :param date start_date: first date, bookings which already started are left alone
+        :param date end_date: last date, inclusive
+        :param bool drop_slots: remove all slots of the GP in the range, also the free ones, instead of making
+                                the slots of the cancelled bookings available again
+        :param str reassign_to: ID of another GP, bookings are moved to them where they have the same slot free,
+                                no other patient holds it and the patient has no other booking at that time
+        :return: {"reassigned": bookings moved, "cancelled": bookings deleted, "notified": patients notified,
+                  "restored": slots made available again, "dropped": free slots removed}
+        :raises BookingError: if the changes could not be saved, nothing is changed then
+        """
+        connection = Database().connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            report, changes = BookingService.cancel_range_in(connection, staff_id, start_date, end_date, drop_slots,
+                                                             reassign_to)
+            connection.commit()
+        except sqlite3.Error as e:
+            if connection.in_transaction:
+                connection.rollback()
+            logger.error(f"Bookings of {staff_id} could not be cancelled: {e}")
+            raise BookingError("The bookings could not be cancelled.")
+        except BaseException:
+            if connection.in_transaction:
+                connection.rollback()
+            raise
+        BookingService.schedule_changed(changes)
+        logger.info(f"Bookings of {staff_id} from {start_date} to {end_date} cancelled")
+        return report
+
+    @staticmethod
+    def cancel_range_in(connection, staff_id, start_date, end_date, drop_slots=False, reassign_to=None) -> tuple:
+        """
+        Make the changes of cancel_range in the transaction open on the connection. The caller commits it and
+        then passes the slot changes to schedule_changed.
+
+        :param sqlite3.Connection connection: connection of the current thread, in a BEGIN IMMEDIATE transaction
+        :return: (report as returned by cancel_range, slot changes as taken by FreeSlotIndex.apply)
+        """
+        if reassign_to == staff_id:
+            raise BookingError("Bookings can only be moved to another GP.")
+        period = (staff_id, max(TimeslotCodec.start_of(start_date), Timeslot.now()),
+                  TimeslotCodec.start_of(end_date + delta(days=1)))
+        created = time.time()
+        reassigned, restored = [], []
+        if reassign_to is not None:
+            reassigned = connection.execute(BookingService.REASSIGN_RANGE_QUERY.format(
+                SlotBitmap.slot_available("?", "Visit.Timeslot")),
+                (reassign_to, *period, reassign_to, reassign_to, created)).fetchall()
+            connection.executemany(SlotBitmap.take_slot_query(),
+                                   [(reassign_to, timeslot) for _, _, timeslot in reassigned])
+        cancelled = connection.execute(BookingService.CANCEL_RANGE_QUERY, period).fetchall()
+        connection.executemany(VisitSearchIndex.REMOVE_QUERY, [(booking_no,) for booking_no, _, _ in cancelled])
+        notifications = [(nhs_no, booking_no, staff_id, timeslot, NotificationOutbox.CANCELLED, None, None,
+                          created) for booking_no, nhs_no, timeslot in cancelled]
+        notifications += [(nhs_no, booking_no, staff_id, timeslot, NotificationOutbox.REASSIGNED, reassign_to,
+                           timeslot, created) for booking_no, nhs_no, timeslot in reassigned]
+        connection.executemany(NotificationOutbox.INSERT_QUERY, notifications)
+        # counted before changing them, statements on the bitmap view do not report their row counts
+        free = [row[0] for row in connection.execute(BookingService.FREE_RANGE_QUERY, period)]
+        changes = {"added": {}, "removed": {}}
+        if drop_slots:
+            connection.execute(BookingService.DROP_RANGE_QUERY, period)
+            changes["removed"][staff_id] = [(period[1], period[2] - TimeslotCodec.MINUTE)]
+        else:
+            restored = sorted({timeslot for _, _, timeslot in cancelled}.difference(free))
+            connection.executemany(BookingService.RESTORE_SLOT_QUERY, [(staff_id, timeslot) for timeslot in restored])
+            changes["added"][staff_id] = [TimeslotCodec.decode(timeslot) for timeslot in restored]
+        if reassigned:
+            changes["removed"][reassign_to] = [(TimeslotCodec.decode(timeslot),) * 2 for _, _, timeslot in reassigned]
+        return ({"reassigned": len(reassigned), "cancelled": len(cancelled), "notified": len(notifications),
+                 "restored": len(restored), "dropped": len(free) if drop_slots else 0}, changes)
+
+    @staticmethod
+    def schedule_changed(changes) -> None:
+        """
+        Update the FreeSlotIndex and the caches once the changes to the bookings of a GP were committed.
+
+        :param dict changes: slot changes of the transaction, see FreeSlotIndex.apply
+        """
+        FreeSlotIndex.apply(changes)
+        BookingService.invalidate_availability()
+        cache.invalidate("pending")
+
+    @staticmethod
+    def check_in(nhs_no, booking_no) -> None:
+        """
+        :param nhs_no: NHS number of the patient owning the booking
+        :param int booking_no: BookingNo of the booking
+        :raises BookingError: if the appointment is not within CHECK_IN_HOURS of now
+        """
+        booking = BookingService.find_booking(booking_no, nhs_no=nhs_no)
+        now = datetime.datetime.now()
+        if not now - delta(hours=BookingService.CHECK_IN_HOURS) <= booking[3] <= \
+                now + delta(hours=BookingService.CHECK_IN_HOURS):
+            raise BookingError("You can only check in within an hour of the appointment.")
+        SQLQuery("UPDATE Visit SET Attended = 'T' WHERE BookingNo = ?").commit((booking_no,))
+
+    @staticmethod
+    def confirm(staff_id, booking_no) -> None:
+        """
+        Confirm the booking and reject all other bookings of the GP for the same timeslot.
+
+        :param str staff_id: ID of the GP
+        :param int booking_no: BookingNo of the booking
+        :raises DBRecordError: if the GP has no such booking
+        """
+        if not BookingService.confirm_many(staff_id, [booking_no])["confirmed"]:
+            raise DBRecordError
+
+    @staticmethod
+    def confirm_many(staff_id, booking_nos) -> dict:
+        """
+        Confirm the selected bookings and reject all other bookings of the GP for their timeslots, with a
+        single statement. If several selected bookings share a timeslot, the one booked first is confirmed.
+
+        :param str staff_id: ID of the GP
+        :param booking_nos: BookingNo of the bookings to confirm
+        :return: {"confirmed": BookingNo of the bookings confirmed, "rejected": BookingNo of the bookings rejected,
+                  "missing": BookingNo selected which are not bookings of the GP}
+        :raises BookingError: if the changes could not be saved, nothing is changed then
+        """
+        booking_nos = sorted({int(booking_no) for booking_no in booking_nos})
+        if not booking_nos:
+            return {"confirmed": [], "rejected": [], "missing": []}
+        # the winners per timeslot and the statuses of all bookings of those timeslots are decided in one UPDATE
+        query = ("WITH chosen AS (SELECT Timeslot, MIN(BookingNo) AS BookingNo FROM Visit WHERE StaffID = ? "
+                 "AND BookingNo IN ({0}) GROUP BY Timeslot) "
+                 "UPDATE Visit SET Confirmed = CASE WHEN BookingNo IN (SELECT BookingNo FROM chosen) THEN 'T' ELSE 'F' "
+                 "END WHERE StaffID = ? AND Timeslot IN (SELECT Timeslot FROM chosen) RETURNING BookingNo, Confirmed"
+                 ).format(", ".join("?" * len(booking_nos)))
+        try:
+            connection = Database().connection()
+            # the connection context manager commits the update
+            with connection:
+                rows = connection.execute(query, (staff_id, *booking_nos, staff_id)).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Bookings of {staff_id} could not be confirmed: {e}")
+            raise BookingError("The bookings could not be confirmed.")
+        cache.invalidate("pending")
+        confirmed = sorted(booking_no for booking_no, status in rows if status == 'T')
+        found = {booking_no for booking_no, _ in rows}
+        return {"confirmed": confirmed, "rejected": sorted(found.difference(confirmed)),
+                "missing": [booking_no for booking_no in booking_nos if booking_no not in found]}
+
+    @staticmethod
+    def reject(staff_id, booking_no) -> None:
+        """
+        :param str staff_id: ID of the GP
+        :param int booking_no: BookingNo of the booking
+        """
+        BookingService.find_booking(booking_no, staff_id=staff_id)
+        SQLQuery("UPDATE Visit SET Confirmed = 'F' WHERE BookingNo = ?").commit((booking_no,))
+        cache.invalidate("pending")
+
+    @staticmethod
+    def prescriptions(nhs_no, booking_no) -> tuple:
+        """
+        :param nhs_no: NHS number of the patient owning the booking
+        :param int booking_no: BookingNo of the booking
+        :return: ([BookingNo, Diagnosis, Notes, PatientInfo], list of [BookingNo, drugName, quantity, Instructions])
+        """
+        visit = SQLQuery("SELECT BookingNo, Diagnosis, Notes, PatientInfo FROM visit WHERE BookingNo = ? AND NHSNo = ?"
+                         ).fetch_all(decrypter=EncryptionHelper(), parameters=(booking_no, nhs_no))
+        if not visit:
+            raise DBRecordError
+        prescriptions = SQLQuery("SELECT BookingNo, drugName, quantity, Instructions FROM prescription "
+                                 "WHERE BookingNo = ?").fetch_all(decrypter=EncryptionHelper(),
+                                                                  parameters=(booking_no,))
+        return visit[0], prescriptions
@@ -0,0 +1,167 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionCache:
+    """
+    In-process cache of decrypted query results, bounded by an estimate of the memory it uses.
+    Least recently used entries are evicted first, and entries expire after ttl seconds so data
+    changed by other sessions is not shown for long.
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, ttl=120):
+        """
+        :param int max_bytes: approximate upper bound of the memory used by the cached values
+        :param float ttl: seconds an entry stays valid
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expiry time, size, value)
+        self._loading = {}  # key -> threading.Event set when the load finishes
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def estimate_size(value) -> int:
+        """
+        :param value: cached value, usually a list of rows
+        :return: rough size in bytes of the value and the rows and cells it contains
+        """
+        size = sys.getsizeof(value)
+        if isinstance(value, (list, tuple)):
+            for item in value:
+                size += SessionCache.estimate_size(item)
+        return size
+
+    def get(self, key, default=None):
+        """
+        :param key: hashable key of the entry
+        :return: the cached value, or default if it is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                return default
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def put(self, key, value) -> None:
+        """
+        :param key: hashable key of the entry
+        :param value: value to cache, values larger than the whole cache are not stored
+        """
+        size = SessionCache.estimate_size(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def get_or_load(self, key, loader, wait=30):
+        """
+        Return the cached value, or load and cache it. If another thread (e.g. the warm-up)
+        is already loading the same key, wait for it instead of running the query twice.
+
+        :param key: hashable key of the entry
+        :param loader: function without arguments returning the value
+        :param float wait: maximum seconds to wait for a load in progress
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+        with self._lock:
+            in_progress = self._loading.get(key)
+            if in_progress is None:
+                self._loading[key] = threading.Event()
+        if in_progress is not None:
+            in_progress.wait(wait)
+            value = self.get(key, missing)
+            if value is not missing:
+                return value
+            return loader()
+        try:
+            value = loader()
+            self.put(key, value)
+            return value
+        finally:
+            with self._lock:
+                self._loading.pop(key).set()
+
+    def invalidate(self, prefix=None) -> None:
+        """
+        :param prefix: remove the entries whose key is a tuple starting with this value, None removes everything
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if prefix is None or (isinstance(key, tuple) and key[0] == prefix):
+                    self._remove(key)
+
+    def discard(self, key) -> None:
+        """
+        :param key: key of the entry to remove, if it is cached
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key) -> None:
+        self._size -= self._entries.pop(key)[1]
+
+
+class WarmUp:
+    """
+    Background stage run right after login, loading the data the role's main menu is most likely
+    to need into the session cache, so the first screens are shown from memory.
+    """
+
+    def __init__(self, loaders, session_cache):
+        """
+        :param list loaders: (key, loader function) pairs, run in order
+        :param SessionCache session_cache: cache the results are stored in
+        """
+        self.loaders = loaders
+        self.session_cache = session_cache
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="warm-up", daemon=True)
+
+    @staticmethod
+    def start(loaders, session_cache=None):
+        """
+        :param list loaders: (key, loader function) pairs
+        :param SessionCache session_cache: default is the shared session_cache
+        :return: the started WarmUp, which can be cancelled
+        """
+        warm_up = WarmUp(loaders, session_cache or cache)
+        warm_up._thread.start()
+        return warm_up
+
+    def _run(self) -> None:
+        for key, loader in self.loaders:
+            # cancelling stops the stage between two loaders, a query already running is allowed to finish
+            if self._cancelled.is_set():
+                return
+            try:
+                self.session_cache.get_or_load(key, loader)
+            except Exception:
+                # warming up is only an optimisation, the screen will run the query itself
+                continue
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def is_alive(self) -> bool:
+        return self._thread.is_alive()
+
+
+# cache shared by the whole process
+cache = SessionCache()
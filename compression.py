@@ -0,0 +1,99 @@
+import lzma
+import zlib
+
+
+class CompressionHelper:
+    """
+    Helper class for compressing long free-text fields before they are encrypted.
+    Ciphertext is incompressible, so any compression has to happen on the plain text.
+
+    Stored format: a single codec flag byte followed by the Fernet token of the compressed text.
+    Rows written before compression was introduced are plain Fernet tokens, which always start with 'g'
+    (the base64 form of the Fernet version byte), so they can never be mistaken for a flagged value.
+    """
+
+    ZLIB_FLAG = b'z'
+    LZMA_FLAG = b'x'
+
+    # (minimum size in bytes, codec flag, compression level) - checked from the largest threshold down,
+    # texts shorter than the last threshold are left uncompressed as the codec overhead would outweigh the saving
+    LEVELS = ((16384, LZMA_FLAG, 6),
+              (1024, ZLIB_FLAG, 9),
+              (96, ZLIB_FLAG, 6))
+
+    @staticmethod
+    def compress(data=b'') -> tuple:
+        """
+        :param bytes data: encoded plain text
+        :return: (codec flag, compressed bytes), flag is b'' if the text is stored uncompressed
+        """
+        for threshold, flag, level in CompressionHelper.LEVELS:
+            if len(data) >= threshold:
+                if flag == CompressionHelper.LZMA_FLAG:
+                    compressed = lzma.compress(data, format=lzma.FORMAT_ALONE, preset=level)
+                else:
+                    compressed = zlib.compress(data, level)
+                # only keep the compressed form if it actually saves space
+                if len(compressed) < len(data):
+                    return flag, compressed
+                break
+        return b'', data
+
+    @staticmethod
+    def decompress(flag, data=b'') -> bytes:
+        """
+        :param bytes flag: codec flag read from the stored value
+        :param bytes data: compressed bytes
+        :return: decompressed bytes
+        """
+        if flag == CompressionHelper.ZLIB_FLAG:
+            return zlib.decompress(data)
+        elif flag == CompressionHelper.LZMA_FLAG:
+            return lzma.decompress(data, format=lzma.FORMAT_ALONE)
+        return data
+
+    @staticmethod
+    def is_flagged(stored=b'') -> bool:
+        """
+        :param bytes stored: value as stored in the database
+        :return: True if the value was written by the compress-then-encrypt codec
+        """
+        return stored[:1] in (CompressionHelper.ZLIB_FLAG, CompressionHelper.LZMA_FLAG)
+
+
+if __name__ == '__main__':
+    """
+    If the file is run, it will generate a synthetic set of visits and report the space saved
+    by compressing the free-text fields before encryption.
+    """
+    import random
+    from tabulate import tabulate
+    from encryption import EncryptionHelper
+
+    vocabulary = ("patient", "reports", "persistent", "dry", "cough", "for", "two", "weeks", "no", "fever",
+                  "history", "of", "asthma", "advised", "to", "continue", "inhaler", "and", "return", "if",
+                  "symptoms", "worsen", "blood", "pressure", "within", "normal", "range", "mild", "headache",
+                  "prescribed", "paracetamol", "follow", "up", "in", "one", "month", "referred", "physiotherapy",
+                  "lower", "back", "pain", "after", "lifting", "allergic", "reaction", "penicillin", "noted")
+    # (field, minimum words, maximum words)
+    fields = (("Visit.PatientInfo", 5, 40), ("Visit.Diagnosis", 10, 80), ("Visit.Notes", 40, 600),
+              ("Patient.Introduction", 10, 60), ("GP.Introduction", 20, 120))
+    rows_per_field = 500
+
+    random.seed(2020)
+    EH = EncryptionHelper()
+    report = []
+    total_plain, total_compressed = 0, 0
+    for field, min_words, max_words in fields:
+        plain_size, compressed_size = 0, 0
+        for _ in range(rows_per_field):
+            text = " ".join(random.choice(vocabulary) for _ in range(random.randint(min_words, max_words)))
+            plain_size += len(EH.encrypt_to_bits(text))
+            compressed_size += len(EH.encrypt_compressed(text))
+        total_plain += plain_size
+        total_compressed += compressed_size
+        report.append((field, plain_size, compressed_size, f"{100 * (1 - compressed_size / plain_size):.1f}%"))
+    report.append(("Total", total_plain, total_compressed, f"{100 * (1 - total_compressed / total_plain):.1f}%"))
+    print(f"Generated {rows_per_field} rows per field.")
+    print(tabulate(report, headers=["Field", "Encrypted (bytes)", "Compressed + Encrypted (bytes)", "Saved"],
+                   tablefmt="fancy_grid", numalign="left"))
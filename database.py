@@ -1,20 +1,151 @@
+import datetime
+import logging
 import sqlite3
+import threading
 from sqlite3 import Error
 
 from encryption import EncryptionHelper, PasswordHelper
 
+logger = logging.getLogger("main.Database")
+
+
+class Timeslot(datetime.datetime):
+    """
+    datetime of a timeslot, passed to sqlite3 as INTEGER minutes since the epoch (see TimeslotCodec) through
+    the __conform__ protocol, so no adapter is registered and other datetime parameters are left alone.
+    Arithmetic, replace() and the class constructors (combine, now, strptime) return Timeslot again.
+    """
+
+    def __conform__(self, protocol):
+        if protocol is sqlite3.PrepareProtocol:
+            return TimeslotCodec.encode(self)
+        return None
+
+    @staticmethod
+    def of(value) -> "Timeslot":
+        """
+        :param datetime value: start of a timeslot
+        :return: the same time as a Timeslot
+        """
+        return Timeslot.combine(value.date(), value.time())
+
+
+class TimeslotCodec:
+    """
+    Timeslots are stored as INTEGER minutes since 1970-01-01 00:00 (local time, without a timezone) and
+    handled as Timeslot (a datetime) in Python: a timeslot parameter is either a Timeslot or encoded with
+    encode() by the caller, and SQLQuery.fetch_all returns the columns named in COLUMNS as Timeslot. Dates
+    are still passed as 'YYYY-MM-DD' text, so a Timeslot must be compared with TimeslotCodec.start_of(date),
+    never with the date itself.
+    """
+
+    EPOCH = datetime.datetime(1970, 1, 1)
+    MINUTE = datetime.timedelta(minutes=1)
+    # result columns decoded by SQLQuery.fetch_all, lower case
+    COLUMNS = frozenset({"timeslot", "newtimeslot"})
+
+    @staticmethod
+    def encode(value) -> int:
+        """
+        :param datetime value: start of the timeslot, seconds are ignored
+        :return: minutes since the epoch
+        """
+        return (value - TimeslotCodec.EPOCH) // TimeslotCodec.MINUTE
+
+    @staticmethod
+    def decode(minutes) -> Timeslot:
+        """
+        :param int minutes: minutes since the epoch
+        :return: start of the timeslot
+        """
+        return Timeslot.of(TimeslotCodec.EPOCH + minutes * TimeslotCodec.MINUTE)
+
+    @staticmethod
+    def start_of(day) -> Timeslot:
+        """
+        :param date day: a date
+        :return: midnight at the start of the date, to compare timeslots with
+        """
+        return Timeslot.combine(day, datetime.time())
+
+    @staticmethod
+    def decode_rows(result, description) -> list:
+        """
+        :param list result: rows fetched by a cursor
+        :param description: description of the cursor
+        :return: the rows, with the integers of the Timeslot columns decoded
+        """
+        columns = [index for index, column in enumerate(description or ())
+                   if column[0].lower() in TimeslotCodec.COLUMNS]
+        if not columns:
+            return result
+        decoded = []
+        for row in result:
+            row = list(row)
+            for index in columns:
+                if isinstance(row[index], int):
+                    row[index] = TimeslotCodec.decode(row[index])
+            decoded.append(tuple(row))
+        return decoded
+
 
 class Database:
     """
     Class for establishing and managing the database connection
+
+    Concurrency contract:
+    - every thread uses its own connection to each database file, opened on first use and reused by all
+      SQLQuery and SQLTransaction objects of that thread (Database.connection), so sqlite3 connections are
+      never shared between threads;
+    - SQLQuery objects keep no state between calls and can be shared by any number of threads;
+      an SQLTransaction collects statements and must be built and committed by a single thread;
+    - every SQLQuery.commit and SQLTransaction.commit is its own transaction, committed or rolled back
+      before it returns, so a connection never holds an open transaction between calls;
+    - the database runs in WAL mode: readers do not block the writer and the other way round, concurrent
+      writers wait for each other up to BUSY_TIMEOUT seconds.
     """
 
+    # seconds a statement waits for another connection's write lock before failing
+    BUSY_TIMEOUT = 30
+    JOURNAL_MODE = "WAL"
+
+    # connections of the current thread, db_file -> sqlite3.Connection
+    _local = threading.local()
+
     def __init__(self, db_file="GPDB.db"):
         """
         :param str db_file: Path to sqlite .db file, default = GPDB.db
         """
         self.db_file = db_file
 
+    def connection(self) -> sqlite3.Connection:
+        """
+        :return: the connection of the current thread to the database, opened on first use
+        """
+        connections = getattr(Database._local, "connections", None)
+        if connections is None:
+            connections = Database._local.connections = {}
+        conn = connections.get(self.db_file)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=Database.BUSY_TIMEOUT)
+            try:
+                conn.execute("PRAGMA journal_mode = {0}".format(Database.JOURNAL_MODE))
+            except Error:
+                # e.g. read-only media, the default journal still works
+                pass
+            connections[self.db_file] = conn
+        return conn
+
+    @staticmethod
+    def close_thread_connections() -> None:
+        """
+        Close the connections of the current thread, e.g. before a worker thread ends.
+        Connections of finished threads are also closed when they are garbage collected.
+        """
+        for conn in getattr(Database._local, "connections", {}).values():
+            conn.close()
+        Database._local.connections = {}
+
     def create_connection(self) -> bool:
         """
         Create a connection to the database
@@ -62,12 +193,14 @@ class Database:
 
 class SQLQuery(Database):
     """
-    Class representing an SQL query as an object
+    Class representing an SQL query as an object.
+    The object is immutable and keeps no state between calls, so it can be shared by threads.
     """
 
-    def __init__(self, query):
+    def __init__(self, query, db_file="GPDB.db"):
         """
         :param str query: Query to be executed
+        :param str db_file: Path to sqlite .db file, default = GPDB.db
         placeholder should be implemented using the Named Method
         You aren't able to use placeholders for column or table names. 
         sql_ = "SELECT * FROM gw_assay WHERE point_id = :id AND analyte = :a AND sampling_date = :d"
@@ -76,7 +209,7 @@ class SQLQuery(Database):
         sql_ = "SELECT * FROM gw_assay WHERE point_id = ? AND analyte = ? AND sampling_date = ?"
         par_ = (point_id, analyte, sampling_date)
         """
-        super().__init__()
+        super().__init__(db_file)
         self.query = query
 
     def fetch_all(self, decrypter=None, parameters=tuple()) -> list:
@@ -87,25 +220,29 @@ class SQLQuery(Database):
         :return: result array
         references: https://blog.finxter.com/sqlite-python-placeholder-four-methods-for-sql-statements
         """
-        if self.create_connection():
-            cur = self.conn.cursor()
-            self.execute_query(cur, parameters)
-            result = cur.fetchall()
-            self.close_connection()
-            if isinstance(decrypter, EncryptionHelper):
-                decrypted_result = list()
-                for row in result:
-                    current_row = list()
-                    for cell in row:
-                        if isinstance(cell, bytes):
-                            current_row.append(decrypter.decrypt_message(cell))
-                        else:
-                            current_row.append(cell)
-                    decrypted_result.append(current_row)
-                return decrypted_result
-            return result
-        else:
+        try:
+            conn = self.connection()
+        except Error as e:
+            logger.error(f"Could not connect to {self.db_file}: {e}")
             return []
+        cur = conn.cursor()
+        try:
+            self.execute_query(cur, parameters)
+            result = TimeslotCodec.decode_rows(cur.fetchall(), cur.description)
+        finally:
+            cur.close()
+        if isinstance(decrypter, EncryptionHelper):
+            decrypted_result = list()
+            for row in result:
+                current_row = list()
+                for cell in row:
+                    if isinstance(cell, bytes):
+                        current_row.append(decrypter.decrypt_message(cell))
+                    else:
+                        current_row.append(cell)
+                decrypted_result.append(current_row)
+            return decrypted_result
+        return result
 
     def commit(self, parameters=tuple(), multiple_queries=False) -> list:
         """
@@ -115,45 +252,149 @@ class SQLQuery(Database):
         execute and Commit Insert, Update and Delete query using the parameters and return the last row updated ID
         references: https://www.sqlitetutorial.net/sqlite-python/insert/ 
         """
-        if self.create_connection():
-            cur = self.conn.cursor()
+        try:
+            conn = self.connection()
+        except Error as e:
+            logger.error(f"Could not connect to {self.db_file}: {e}")
+            return []
+        cur = conn.cursor()
+        try:
             if not multiple_queries:
                 self.execute_query(cur, parameters)
             else:
                 self.execute_multiple_query(cur)
-            self.conn.commit()
-            result = cur.lastrowid
-            self.close_connection()
-            return result
-        else:
-            return []
+            conn.commit()
+            return cur.lastrowid
+        except BaseException:
+            # the connection is reused by the thread, it must not be left inside the failed transaction
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
 
     def execute_query(self, cursor, parameters):
         """
+        Errors propagate to the caller, e.g. a request of the API fails while its worker thread goes on.
+
         :param cursor: connection to the database
         :param tuple parameters: Parameters for the query
         """
-        try:
-            cursor.execute(self.query, parameters)
-        except sqlite3.DatabaseError as e:
-            print("Database disk image is malformed.", e)
-            from iohandler import Parser
-            Parser.user_quit()
+        cursor.execute(self.query, parameters)
 
     def execute_multiple_query(self, cursor):
+        """
+        :param cursor: connection to the database
+        """
+        cursor.executescript(self.query)
+
+
+class SQLTransaction(Database):
+    """
+    Class representing several parameterised statements committed in a single transaction.
+    A transaction must be built and committed by the same thread.
+    """
+
+    def __init__(self, db_file="GPDB.db"):
+        """
+        :param str db_file: Path to sqlite .db file, default = GPDB.db
+        """
+        super().__init__(db_file)
+        self.statements = []
+
+    def add(self, query, parameters=tuple(), many=False):
+        """
+        :param str query: Query to be executed, placeholders as in SQLQuery
+        :param parameters: Parameters for the query, or a list of parameter tuples if many is True
+        :param bool many: set true to execute the query once for every tuple in parameters (executemany)
+        :return: the transaction itself, so that statements can be chained
+        """
+        self.statements.append((query, parameters, many))
+        return self
+
+    def commit(self) -> bool:
+        """
+        Execute all added statements in order and commit them together, rolling back if any of them fails.
+        :return: True if the transaction was committed
+        """
         try:
-            cursor.executescript(self.query)
-        except sqlite3.DatabaseError as e:
-            print("Database disk image is malformed.", e)
-            from iohandler import Parser
-            Parser.user_quit()
+            conn = self.connection()
+        except Error as e:
+            logger.error(f"Could not connect to {self.db_file}: {e}")
+            return False
+        cur = conn.cursor()
+        try:
+            for query, parameters, many in self.statements:
+                if many:
+                    cur.executemany(query, parameters)
+                else:
+                    cur.execute(query, parameters)
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error(f"Database error, transaction rolled back: {e}")
+            return False
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
 
 
 if __name__ == '__main__':
     """
     If the file is run, it will attempt to recreate the database using existing schema.
     Only one user will be added - testAdmin
+
+    python database.py --stress [threads] [operations per thread] instead runs a stress test of the
+    concurrent use of SQLQuery and SQLTransaction on a scratch database.
     """
+    import sys
+    if "--stress" in sys.argv:
+        import os
+        import tempfile
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        numbers = [int(argument) for argument in sys.argv[sys.argv.index("--stress") + 1:]]
+        threads, operations = (numbers + [32, 200][len(numbers):])[:2]
+        scratch = os.path.join(tempfile.mkdtemp(), "stress.db")
+        SQLQuery("CREATE TABLE counter (ID INTEGER PRIMARY KEY, Value INTEGER NOT NULL); "
+                 "CREATE TABLE entries (Worker INTEGER NOT NULL, Number INTEGER NOT NULL, "
+                 "PRIMARY KEY (Worker, Number)); INSERT INTO counter VALUES (1, 0);", scratch
+                 ).commit(multiple_queries=True)
+        # one shared query object per statement, used by all threads at the same time
+        insert = SQLQuery("INSERT INTO entries VALUES (?, ?)", scratch)
+        count = SQLQuery("SELECT COUNT(*) FROM entries WHERE Worker = ?", scratch)
+
+        def work(worker) -> int:
+            errors = 0
+            for number in range(operations):
+                if number % 4 == 0:
+                    committed = SQLTransaction(scratch).add("UPDATE counter SET Value = Value + 1 WHERE ID = 1"
+                                                            ).add("INSERT INTO entries VALUES (?, ?)",
+                                                                  (worker, number)).commit()
+                    errors += not committed
+                else:
+                    insert.commit((worker, number))
+                if count.fetch_all(parameters=(worker,))[0][0] != number + 1 - errors:
+                    errors += 1
+            Database.close_thread_connections()
+            return errors
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            failures = sum(executor.map(work, range(threads)))
+        elapsed = time.perf_counter() - started
+        total = SQLQuery("SELECT COUNT(*) FROM entries", scratch).fetch_all()[0][0]
+        counter = SQLQuery("SELECT Value FROM counter", scratch).fetch_all()[0][0]
+        expected_counter = threads * len(range(0, operations, 4))
+        print(f"{threads} threads x {operations} operations: {2 * threads * operations} statements in "
+              f"{elapsed:.2f} s ({2 * threads * operations / elapsed:.0f}/s)")
+        print(f"rows: {total}/{threads * operations}, transactions: {counter}/{expected_counter}, "
+              f"inconsistent reads or failed transactions: {failures}")
+        sys.exit(0 if failures == 0 and total == threads * operations and counter == expected_counter else 1)
+
     while True:
         try:
             DB = Database("GPDB.db")
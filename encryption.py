@@ -1,4 +1,4 @@
-from cryptography.fernet import Fernet
+from compression import CompressionHelper
 import hashlib
 
 
@@ -22,14 +22,20 @@ class EncryptionHelper:
     object for loading the encryption key
     references: https://nitratine.net/blog/post/encryption-and-decryption-in-python/#reading-keys
     """
+    # loaded keys and ciphers by key path, so the key file is read and cryptography imported only once
+    _ciphers = {}
+
     def __init__(self, key_path="secure/GPDB.key"):
         """
         :param key_path: specify path to key leave blank for default
         """
-        file = open(key_path, 'rb')
-        self.key = file.read()
-        self.cipher = Fernet(self.key)
-        file.close()
+        if key_path not in EncryptionHelper._ciphers:
+            from cryptography.fernet import Fernet
+            file = open(key_path, 'rb')
+            key = file.read()
+            file.close()
+            EncryptionHelper._ciphers[key_path] = (key, Fernet(key))
+        self.key, self.cipher = EncryptionHelper._ciphers[key_path]
     
     def encrypt_to_bits(self, info="") -> str:
         """
@@ -40,11 +46,26 @@ class EncryptionHelper:
         encrypted_message = self.cipher.encrypt(to_bit_message)
         return encrypted_message
 
+    def encrypt_compressed(self, info="") -> bytes:
+        """
+        Compress-then-encrypt, used for long free-text fields (diagnosis, notes, introductions).
+        Short texts are stored in the plain encrypt_to_bits format.
+
+        :param str info: information in string for encoding
+        :return: bit object for storage in DB, prefixed with the codec flag if compressed
+        """
+        flag, to_bit_message = CompressionHelper.compress(info.encode())
+        return flag + self.cipher.encrypt(to_bit_message)
+
     def decrypt_message(self, ciphered_text=b''):
         """
-        :param ciphered_text: information in string for encoding
-        :return: bit object for storage in DB
+        :param ciphered_text: bit object stored in DB, either a plain or a compressed (flagged) token
+        :return: decrypted message as string
         """
-        decrypted_bits = self.cipher.decrypt(ciphered_text)
+        if CompressionHelper.is_flagged(ciphered_text):
+            flag, ciphered_text = ciphered_text[:1], ciphered_text[1:]
+            decrypted_bits = CompressionHelper.decompress(flag, self.cipher.decrypt(ciphered_text))
+        else:
+            decrypted_bits = self.cipher.decrypt(ciphered_text)
         message = decrypted_bits.decode()
         return message
@@ -0,0 +1,171 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formatter writing the event data attached to a record as a single JSON line.
+    """
+
+    def format(self, record) -> str:
+        event = {"ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds")}
+        event.update(getattr(record, "event_data", {"event": "message", "message": record.getMessage()}))
+        return json.dumps(event, separators=(",", ":"), default=str)
+
+
+class CompressedRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler which gzips every rotated segment (events.jsonl.1.gz, events.jsonl.2.gz, ...).
+    """
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.namer = lambda name: name + ".gz"
+        self.rotator = CompressedRotatingFileHandler.compress
+
+    @staticmethod
+    def compress(source, destination) -> None:
+        with open(source, "rb") as plain_file, gzip.open(destination, "wb") as compressed_file:
+            shutil.copyfileobj(plain_file, compressed_file)
+        os.remove(source)
+
+
+class EventLog:
+    """
+    Structured event log: one JSON object per line with the event type, user type, operation,
+    duration and row count, written through the "events" logger (see LogPipeline.configure).
+    """
+
+    FILE_NAME = "events.jsonl"
+    MAX_BYTES = 5000000
+    BACKUP_COUNT = 50
+
+    logger = logging.getLogger("events")
+
+    @staticmethod
+    def create_handler(log_dir="log") -> logging.Handler:
+        """
+        :param str log_dir: directory of the event log
+        :return: handler writing the events of the "events" logger only
+        """
+        handler = CompressedRotatingFileHandler(os.path.join(log_dir, EventLog.FILE_NAME),
+                                                maxBytes=EventLog.MAX_BYTES, backupCount=EventLog.BACKUP_COUNT,
+                                                delay=True)
+        handler.setFormatter(JsonFormatter())
+        handler.addFilter(logging.Filter("events"))
+        return handler
+
+    @staticmethod
+    def record(event, operation, duration=None, rows=None, user_type=None, **fields) -> None:
+        """
+        :param str event: event type, e.g. "booking"
+        :param str operation: what was done, e.g. "create"
+        :param float duration: duration in seconds
+        :param int rows: number of rows read or written
+        :param str user_type: Admin, GP or Patient
+        :param fields: any further JSON serialisable details
+        """
+        event_data = {"event": event, "operation": operation, "user_type": user_type,
+                      "duration_ms": None if duration is None else round(duration * 1000, 3), "rows": rows}
+        event_data.update(fields)
+        EventLog.logger.info(event, extra={"event_data": event_data})
+
+    @staticmethod
+    @contextmanager
+    def timed(event, operation, user_type=None, **fields):
+        """
+        Record an event with the duration of the with-block. The block may set "rows" or any other
+        field in the yielded dict, e.g. details["rows"] = len(result).
+        """
+        details = dict(fields)
+        started = time.perf_counter()
+        try:
+            yield details
+        finally:
+            EventLog.record(event, operation, duration=time.perf_counter() - started, user_type=user_type,
+                            **details)
+
+    @staticmethod
+    def segments(log_dir="log") -> list:
+        """
+        :param str log_dir: directory of the event log
+        :return: paths of all segments of the event log, oldest first
+        """
+        base = os.path.join(log_dir, EventLog.FILE_NAME)
+        rotated = [f"{base}.{number}.gz" for number in range(EventLog.BACKUP_COUNT, 0, -1)]
+        return [path for path in rotated + [base] if os.path.exists(path)]
+
+    @staticmethod
+    def read(log_dir="log", event=None, operation=None, user_type=None, since=None, until=None):
+        """
+        Stream the events of all segments matching the filters, oldest first, without loading whole segments.
+
+        :param str event: only events of this type
+        :param str operation: only events of this operation
+        :param str user_type: only events of this user type
+        :param datetime since: only events at or after this time
+        :param datetime until: only events before this time
+        """
+        since = since.isoformat() if since else None
+        until = until.isoformat() if until else None
+        for path in EventLog.segments(log_dir):
+            opener = gzip.open if path.endswith(".gz") else open
+            with opener(path, "rt", encoding="utf-8") as segment:
+                for line in segment:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    # timestamps are ISO strings, so they compare correctly as text
+                    if (since and entry["ts"] < since) or (until and entry["ts"] >= until) \
+                            or (event and entry.get("event") != event) \
+                            or (operation and entry.get("operation") != operation) \
+                            or (user_type and entry.get("user_type") != user_type):
+                        continue
+                    yield entry
+
+
+if __name__ == '__main__':
+    """
+    If the file is run, it streams the event log filtered by the command line options, e.g.
+    python events.py --event booking --since 2020-12-08 --until 2020-12-09 --summary
+    """
+    import argparse
+    import statistics
+
+    parser = argparse.ArgumentParser(description="Read the structured event log.")
+    parser.add_argument("--log-dir", default="log")
+    parser.add_argument("--event")
+    parser.add_argument("--operation")
+    parser.add_argument("--user-type")
+    parser.add_argument("--since", type=datetime.datetime.fromisoformat, help="YYYY-MM-DD[ HH:MM]")
+    parser.add_argument("--until", type=datetime.datetime.fromisoformat, help="YYYY-MM-DD[ HH:MM], exclusive")
+    parser.add_argument("--summary", action="store_true", help="print duration statistics instead of the events")
+    arguments = parser.parse_args()
+
+    entries = EventLog.read(arguments.log_dir, arguments.event, arguments.operation, arguments.user_type,
+                            arguments.since, arguments.until)
+    if not arguments.summary:
+        for entry in entries:
+            print(json.dumps(entry))
+    else:
+        durations, rows = [], 0
+        for entry in entries:
+            if entry.get("duration_ms") is not None:
+                durations.append(entry["duration_ms"])
+            rows += entry.get("rows") or 0
+        if not durations:
+            print("No matching events.")
+        else:
+            durations.sort()
+            print(f"events: {len(durations)}, rows: {rows}")
+            print(f"duration ms - mean: {statistics.mean(durations):.3f}, "
+                  f"median: {statistics.median(durations):.3f}, "
+                  f"p95: {durations[int(0.95 * (len(durations) - 1))]:.3f}, max: {durations[-1]:.3f}")
@@ -17,3 +17,17 @@ class NotQuarterIntervalError(Exception):
     error class created for datetime object
     """
     pass
+
+
+class BookingError(Exception):
+    """
+    error class created for booking operations not allowed by the booking rules
+    """
+    pass
+
+
+class AccessError(Exception):
+    """
+    error class created for requests the authenticated user is not allowed to make
+    """
+    pass
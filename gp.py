@@ -1,13 +1,18 @@
 from tabulate import tabulate
 from encryption import EncryptionHelper
 from iohandler import Parser, Paging
-from database import SQLQuery
+from database import SQLQuery, SQLTransaction, Timeslot, TimeslotCodec
+from search import VisitSearchIndex
+from events import EventLog
+from cache import cache
+from booking import BookingService
+from slotindex import FreeSlotIndex
+from availability import AvailabilityTemplate
+from reassignment import ReassignmentEngine
 import time
 import datetime
 from main import User, MenuHelper
-from exceptions import DBRecordError
-# for helping patient book appointment
-from patient import Patient
+from exceptions import DBRecordError, BookingError
 # logging
 import logging
 
@@ -19,6 +24,8 @@ class GP(User):
     GP Class with navigation options and various functionalities.
     """
 
+    __slots__ = ()
+
     def main_menu(self) -> None:
         """
         Main Menu for GP-type users.
@@ -54,12 +61,15 @@ class GP(User):
             Parser.print_clean()
             option_selection = Parser.selection_parser(
                 options={"A": "View all your current availability", "D": "Edit availability by date",
-                         "--back": "to go back"})
+                         "T": "Manage your weekly availability pattern", "--back": "to go back"})
             if option_selection == "--back":
                 Parser.print_clean()
                 return
+            elif option_selection == "T":
+                self.edit_availability_template()
+                continue
             elif option_selection == "A":
-                today = datetime.datetime.combine(datetime.date.today(), datetime.time(0, 0, 0))
+                today = TimeslotCodec.start_of(datetime.date.today())
                 availability_result = Paging.give_pointer(SQLQuery("SELECT Timeslot FROM available_time WHERE StaffId "
                                                                    "= ? AND Timeslot >= ?")
                                                           .fetch_all(parameters=(self.ID, today)))
@@ -82,7 +92,8 @@ class GP(User):
             availability_result = SQLQuery(
                 "SELECT Timeslot FROM available_time WHERE StaffID = ? AND Timeslot >= ? AND Timeslot <= ? "
                 "ORDER BY Timeslot",
-            ).fetch_all(parameters=(self.ID, selected_date, selected_date + datetime.timedelta(days=1)))
+            ).fetch_all(parameters=(self.ID, TimeslotCodec.start_of(selected_date),
+                                    TimeslotCodec.start_of(selected_date + datetime.timedelta(days=1))))
             # Creating two corresponding tables for the fetched data - one for SQL manipulation, one for display
             availability_table = Paging.give_pointer(availability_result)
             Parser.print_clean(f"You are viewing your schedule for: {selected_date}")
@@ -107,44 +118,45 @@ class GP(User):
         Method to remove available timeslots for a given day
         !IMPORTANT Should only be called from within GP.edit_availability
         
-        :param: list availability_table: availability table for the selected day
+        :param: list availability_table: availability table for the selected day, ordered by timeslot
         """
-        slots_to_remove = []
         while True:
             # Selecting the entries to remove
             selected_entry = Parser.list_number_parser("Select the entry to remove using their corresponding IDs"
                                                        "from the 'Pointer' column.",
-                                                       (1, len(availability_table) + 1))
+                                                       (1, len(availability_table)))
             if selected_entry == '--back':
                 return False
-            for row in availability_table:
-                if row[0] in selected_entry:
-                    slots_to_remove.append(row[1])
+            # the table is ordered by timeslot, so every range of pointers is a range of timeslots
+            ranges_to_remove = [(availability_table[start - 1][1], availability_table[end - 1][1], end - start + 1)
+                                for start, end in selected_entry.ranges()]
             print("These time slot will be removed and made unavailable for future bookings:")
-            slots_to_remove = Paging.give_pointer(slots_to_remove)
-            Paging.show_page(1, slots_to_remove, 10, 2, ["Pointer", "Timeslot"])
+            Paging.show_page(1, Paging.give_pointer(ranges_to_remove), 10, 4,
+                             ["Pointer", "From", "To", "Number of slots"])
             confirm = Parser.selection_parser(options={"Y": "Confirm", "N": "Go back and select again"})
             # Confirm if user wants to delete slots
             if confirm == "Y":
-                try:
-                    for slot in slots_to_remove:
-                        SQLQuery("DELETE FROM available_time WHERE StaffID = ? AND Timeslot = ?"
-                                 ).commit((self.ID, slot[1]))
+                with EventLog.timed("availability", "remove", self.user_type, rows=len(selected_entry)):
+                    removed = SQLTransaction().add("DELETE FROM available_time WHERE StaffID = ? AND Timeslot >= ? "
+                                                   "AND Timeslot <= ?",
+                                                   [(self.ID, first, last) for first, last, _ in ranges_to_remove],
+                                                   many=True).commit()
+                if removed:
+                    FreeSlotIndex.remove_ranges(self.ID, [(first, last) for first, last, _ in ranges_to_remove])
+                    BookingService.invalidate_availability()
                     print("Slots removed successfully.")
-                    logger.info("Removed timeslot, DB transaction completed")
+                    logger.info(f"Removed {len(selected_entry)} timeslots in {len(ranges_to_remove)} ranges, "
+                                f"DB transaction completed")
                     # input("Press Enter to continue...")
                     Parser.handle_input()
                     return True
-                # temporary exception
-                except DBRecordError:
+                else:
                     print("Error encountered")
                     logger.warning("Error in DB, remove action failed")
-                    slots_to_remove = []
                     # input("Press Enter to continue...")
                     Parser.handle_input()
             if confirm == "N":
                 print("Removal cancelled.")
-                slots_to_remove = []
                 # input("Press Enter to continue...")
                 Parser.handle_input()
 
@@ -165,7 +177,7 @@ class GP(User):
                 if start_time == "--back":
                     return False
                 else:
-                    selected_start = datetime.datetime.combine(selected_date, start_time)
+                    selected_start = Timeslot.combine(selected_date, start_time)
                     stage = 1
             while stage == 1:
                 end_time = Parser.time_parser(f"GP {self.username}: Each timeslot is  15 minutes long. You have "
@@ -177,7 +189,7 @@ class GP(User):
                 if end_time == "--back":
                     stage = 0
                 else:
-                    selected_end = datetime.datetime.combine(selected_date, end_time)
+                    selected_end = Timeslot.combine(selected_date, end_time)
                     stage = 2
             while stage == 2:
                 temporary_time = selected_start
@@ -190,8 +202,16 @@ class GP(User):
                 confirm = Parser.selection_parser(options={"Y": "Confirm", "N": "Go back and select again"})
                 if confirm == "Y":
                     try:
-                        for slot in slots_to_add:
-                            SQLQuery("INSERT INTO available_time VALUES (?, ?)").commit((self.ID, slot[1]))
+                        added = []
+                        with EventLog.timed("availability", "add", self.user_type, rows=len(slots_to_add)):
+                            try:
+                                for slot in slots_to_add:
+                                    SQLQuery("INSERT INTO available_time VALUES (?, ?)").commit((self.ID, slot[1]))
+                                    added.append(slot[1])
+                            finally:
+                                # the slots committed before a failed insert are indexed as well
+                                FreeSlotIndex.add_many(self.ID, added)
+                        BookingService.invalidate_availability()
                         print("Your slots have been successfully added!")
                         logger.info("Added timeslot, DB transaction completed")
                         # input("Press Enter to continue...")
@@ -211,6 +231,145 @@ class GP(User):
                     print("Starting over...")
                     time.sleep(2)
 
+    def edit_availability_template(self) -> None:
+        """
+        Method to view and edit the weekly availability rules and exceptions of the logged in GP, and to
+        generate the available timeslots from them.
+        !IMPORTANT Should only be called from within GP.edit_availability
+        """
+        while True:
+            Parser.print_clean(f"Weekly availability pattern for GP {self.username}")
+            rules = AvailabilityTemplate.rules(self.ID)
+            exceptions = AvailabilityTemplate.exceptions(self.ID)
+            rules_table = Paging.give_pointer([[AvailabilityTemplate.WEEKDAYS[weekday], start, end,
+                                                valid_from or "-", valid_until or "-"]
+                                               for _, weekday, start, end, valid_from, valid_until in rules])
+            exceptions_table = Paging.give_pointer([[exception_date, start or "all day", end or "", reason or ""]
+                                                    for _, exception_date, start, end, reason in exceptions])
+            options = {"R": "add a weekly rule", "E": "add an exception or holiday"}
+            if rules_table:
+                print("Rules:")
+                Paging.show_page(1, rules_table, 10, 6, ["Pointer", "Weekday", "From", "To", "Valid from",
+                                                         "Valid until"])
+                options["X"] = "remove a rule"
+                options["G"] = "generate timeslots from the rules"
+            else:
+                print("You have no weekly rules yet.")
+            if exceptions_table:
+                print("Exceptions:")
+                Paging.show_page(1, exceptions_table, 10, 5, ["Pointer", "Date", "From", "To", "Reason"])
+                options["Y"] = "remove an exception"
+            options["--back"] = "back to previous page"
+            option_selection = Parser.selection_parser(options=options)
+            if option_selection == "--back":
+                return
+            elif option_selection == "R":
+                weekday = Parser.list_number_parser("Select the weekday: " + ", ".join(
+                    f"{number + 1} {name}" for number, name in enumerate(AvailabilityTemplate.WEEKDAYS)),
+                    (1, 7), allow_multiple=False)
+                if weekday == "--back":
+                    continue
+                hours = self.template_hours(f"every {AvailabilityTemplate.WEEKDAYS[weekday - 1]}")
+                if hours is None:
+                    continue
+                valid_from = Parser.date_parser("First date the rule applies to:")
+                if valid_from == "--back":
+                    continue
+                valid_until = Parser.date_parser("Last date the rule applies to:")
+                if valid_until == "--back" or valid_until < valid_from:
+                    print("The rule was not added, the last date must not be before the first one.")
+                    Parser.handle_input()
+                    continue
+                AvailabilityTemplate.add_rule(self.ID, weekday - 1, hours[0], hours[1], valid_from, valid_until)
+                logger.info("Added availability rule")
+            elif option_selection == "E":
+                exception_date = Parser.date_parser("Select the date of the exception:")
+                if exception_date == "--back":
+                    continue
+                whole_day = Parser.selection_parser(options={"H": "the whole day (holiday)",
+                                                             "T": "some hours of the day"})
+                hours = (None, None)
+                if whole_day == "T":
+                    hours = self.template_hours(f"on {exception_date}")
+                    if hours is None:
+                        continue
+                reason = Parser.string_parser("Enter a short reason, e.g. 'Holiday':")
+                AvailabilityTemplate.add_exception(self.ID, exception_date, hours[0], hours[1], reason)
+                logger.info("Added availability exception")
+            elif option_selection in ("X", "Y"):
+                table, rows = (rules_table, rules) if option_selection == "X" else (exceptions_table, exceptions)
+                selected_entry = Parser.list_number_parser("Select the entry to remove using their corresponding "
+                                                           "IDs from the 'Pointer' column.", (1, len(table)),
+                                                           allow_multiple=False)
+                if selected_entry == "--back":
+                    continue
+                if option_selection == "X":
+                    AvailabilityTemplate.remove_rule(self.ID, rows[selected_entry - 1][0])
+                else:
+                    AvailabilityTemplate.remove_exception(self.ID, rows[selected_entry - 1][0])
+                logger.info("Removed availability rule or exception")
+            elif option_selection == "G":
+                end_date = Parser.date_parser("Generate timeslots from today until:")
+                if end_date == "--back":
+                    continue
+                with EventLog.timed("availability", "materialise", self.user_type) as details:
+                    report = AvailabilityTemplate.materialise(self.ID, end_date=end_date)
+                    details["rows"] = report["added"]
+                if not report["committed"]:
+                    print("Error encountered, no timeslots were added.")
+                    logger.warning("Error in DB, materialise action failed")
+                else:
+                    BookingService.invalidate_availability()
+                    print(f"{report['added']} timeslots added, {report['existing']} were already available.")
+                    logger.info(f"Materialised {report['added']} timeslots, DB transaction completed")
+                    if report["booked"]:
+                        print("These timeslots were skipped because they are already booked:")
+                        Paging.show_page(1, Paging.give_pointer([[slot] for slot in report["booked"]]), 10, 2,
+                                         ["Pointer", "Timeslot"])
+                    if report["skipped"]:
+                        print("These timeslots were skipped because they were added or booked in the meantime:")
+                        Paging.show_page(1, Paging.give_pointer([[slot] for slot in report["skipped"]]), 10, 2,
+                                         ["Pointer", "Timeslot"])
+                Parser.handle_input()
+
+    def template_hours(self, description):
+        """
+        Collect the start and end time of a rule or an exception.
+
+        :param str description: when the hours apply, e.g. "every Monday"
+        :return: (start time, end time), or None if the user went back
+        """
+        while True:
+            start_time = Parser.time_parser(f"GP {self.username}: enter the start of the first appointment "
+                                            f"{description}:")
+            if start_time == "--back":
+                return None
+            end_time = Parser.time_parser(f"GP {self.username}: enter the end of the last appointment "
+                                          f"{description}:")
+            if end_time == "--back":
+                return None
+            if end_time > start_time:
+                return start_time, end_time
+            print("The end time cannot be earlier than the start time!")
+            Parser.handle_input()
+
+    def warm_up_loaders(self) -> list:
+        """
+        :return: the pending bookings of the GP, the first list shown when managing bookings
+        """
+        return [(("pending", self.ID), lambda: GP.load_pending_bookings(self.ID))]
+
+    @staticmethod
+    def load_pending_bookings(staff_id) -> list:
+        """
+        :param staff_id: ID of the GP
+        :return: the bookings of the GP waiting for a response, ordered by Timeslot
+        """
+        return SQLQuery("SELECT visit.BookingNo, visit.Timeslot, visit.NHSNo, users.firstName, "
+                        "users.lastName, visit.Confirmed FROM visit INNER JOIN users ON "
+                        "visit.NHSNo = users.ID WHERE visit.StaffID = ? AND visit.Confirmed = "
+                        "'P' ORDER BY visit.Timeslot ASC").fetch_all(EncryptionHelper(), parameters=(staff_id,))
+
     def manage_bookings(self) -> None:
         """
         Method to manage bookings for a GP.
@@ -221,16 +380,18 @@ class GP(User):
                 Parser.print_clean(f"Managing bookings for GP {self.username}.")
                 option_selection = Parser.selection_parser(
                     options={"P": "View and edit your pending bookings", "D": "View and edit bookings by date",
-                             "--back": "to go back"})
+                             "A": "Confirm several pending bookings at once",
+                             "C": "Cancel all your bookings over a date range", "--back": "to go back"})
                 if option_selection == "--back":
                     Parser.print_clean()
                     return
+                elif option_selection == "A":
+                    self.confirm_pending_bookings()
+                elif option_selection == "C":
+                    self.cancel_bookings_range()
                 elif option_selection == "P":
-                    bookings_result = SQLQuery("SELECT visit.BookingNo, visit.Timeslot, visit.NHSNo, users.firstName, "
-                                               "users.lastName, visit.Confirmed FROM visit INNER JOIN users ON "
-                                               "visit.NHSNo = users.ID WHERE visit.StaffID = ? AND visit.Confirmed = "
-                                               "'P' ORDER BY visit.Timeslot ASC").fetch_all(EncryptionHelper(),
-                                                                                            parameters=(self.ID,))
+                    bookings_result = cache.get_or_load(("pending", self.ID),
+                                                      lambda: GP.load_pending_bookings(self.ID))
                     message = "with status 'pending'."
                     stage = 1
                 elif option_selection == "D":
@@ -244,27 +405,24 @@ class GP(User):
                             "users.lastName, visit.Confirmed FROM visit INNER JOIN users ON "
                             "visit.NHSNo = users.ID WHERE visit.StaffID = ? AND visit.Timeslot >= ?"
                             " AND visit.Timeslot <= ? ORDER BY visit.Timeslot ASC"
-                        ).fetch_all(EncryptionHelper(), (self.ID, selected_date,
-                                                         selected_date + datetime.timedelta(
-                                                             days=1)))
+                        ).fetch_all(EncryptionHelper(), (self.ID, TimeslotCodec.start_of(selected_date),
+                                                         TimeslotCodec.start_of(
+                                                             selected_date + datetime.timedelta(days=1))))
                         message = f"for: {selected_date.strftime('%Y-%m-%d')}"
                         stage = 1
             while stage == 1:
                 if option_selection == "P":
-                    bookings_result = SQLQuery("SELECT visit.BookingNo, visit.Timeslot, visit.NHSNo, users.firstName, "
-                                               "users.lastName, visit.Confirmed FROM visit INNER JOIN users ON "
-                                               "visit.NHSNo = users.ID WHERE visit.StaffID = ? AND visit.Confirmed = "
-                                               "'P' ORDER BY visit.Timeslot ASC").fetch_all(EncryptionHelper(),
-                                                                                            parameters=(self.ID,))
+                    bookings_result = cache.get_or_load(("pending", self.ID),
+                                                      lambda: GP.load_pending_bookings(self.ID))
                 elif option_selection == "D":
                     bookings_result = SQLQuery(
                         "SELECT visit.BookingNo, visit.Timeslot, visit.NHSNo, users.firstName, "
                         "users.lastName, visit.Confirmed FROM visit INNER JOIN users ON "
                         "visit.NHSNo = users.ID WHERE visit.StaffID = ? AND visit.Timeslot >= ?"
                         " AND visit.Timeslot <= ? ORDER BY visit.Timeslot ASC"
-                    ).fetch_all(EncryptionHelper(), (self.ID, selected_date,
-                                                     selected_date + datetime.timedelta(
-                                                         days=1)))
+                    ).fetch_all(EncryptionHelper(), (self.ID, TimeslotCodec.start_of(selected_date),
+                                                     TimeslotCodec.start_of(
+                                                         selected_date + datetime.timedelta(days=1))))
                 row = GP.print_select_bookings(bookings_result, message)
                 if not row:
                     stage = 0
@@ -272,6 +430,134 @@ class GP(User):
                     self.booking_transaction(row)
                     stage = 0
 
+    def confirm_pending_bookings(self) -> bool:
+        """
+        Method to confirm several pending bookings of the GP at once.
+        !IMPORTANT Should only be called from within GP.manage_bookings
+        """
+        # read from the database, the bookings are changed in bulk and patients may have cancelled meanwhile
+        pending = GP.load_pending_bookings(self.ID)
+        cache.put(("pending", self.ID), pending)
+        bookings_table = Paging.give_pointer(pending)
+        if not bookings_table:
+            print("You have no pending bookings.")
+            Parser.handle_input()
+            return False
+        Parser.print_clean()
+        Paging.show_page(1, bookings_table, 10, 7, ["Pointer", "BookingNo", "timeslot", "Patient NHSNo", "P. Name",
+                                                    "P. Last Name", "Confirmed"])
+        selection = Parser.list_number_parser("Select the bookings to confirm by the Pointer, e.g. 1-5, 8",
+                                              (1, len(bookings_table)))
+        if selection == "--back":
+            return False
+        print("Warning! This will reject all other pending bookings for these timeslots. ")
+        confirm = Parser.selection_parser(options={"Y": "Confirm", "N": "Rollback"})
+        if confirm == "N":
+            return False
+        try:
+            with EventLog.timed("booking", "confirm_many", self.user_type) as details:
+                report = BookingService.confirm_many(self.ID, [bookings_table[pointer - 1][1] for pointer in selection])
+                details["rows"] = len(report["confirmed"]) + len(report["rejected"])
+        except BookingError as e:
+            print("Error encountered:", e)
+            logger.warning(f"Confirming bookings failed: {e}")
+            Parser.handle_input()
+            return False
+        print(f"{len(report['confirmed'])} bookings confirmed, {len(report['rejected'])} conflicting bookings "
+              f"rejected.")
+        if report["missing"]:
+            print(f"These bookings were cancelled meanwhile and could not be confirmed: "
+                  f"{', '.join(str(booking_no) for booking_no in report['missing'])}")
+            logger.info(f"Bookings {report['missing']} no longer existed when confirmed")
+        logger.info("Several bookings confirmed")
+        Parser.handle_input()
+        return True
+
+    def cancel_bookings_range(self) -> bool:
+        """
+        Method to cancel all bookings of the GP over a date range at once, e.g. when the GP is off sick.
+        !IMPORTANT Should only be called from within GP.manage_bookings
+        """
+        return GP.cancel_range_menu(self.ID, self.username, self.user_type)
+
+    @staticmethod
+    def cancel_range_menu(staff_id, username, user_type) -> bool:
+        """
+        Cancel, or move to other GPs, all bookings of a GP over a date range. Shared by the GP and Admin menus.
+
+        :param str staff_id: ID of the GP whose bookings are cancelled
+        :param str username: username of that GP
+        :param str user_type: type of the user acting, for the event log
+        :return: True if the bookings were cancelled
+        """
+        start_date = Parser.date_parser(question=f"Cancelling bookings for GP {username}\n"
+                                                 f"Select the first date:")
+        if start_date == "--back":
+            return False
+        end_date = Parser.date_parser(question="Select the last date:")
+        if end_date == "--back":
+            return False
+        if end_date < start_date:
+            print("The last date cannot be earlier than the first date.")
+            Parser.handle_input()
+            return False
+        slots = Parser.selection_parser(
+            options={"D": "Remove all availability in these dates", "K": "Keep the availability, the "
+                     "cancelled timeslots can be booked again", "--back": "to go back"})
+        if slots == "--back":
+            return False
+        bookings = Parser.selection_parser(
+            options={"M": "Move the bookings to the nearest free timeslot of another GP of the same gender, cancel "
+                     "the ones which cannot be moved",
+                     "R": "Move the bookings to the same timeslots of a GP you choose, cancel the ones which "
+                     "cannot be moved",
+                     "C": "Cancel the bookings", "--back": "to go back"})
+        if bookings == "--back":
+            return False
+        reassign_to = None
+        if bookings == "R":
+            gps = SQLQuery("SELECT ID, firstName, lastName FROM Users WHERE UserType = 'GP' AND ID != ?"
+                           ).fetch_all(parameters=(staff_id,), decrypter=EncryptionHelper())
+            options = {str(number): f"Dr {first_name} {last_name}"
+                       for number, (_, first_name, last_name) in enumerate(gps, 1)}
+            options["--back"] = "to go back"
+            selected = Parser.selection_parser(options=options)
+            if selected == "--back":
+                return False
+            reassign_to = gps[int(selected) - 1][0]
+        print(f"Warning! This will {'cancel' if bookings == 'C' else 'move or cancel'} all bookings of GP {username} "
+              f"from {start_date} to {end_date} and notify the patients.")
+        confirm = Parser.selection_parser(options={"Y": "Confirm", "N": "Rollback"})
+        if confirm == "N":
+            return False
+        try:
+            if bookings == "M":
+                # the moves and the cancellations of the bookings left are made in one transaction
+                with EventLog.timed("booking", "reassign", user_type) as details:
+                    report = ReassignmentEngine.reassign(staff_id, start_date, end_date, restore_slots=slots == "K",
+                                                         cancel_rest=True)
+                    details["rows"] = report["reassigned"] + report["cancelled"]
+            else:
+                with EventLog.timed("booking", "cancel_range", user_type) as details:
+                    report = BookingService.cancel_range(staff_id, start_date, end_date, drop_slots=slots == "D",
+                                                         reassign_to=reassign_to)
+                    details["rows"] = report["cancelled"]
+        except BookingError as e:
+            print("Error encountered:", e)
+            logger.warning(f"Cancelling bookings failed: {e}")
+            Parser.handle_input()
+            return False
+        if bookings != "C":
+            print(f"{report['reassigned']} bookings moved to other GPs.")
+        print(f"{report['cancelled']} bookings cancelled, {report['notified']} patients notified.")
+        if slots == "D":
+            print(f"{report['dropped']} free timeslots removed.")
+        else:
+            print(f"{report['restored']} timeslots can be booked again.")
+        logger.info(f"Bookings of {staff_id} over a date range cancelled")
+        Parser.handle_input()
+        return True
+
     @staticmethod
     def print_select_bookings(bookings_result, message):
         """
@@ -320,15 +606,14 @@ class GP(User):
                 if confirm == 'N':
                     pass
                 else:
-                    SQLQuery("UPDATE Visit SET Confirmed = 'F' WHERE StaffID = ? AND Timeslot = ? AND BookingNo != ?"
-                             ).commit((self.ID, selected_row[2], selected_row[1]))
-                    logger.info("removing conflicting confirmed bookings")
-                    SQLQuery("UPDATE Visit SET Confirmed = 'T' WHERE BookingNo = ?"
-                             ).commit((selected_row[1],))
+                    with EventLog.timed("booking", "confirm", self.user_type):
+                        BookingService.confirm(self.ID, selected_row[1])
+                        logger.info("removing conflicting confirmed bookings")
                     logger.info("setting selected booking as confirmed, action successful")
                     return True
             elif user_input == "R":
-                SQLQuery("UPDATE Visit SET Confirmed = 'F' WHERE BookingNo = ?").commit((selected_row[1],))
+                with EventLog.timed("booking", "reject", self.user_type, rows=1):
+                    BookingService.reject(self.ID, selected_row[1])
                 logger.info("removing confirmed bookings")
                 return True
 
@@ -343,7 +628,11 @@ class GP(User):
             while stage == 0:
                 print(f"Viewing confirmed appointments for GP {self.username}.")
                 user_input = Parser.selection_parser(options={"T": "View today's appointments", "D": "Select by Date",
+                                                              "S": "Search past visits by diagnosis or notes",
                                                               "--back": "to go back"})
+                if user_input == "S":
+                    self.search_visits()
+                    continue
                 if user_input == "T":
                     selected_date = datetime.datetime.today().date()
                     print(str(selected_date))
@@ -362,8 +651,9 @@ class GP(User):
                                            "users.lastName, visit.Confirmed FROM visit INNER JOIN users ON "
                                            "visit.NHSNo = users.ID WHERE visit.StaffID = ? AND visit.Timeslot >= ? AND "
                                            "visit.Timeslot <= ? AND visit.Confirmed = 'T' ORDER BY visit.Timeslot ASC")\
-                    .fetch_all(decrypter=EncryptionHelper(), parameters=(self.ID, selected_date,
-                                                                         selected_date + datetime.timedelta(days=1)))
+                    .fetch_all(decrypter=EncryptionHelper(),
+                               parameters=(self.ID, TimeslotCodec.start_of(selected_date),
+                                           TimeslotCodec.start_of(selected_date + datetime.timedelta(days=1))))
                 message = f"for {selected_date.strftime('%Y-%m-%d')} (confirmed)."
                 booking_no = GP.print_select_bookings(bookings_result, message)
                 if not booking_no:
@@ -371,6 +661,34 @@ class GP(User):
                 else:
                     GP.start_appointment(booking_no[1])
 
+    def search_visits(self) -> None:
+        """
+        Method to search the logged in GP's visits by terms in their diagnosis or notes.
+        !IMPORTANT Should only be called from within GP.view_appointment
+        """
+        while True:
+            search_text = Parser.string_parser("Enter the search terms (e.g. 'asthma'), all terms must match, "
+                                               "or enter '--back' to go back:")
+            if search_text == "--back":
+                Parser.print_clean()
+                return
+            field_selection = Parser.selection_parser(options={"D": "Search diagnosis", "N": "Search notes",
+                                                               "A": "Search both"})
+            fields = VisitSearchIndex.FIELDS if field_selection == "A" else (field_selection,)
+            with EventLog.timed("visit", "search", self.user_type) as details:
+                booking_numbers = VisitSearchIndex.search(search_text, fields, staff_id=self.ID)
+                details["rows"] = len(booking_numbers)
+            logger.info(f"Searched visits, {len(booking_numbers)} matches")
+            bookings_result = SQLQuery("SELECT visit.BookingNo, visit.Timeslot, visit.NHSNo, users.firstName, "
+                                       "users.lastName, visit.Confirmed FROM visit INNER JOIN users ON "
+                                       "visit.NHSNo = users.ID WHERE visit.BookingNo IN ({0}) "
+                                       "ORDER BY visit.Timeslot DESC".format(", ".join("?" * len(booking_numbers)))
+                                       ).fetch_all(EncryptionHelper(), parameters=tuple(booking_numbers))
+            Parser.print_clean()
+            selected_row = GP.print_select_bookings(bookings_result, f"matching '{search_text}'.")
+            if selected_row:
+                GP.start_appointment(selected_row[1])
+
     @staticmethod
     def start_appointment(booking_no):
         """
@@ -423,11 +741,16 @@ class GP(User):
                 print(booking_information[0][10])
                 print("")
                 diagnosis = Parser.string_parser("Please enter your diagnosis: ")
-                diagnosis_encrypted = encrypter.encrypt_to_bits(info=diagnosis)
-                SQLQuery(" UPDATE Visit SET diagnosis = ? WHERE BookingNo = ? ").commit(
-                    (diagnosis_encrypted, booking_no))
-                logger.info(f"Updated diagnosis for booking: {booking_no}")
-                print("The diagnosis has been recorded successfully!")
+                diagnosis_encrypted = encrypter.encrypt_compressed(info=diagnosis)
+                transaction = SQLTransaction().add(" UPDATE Visit SET diagnosis = ? WHERE BookingNo = ? ",
+                                                   (diagnosis_encrypted, booking_no))
+                VisitSearchIndex.add_to_transaction(transaction, booking_no, VisitSearchIndex.DIAGNOSIS, diagnosis)
+                if transaction.commit():
+                    logger.info(f"Updated diagnosis for booking: {booking_no}")
+                    print("The diagnosis has been recorded successfully!")
+                else:
+                    logger.error(f"Diagnosis for booking {booking_no} could not be saved")
+                    print("The diagnosis could not be saved, please try again.")
                 # input("Press Enter to continue...")
                 Parser.handle_input()
 
@@ -436,11 +759,16 @@ class GP(User):
                 print("")
                 print(booking_information[0][11])
                 notes_input = Parser.string_parser("Please enter your notes: ")
-                notes_input_encrypted = encrypter.encrypt_to_bits(info=notes_input)
-                SQLQuery(" UPDATE Visit SET notes = ? WHERE BookingNo = ? ").commit((notes_input_encrypted,
-                                                                                     booking_no))
-                logger.info(f"Updated Notes for booking: {booking_no}")
-                print("Your notes have been recorded successfully!")
+                notes_input_encrypted = encrypter.encrypt_compressed(info=notes_input)
+                transaction = SQLTransaction().add(" UPDATE Visit SET notes = ? WHERE BookingNo = ? ",
+                                                   (notes_input_encrypted, booking_no))
+                VisitSearchIndex.add_to_transaction(transaction, booking_no, VisitSearchIndex.NOTES, notes_input)
+                if transaction.commit():
+                    logger.info(f"Updated Notes for booking: {booking_no}")
+                    print("Your notes have been recorded successfully!")
+                else:
+                    logger.error(f"Notes for booking {booking_no} could not be saved")
+                    print("Your notes could not be saved, please try again.")
                 # input("Press Enter to continue...")
                 Parser.handle_input()
 
@@ -488,6 +816,8 @@ class GP(User):
                         Parser.handle_input()
                         break
             elif user_input == "B":
+                # for helping patient book appointment, imported here as most GP sessions never need it
+                from patient import Patient
                 patient_username = booking_information[0][-1]
                 patient_object = Patient(patient_username)
                 logger.info(f"GP trying to book appiontment for patient :{patient_username}")
@@ -498,7 +828,7 @@ class GP(User):
                 else:
                     print("booking failed")
                     logger.warning(f"The booking failed or canceled")
-                input("Press enter to continue")
+                Parser.handle_input("Press enter to continue")
                 Parser.print_clean()
                 del patient_object
 
@@ -507,12 +837,13 @@ class GP(User):
         print("You need to input additional information before you can proceed.")
         Parser.handle_input("Press Enter to continue...")
         encrypt = EncryptionHelper().encrypt_to_bits
+        encrypt_compressed = EncryptionHelper().encrypt_compressed
         specialty = encrypt(Parser.string_parser("Enter your specialisation: "))
         Parser.print_clean("Enter your gender: ")
         gender = Parser.selection_parser(options={"M": "Male", "F": "Female", "N": "Do not disclose"})
         clinic_address = encrypt(Parser.string_parser("Enter your clinic address (one line): "))
         clinic_postcode = MenuHelper.valid_postcode()
-        info = encrypt(Parser.string_parser("Enter an intro paragraph about yourself: "))
+        info = encrypt_compressed(Parser.string_parser("Enter an intro paragraph about yourself: "))
         try:
             SQLQuery("INSERT INTO GP(ID, Gender, ClinicAddress, ClinicPostcode, Speciality, Introduction) VALUES (?, "
                      "?, ?, ?, ?, ?)").commit(parameters=(self.ID, gender, clinic_address, clinic_postcode,
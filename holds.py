@@ -0,0 +1,120 @@
+import logging
+import sqlite3
+import threading
+import time
+from database import Database, SQLQuery, Timeslot
+from slotbitmap import SlotBitmap
+
+logger = logging.getLogger("main.Holds")
+
+
+class SlotHold:
+    """
+    Short-lived reservations of available slots. Selecting a slot holds it for HOLD_SECONDS, during which
+    it is hidden from the searches of other patients and only its holder can book it, so patients stop
+    losing the slot they are confirming to someone who picked it a moment later.
+
+    Holds are rows of slot_hold, so they are shared by every process using the database. A hold counts
+    only until ExpiresAt (seconds since the epoch), expired rows are merely deleted by the sweeper thread,
+    started by the first hold of the process.
+    """
+
+    HOLD_SECONDS = 120
+    SWEEP_SECONDS = 30
+
+    TABLE_SCRIPT = """
+        CREATE TABLE IF NOT EXISTS slot_hold (
+            StaffID varchar(10) NOT NULL,
+            Timeslot INTEGER NOT NULL,
+            NHSNo varchar(10) NOT NULL,
+            ExpiresAt REAL NOT NULL,
+            PRIMARY KEY(StaffID, Timeslot)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS slot_hold_expiry ON slot_hold (ExpiresAt);
+        """
+
+    # a patient holds one slot at a time, the slot must be available and not held by someone else,
+    # {0} is SlotBitmap.slot_available()
+    RELEASE_OTHERS_QUERY = "DELETE FROM slot_hold WHERE NHSNo = ? AND NOT (StaffID = ? AND Timeslot = ?)"
+    HOLD_QUERY = ("INSERT INTO slot_hold (StaffID, Timeslot, NHSNo, ExpiresAt) SELECT ?, ?, ?, ? WHERE {0} "
+                  "ON CONFLICT(StaffID, Timeslot) DO UPDATE SET NHSNo = excluded.NHSNo, ExpiresAt = excluded.ExpiresAt "
+                  "WHERE slot_hold.NHSNo = excluded.NHSNo OR slot_hold.ExpiresAt <= ? RETURNING ExpiresAt")
+
+    _sweeper = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def hold(nhs_no, staff_id, timeslot) -> bool:
+        """
+        Hold the slot for the patient, or extend their hold, releasing any other slot they held.
+
+        :param nhs_no: NHS number of the patient
+        :param str staff_id: ID of the GP
+        :param datetime timeslot: slot to hold
+        :return: False if the slot is not available or held by another patient
+        """
+        SlotHold.start_sweeper()
+        timeslot = Timeslot.of(timeslot)
+        now = time.time()
+        connection = Database().connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(SlotHold.RELEASE_OTHERS_QUERY, (nhs_no, staff_id, timeslot))
+            row = connection.execute(SlotHold.HOLD_QUERY.format(SlotBitmap.slot_available()),
+                                     (staff_id, timeslot, nhs_no, now + SlotHold.HOLD_SECONDS, staff_id, timeslot,
+                                      now)).fetchone()
+            connection.commit()
+        except BaseException:
+            if connection.in_transaction:
+                connection.rollback()
+            raise
+        return row is not None
+
+    @staticmethod
+    def release(nhs_no) -> None:
+        """
+        :param nhs_no: NHS number of the patient whose hold is given up
+        """
+        SQLQuery("DELETE FROM slot_hold WHERE NHSNo = ?").commit((nhs_no,))
+
+    @staticmethod
+    def held(nhs_no=None) -> set:
+        """
+        :param nhs_no: NHS number of a patient whose own hold is not included
+        :return: (Timeslot, StaffID) of the slots held by other patients
+        """
+        return {(timeslot, staff_id) for timeslot, staff_id in
+                SQLQuery("SELECT Timeslot, StaffID FROM slot_hold WHERE ExpiresAt > ? AND NHSNo != ?"
+                         ).fetch_all(parameters=(time.time(), '' if nhs_no is None else nhs_no))}
+
+    @staticmethod
+    def sweep() -> int:
+        """
+        :return: number of expired holds deleted
+        """
+        connection = Database().connection()
+        with connection:
+            return connection.execute("DELETE FROM slot_hold WHERE ExpiresAt <= ?", (time.time(),)).rowcount
+
+    @staticmethod
+    def start_sweeper() -> None:
+        """
+        Start the thread deleting the expired holds every SWEEP_SECONDS, once per process.
+        """
+        with SlotHold._lock:
+            if SlotHold._sweeper is None:
+                SlotHold._sweeper = threading.Thread(target=SlotHold._sweep_forever, name="hold-sweeper", daemon=True)
+                SlotHold._sweeper.start()
+
+    @staticmethod
+    def _sweep_forever() -> None:
+        while True:
+            time.sleep(SlotHold.SWEEP_SECONDS)
+            try:
+                swept = SlotHold.sweep()
+            except sqlite3.Error as e:
+                # expired holds are ignored by every query, deleting them can wait for the next round
+                logger.warning(f"Expired holds could not be deleted: {e}")
+                continue
+            if swept:
+                logger.debug(f"{swept} expired slot holds deleted")
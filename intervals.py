@@ -0,0 +1,62 @@
+from bisect import bisect_right
+
+
+class IntervalSet:
+    """
+    Compact set of integers stored as merged, sorted, inclusive ranges.
+    Used for selections like '1-30, 45, 50-60', which never have to be expanded number by number.
+    """
+
+    __slots__ = ("_starts", "_ends")
+
+    def __init__(self, ranges=()):
+        """
+        :param ranges: iterable of (a, b) inclusive ranges, in any order, may overlap; a > b is allowed
+        """
+        starts, ends = [], []
+        for start, end in sorted((min(bounds), max(bounds)) for bounds in ranges):
+            # ranges that overlap or touch the previous one are merged into it
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        self._starts = starts
+        self._ends = ends
+
+    def __contains__(self, value) -> bool:
+        """
+        O(log n) membership test, n being the number of ranges.
+        """
+        position = bisect_right(self._starts, value) - 1
+        return position >= 0 and value <= self._ends[position]
+
+    def __iter__(self):
+        for start, end in zip(self._starts, self._ends):
+            yield from range(start, end + 1)
+
+    def __len__(self) -> int:
+        return sum(end - start + 1 for start, end in zip(self._starts, self._ends))
+
+    def __bool__(self) -> bool:
+        return bool(self._starts)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, IntervalSet):
+            return self._starts == other._starts and self._ends == other._ends
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return "IntervalSet({0})".format(self.ranges())
+
+    def ranges(self) -> list:
+        """
+        :return: list of merged (start, end) inclusive ranges in ascending order
+        """
+        return list(zip(self._starts, self._ends))
+
+    def min(self) -> int:
+        return self._starts[0]
+
+    def max(self) -> int:
+        return self._ends[-1]
@@ -1,11 +1,12 @@
 import time
 import datetime
 import sys
+import textwrap
+from collections import OrderedDict
 from typing import Iterable, Union
 from exceptions import *
-from tabulate import tabulate
-import os
-
+from intervals import IntervalSet
+from terminal import Terminal
 
 
 class Parser:
@@ -174,7 +175,8 @@ class Parser:
                 Parser.print_clean("Invalid Input!\n")
 
     @staticmethod
-    def list_number_parser(question, full_num_range, allow_back=True, allow_multiple=True) -> Union[list, str]:
+    def list_number_parser(question, full_num_range, allow_back=True, allow_multiple=True) \
+            -> Union[IntervalSet, int, str]:
         """
         Method to collect and process a range selection from user
 
@@ -182,6 +184,7 @@ class Parser:
         :param bool allow_multiple: True allows user to input a selection like 1-5, 6-10 etc.
         :param tuple full_num_range: (a, b)-like tuple specifying upper and lower bounds of the range
         :param bool allow_back: Specific whether '--back' is an allowed input
+        :return: IntervalSet of the selected numbers if allow_multiple, otherwise a single integer
         """
         while True:
             try:
@@ -191,30 +194,24 @@ class Parser:
                     print("Use 'a-b' to select the number in range a to b inclusive")
                     if allow_back:
                         print("Or enter '--back' to go back to previous page")
-                    result_final = []
                     result_raw = Parser.handle_input(input_question="")
                     if allow_back and result_raw == '--back':
                         return result_raw
-                    result_raw = (result_raw.strip(" ")).split(',')
-                    for element in result_raw:
-                        if '-' not in element:
-                            result_final.append(int(element))
-                        else:
-                            num_range = element.split('-')
-                            # map is a generator!!!
-                            num_range = list(map(int, num_range))
-                            list_num_range = list(range(min(num_range), max(num_range) + 1))
-                            result_final += list_num_range
-                    result_final = list(set(result_final))
-                    for num in result_final:
-                        if not min(full_num_range) <= num <= max(full_num_range):
+                    result_ranges = []
+                    for element in (result_raw.strip(" ")).split(','):
+                        # ranges are kept as (a, b) bounds and never expanded number by number
+                        num_range = list(map(int, element.split('-')))
+                        if len(num_range) > 2:
                             raise ValueError
-                    result_final.sort()
+                        result_ranges.append((num_range[0], num_range[-1]))
+                    result_final = IntervalSet(result_ranges)
+                    if result_final.min() < min(full_num_range) or result_final.max() > max(full_num_range):
+                        raise ValueError
                     return result_final
                 else:
                     if allow_back:
                         print("Or enter '--back' to go back to previous page")
-                        input_string = Parser.handle_input(input_question="")
+                    input_string = Parser.handle_input(input_question="")
                     if allow_back and input_string == '--back':
                         return input_string
                     else:
@@ -239,9 +236,9 @@ class Parser:
 
         :param str args: Messages to be printed
         """
-        os.system('cls' if os.name == 'nt' else 'clear')
-        for message in args:
-            print(message)
+        terminal = Terminal.current()
+        terminal.clear()
+        terminal.write_lines(*args)
 
     @staticmethod
     def string_parser(question) -> str:
@@ -272,7 +269,20 @@ class Parser:
         """
         while True:
             try:
-                return input(input_question)
+                return Terminal.current().read_line(input_question)
+            except KeyboardInterrupt:
+                continue
+
+    @staticmethod
+    def secret_input(input_question="Password: ") -> str:
+        """
+        Method to collect input without echoing it, e.g. a password.
+
+        :param str input_question: Prompt for the user
+        """
+        while True:
+            try:
+                return Terminal.current().read_secret(input_question)
             except KeyboardInterrupt:
                 continue
 
@@ -282,6 +292,11 @@ class Paging:
     Help with print and pointer
     """
 
+    # maximum number of rendered pages kept per browsed dataset
+    PAGE_CACHE_SIZE = 16
+    # maximum width of a table column, wider cells (e.g. decrypted notes) are wrapped onto several lines
+    MAX_COLUMN_WIDTH = 60
+
     @staticmethod
     def show_page(page, all_data_table, step, index, headers_holder):
         """
@@ -297,41 +312,143 @@ class Paging:
         """
         if step == 0:
             print("step must > 0")
-        else:
-            end = len(all_data_table)/step + 1 if len(all_data_table) % step != 0 else len(all_data_table)/step
-            start = 0 + (page-1)*step
-            stop = start + step
-            current = []
-            for row in all_data_table[start: stop]:
-                current.append(row[0:index])
-
-            print(tabulate(current, headers=headers_holder,
-                           tablefmt="fancy_grid",
-                           numalign="left"))
-            print("Page: - " + str(page) + " - ")
+            return
+        end = max(1, -(-len(all_data_table) // step))
+        page = min(max(page, 1), end)
+        # column widths are computed once for the whole dataset, so every page lines up and moving between
+        # pages only has to format the rows of that page
+        widths = Paging.column_widths(all_data_table, index, headers_holder)
+        rendered_pages = OrderedDict()
+        while True:
+            if page in rendered_pages:
+                rendered_pages.move_to_end(page)
+            else:
+                start = (page - 1) * step
+                current = [row[0:index] for row in all_data_table[start: start + step]]
+                rendered_pages[page] = Paging.render_table(current, headers_holder, widths)
+                if len(rendered_pages) > Paging.PAGE_CACHE_SIZE:
+                    rendered_pages.popitem(last=False)
+            print(rendered_pages[page])
+            print("Page: - " + str(page) + " - of " + str(end))
 
             user_input = Parser.selection_parser(
                 options={"A": " <-- back to previous page ", "D": " --> Proceed to next page ",
+                         "F": "go to the first page", "L": "go to the last page", "J": "jump to a page",
                          "C": "Continue to next part"})
             if user_input == "D":
-                page += 1
-                if page > end:
+                if page == end:
                     print("already the last page")
-                    input("Press Enter to Continue...")
-                    Paging.show_page(page - 1, all_data_table, step, index, headers_holder)
+                    Parser.handle_input("Press Enter to Continue...")
                 else:
-                    Paging.show_page(page, all_data_table, step, index, headers_holder)
+                    page += 1
             elif user_input == "A":
-                page -= 1
-                if page == 0:
+                if page == 1:
                     print("already the first page")
-                    input("Press Enter to Continue...")
-                    Paging.show_page(page + 1, all_data_table, step, index, headers_holder)
+                    Parser.handle_input("Press Enter to Continue...")
                 else:
-                    Paging.show_page(page, all_data_table, step, index, headers_holder)
+                    page -= 1
+            elif user_input == "F":
+                page = 1
+            elif user_input == "L":
+                page = end
+            elif user_input == "J":
+                page = Parser.list_number_parser(f"Enter a page number between 1 and {end}.", (1, end),
+                                                 allow_multiple=False)
+                if page == "--back":
+                    page = 1
             else:
                 return
 
+    @staticmethod
+    def column_widths(data, index, headers_holder, max_width=MAX_COLUMN_WIDTH) -> list:
+        """
+        Method to compute the width of every column of a table in a single pass over the data.
+
+        :param list data: lists of data list
+        :param int index: only the first index columns of each row are shown, None for all of them
+        :param list headers_holder: a list of table columns' name
+        :param int max_width: maximum column width, a column is never narrower than its header, None for unlimited
+        :return: list of column widths, excluding the cell padding
+        """
+        # like tabulate, headers get two extra characters of minimum padding
+        header_widths = [len(str(header)) + 2 for header in headers_holder][:index]
+        widths = list(header_widths)
+        for row in data:
+            for column, cell in enumerate(row[0:index]):
+                cell_width = max(len(line) for line in Paging.format_cell(cell).split("\n"))
+                if column >= len(widths):
+                    widths.append(cell_width)
+                elif cell_width > widths[column]:
+                    widths[column] = cell_width
+        if max_width:
+            header_widths += [0] * (len(widths) - len(header_widths))
+            widths = [min(width, max(max_width, header_width)) for width, header_width in zip(widths, header_widths)]
+        return widths
+
+    @staticmethod
+    def format_cell(cell) -> str:
+        """
+        :param cell: value of a table cell
+        :return: the cell as displayed in the table
+        """
+        return "" if cell is None else str(cell)
+
+    @staticmethod
+    def cell_lines(cell, width) -> list:
+        """
+        :param cell: value of a table cell
+        :param int width: width of the column
+        :return: lines of the cell, lines wider than the column are wrapped
+        """
+        lines = []
+        for line in Paging.format_cell(cell).split("\n"):
+            if len(line) <= width:
+                lines.append(line)
+            else:
+                lines.extend(textwrap.wrap(line, width, break_on_hyphens=False) or [""])
+        return lines
+
+    @staticmethod
+    def table_lines(data, headers_holder, widths):
+        """
+        Method to generate the lines of a table in the tabulate 'fancy_grid' format one at a time.
+
+        :param data: rows to render
+        :param list headers_holder: a list of table columns' name
+        :param list widths: column widths as returned by Paging.column_widths
+        """
+        def border(left, fill, middle, right):
+            return left + middle.join(fill * (width + 2) for width in widths) + right
+
+        def cells(row):
+            lines = [Paging.cell_lines(cell, width) for cell, width in zip(row, widths)]
+            lines += [[""]] * (len(widths) - len(lines))
+            for line_no in range(max(len(cell_lines) for cell_lines in lines)):
+                yield "│" + "│".join(" " + (cell_lines[line_no] if line_no < len(cell_lines) else "").ljust(width)
+                                     + " " for cell_lines, width in zip(lines, widths)) + "│"
+
+        yield border("╒", "═", "╤", "╕")
+        if headers_holder:
+            yield from cells(headers_holder)
+            yield border("╞", "═", "╪", "╡")
+        for row_no, row in enumerate(data):
+            if row_no:
+                yield border("├", "─", "┼", "┤")
+            yield from cells(row)
+        yield border("╘", "═", "╧", "╛")
+
+    @staticmethod
+    def render_table(data, headers_holder, widths) -> str:
+        """
+        Method to render rows in the tabulate 'fancy_grid' format using precomputed column widths.
+
+        :param list data: rows to render
+        :param list headers_holder: a list of table columns' name
+        :param list widths: column widths as returned by Paging.column_widths
+        :return: the table as a string
+        """
+        return "\n".join(Paging.table_lines(data, headers_holder, widths))
+
     @staticmethod
     def give_pointer(result):
         """
@@ -358,5 +475,7 @@ class Paging:
         :param list data: data to print
         :param list headers_holder: a list of table columns' name
         """
-        print(tabulate(data, headers=headers_holder, tablefmt="fancy_grid", numalign="left"))
+        # written line by line, a long table is never built as one string
+        for line in Paging.table_lines(data, headers_holder, Paging.column_widths(data, None, headers_holder)):
+            print(line)
         return
@@ -0,0 +1,172 @@
+import atexit
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+from events import EventLog
+
+
+class DebugSampler(logging.Filter):
+    """
+    Logging filter letting through every record of INFO level and above, but only one in every
+    sample_every DEBUG records.
+    """
+
+    def __init__(self, sample_every=1):
+        """
+        :param int sample_every: keep one DEBUG record out of this many, 1 keeps all of them
+        """
+        super().__init__()
+        self.sample_every = max(1, sample_every)
+        self._counter = itertools.count()
+
+    def filter(self, record) -> bool:
+        if record.levelno > logging.DEBUG or self.sample_every == 1:
+            return True
+        return next(self._counter) % self.sample_every == 0
+
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler which does not flush after every record.
+    The file is flushed by the BatchingQueueListener once per batch instead.
+    """
+
+    def flush(self) -> None:
+        pass
+
+    def flush_batch(self) -> None:
+        super().flush()
+
+
+class BatchingQueueListener:
+    """
+    Background thread writing the records put on the queue by a logging.handlers.QueueHandler.
+    Once woken up by a record it drains up to batch_size queued records before flushing the handlers,
+    so a burst of log calls costs one write per file.
+    """
+
+    # put on the queue by stop, the thread writes everything queued before it and exits
+    _STOP = object()
+
+    def __init__(self, log_queue, *handlers, batch_size=256):
+        """
+        :param queue.Queue log_queue: queue the records are put on
+        :param handlers: handlers the records are passed to, according to their level
+        :param int batch_size: maximum number of records written before the handlers are flushed
+        """
+        self.queue = log_queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._drain, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Write the queued records and wait for the thread to exit.
+        """
+        if self._thread is not None:
+            self.queue.put(BatchingQueueListener._STOP)
+            self._thread.join()
+            self._thread = None
+
+    def handle(self, record) -> None:
+        """
+        :param logging.LogRecord record: record already prepared by the QueueHandler
+        """
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _drain(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            for record in batch:
+                if record is BatchingQueueListener._STOP:
+                    stopping = True
+                else:
+                    self.handle(record)
+            for handler in self.handlers:
+                if isinstance(handler, BufferedRotatingFileHandler):
+                    handler.flush_batch()
+                else:
+                    handler.flush()
+
+
+class LogPipeline:
+    """
+    Asynchronous logging for the "main" and "events" loggers: log calls only put the record on a queue,
+    a background thread writes them to the rotating log files.
+    """
+
+    LOG_FORMAT = '%(asctime)s - %(name)s - %(module)s - %(levelname)s - %(message)s'
+    MAX_BYTES = 1000000
+    BACKUP_COUNT = 2
+    # keep one in every DEBUG_SAMPLE_EVERY debug records, INFO and above are always kept, 1 keeps all of them
+    DEBUG_SAMPLE_EVERY = 1
+
+    _listener = None
+
+    @staticmethod
+    def configure(log_dir="log", logger_name="main", debug_sample_every=DEBUG_SAMPLE_EVERY) -> logging.Logger:
+        """
+        Attach the queue-based pipeline to the logger. Safe to call more than once, later calls do nothing.
+
+        :param str log_dir: directory of the log files
+        :param str logger_name: name of the logger to configure
+        :param int debug_sample_every: keep one DEBUG record out of this many
+        :return: the configured logger
+        """
+        logger = logging.getLogger(logger_name)
+        if LogPipeline._listener is not None:
+            return logger
+        os.makedirs(log_dir, exist_ok=True)
+        handlers = []
+        for file_name, level in (("gp_system_debug_log.log", logging.DEBUG),
+                                 ("gp_system_info_log.log", logging.INFO),
+                                 ("gp_system_warning_log.log", logging.WARNING)):
+            handler = BufferedRotatingFileHandler(os.path.join(log_dir, file_name), maxBytes=LogPipeline.MAX_BYTES,
+                                                  backupCount=LogPipeline.BACKUP_COUNT, delay=True)
+            handler.setLevel(level)  # change this If you need different level
+            handler.setFormatter(logging.Formatter(LogPipeline.LOG_FORMAT))
+            handler.addFilter(logging.Filter(logger_name))
+            handlers.append(handler)
+        # structured events share the queue and the writer thread, but go to their own JSON file
+        handlers.append(EventLog.create_handler(log_dir))
+
+        log_queue = queue.Queue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(DebugSampler(debug_sample_every))
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(queue_handler)
+        EventLog.logger.setLevel(logging.INFO)
+        EventLog.logger.propagate = False
+        EventLog.logger.addHandler(queue_handler)
+
+        LogPipeline._listener = BatchingQueueListener(log_queue, *handlers)
+        LogPipeline._listener.start()
+        # the remaining records are written when the application quits (Parser.user_quit calls sys.exit)
+        atexit.register(LogPipeline.shutdown)
+        return logger
+
+    @staticmethod
+    def shutdown() -> None:
+        """
+        Write all queued records and stop the background writer thread.
+        """
+        if LogPipeline._listener is not None:
+            LogPipeline._listener.stop()
+            for handler in LogPipeline._listener.handlers:
+                handler.close()
+            LogPipeline._listener = None
@@ -1,33 +1,13 @@
-import logging.handlers
-from getpass import getpass
+import logging
+import sys
 from typing import Tuple
-from tabulate import tabulate
 from database import SQLQuery
 from encryption import EncryptionHelper, PasswordHelper
-from exceptions import DBRecordError
 from iohandler import Parser
+from userprofile import ProfileStore, ProfileField
 
-log_info = open('log/gp_system_info_log.log', 'a+')
-log_debug = open('log/gp_system_debug_log.log', 'a+')
-log_warning = open('log/gp_system_warning_log.log', 'a+')
-
-fh_info = logging.handlers.RotatingFileHandler('log/gp_system_info_log.log', maxBytes=1000000, backupCount=2)
-fh_info.setLevel(logging.INFO)  # change this If you need different level
-fh_info.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(levelname)s - %(message)s'))
-
-fh_debug = logging.handlers.RotatingFileHandler('log/gp_system_debug_log.log', maxBytes=1000000, backupCount=2)
-fh_debug.setLevel(logging.DEBUG)  # change this If you need different level
-fh_debug.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(levelname)s - %(message)s'))
-
-fh_warning = logging.handlers.RotatingFileHandler('log/gp_system_warning_log.log', maxBytes=1000000, backupCount=2)
-fh_warning.setLevel(logging.WARNING)  # change this If you need different level
-fh_warning.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(levelname)s - %(message)s'))
-
+# handlers are attached by LogPipeline.configure() when the application starts, see below
 main_logger = logging.getLogger("main")
-main_logger.setLevel(logging.DEBUG)
-main_logger.addHandler(fh_debug)
-main_logger.addHandler(fh_info)
-main_logger.addHandler(fh_warning)
 
 
 class MenuHelper:
@@ -36,61 +16,64 @@ class MenuHelper:
     Methods for login, registering and starting specific sub-functionalities
     """
 
+    @staticmethod
+    def welcome() -> None:
+        """
+        Welcome menu shown when the application starts, or when a terminal connects in server mode.
+        """
+        while True:
+            Parser.print_clean("Welcome to Group 6 GP System")
+            option_selection = Parser.selection_parser(options={"R": "register", "L": "login", "H": "help",
+                                                                "--quit": "quit"})
+
+            if option_selection == 'L':
+                main_logger.debug("Selected Login")
+                current_user = MenuHelper.login()
+                MenuHelper.dispatcher(current_user["username"], current_user["user_type"])
+            elif option_selection == 'R':
+                main_logger.debug("New user registration started")
+                result = MenuHelper.register()
+                Parser.user_quit()
+            elif option_selection == "H":
+                MenuHelper.help()
+
     @staticmethod
     def login() -> Tuple[str, str]:
         """
         Login to a registered account.
         :return: username, user account type
         """
+        from auth import AuthenticationService
+        from events import EventLog
         main_logger.debug("Entered Login Sequence")
-        for i in range(4, -1, -1):
-            main_logger.debug(f"Username attempt {5 - i}")
-            # limit to 5 username attempts
-            try:
-                # trying to get username
-                try_username = Parser.string_parser("Please enter your username: ")
-                main_logger.debug(f"UserName Entered: {try_username}")
-                # retrieving the user if exist to compare to PW
-                username_query = SQLQuery("SELECT username, passCode, Deactivated, UserType FROM Users "
-                                          "WHERE username == ?").fetch_all(parameters=(try_username,))
-                if len(username_query) != 1:
-                    raise DBRecordError
-                else:
-                    username = try_username
-                    login_array = username_query[0]
-                    user_type = login_array[3]
-                    Parser.print_clean("Username validated.")
-                    main_logger.info(f"{try_username}, user valid")
-                    break
-            except DBRecordError:
-                main_logger.warning("User doesn't exist or invalid")
-                Parser.print_clean(f"Invalid Username: {i} attempts remaining")
-        else:
-            Parser.print_clean("You've entered an incorrect username too many times.")
-            main_logger.critical("Too many failed Username attempts")
-            Parser.user_quit()
-        for i in range(4, -1, -1):
-            try:
-                # the PW is saved in hash so need to convert to hash to compare special parsing function because it will
-                # hide the needed
-                try_pw = PasswordHelper.hash_pw(getpass("Enter your password: "))
-                if try_pw == login_array[1]:
-                    Parser.print_clean("Password correct!")
-                    if login_array[2] == "T":
-                        Parser.print_clean("Your account is deactivated. Please contact the system administrator. ")
-                        main_logger.critical(f"{username}, user deactivated, quitting.")
-                        Parser.user_quit()
-                    else:
-                        return {"username": username, "user_type": user_type}
-                else:
-                    raise DBRecordError
-            except DBRecordError:
-                main_logger.warning("Password invalid")
-                Parser.print_clean(f"Invalid Password: {i} attempts remaining")
-        else:
-            Parser.print_clean("You've entered an incorrect password too many times.")
-            main_logger.critical("Too many failed Password attempts")
-            Parser.user_quit()
+        for attempt in range(1, AuthenticationService.MAX_ATTEMPTS + 1):
+            main_logger.debug(f"Login attempt {attempt}")
+            try_username = Parser.string_parser("Please enter your username: ")
+            main_logger.debug(f"UserName Entered: {try_username}")
+            try_password = Parser.secret_input("Enter your password: ")
+            status, profile = AuthenticationService.authenticate(try_username, try_password)
+            if status == AuthenticationService.SUCCESS:
+                Parser.print_clean("Login details correct!")
+                main_logger.info(f"{try_username}, user valid")
+                EventLog.record("login", "success", user_type=profile.user_type, attempts=attempt)
+                return {"username": profile.username, "user_type": profile.user_type}
+            elif status == AuthenticationService.DEACTIVATED:
+                Parser.print_clean("Your account is deactivated. Please contact the system administrator. ")
+                main_logger.critical(f"{try_username}, user deactivated, quitting.")
+                EventLog.record("login", "deactivated", user_type=profile.user_type)
+                Parser.user_quit()
+            elif status == AuthenticationService.LOCKED:
+                Parser.print_clean("Too many failed attempts for this account. Please try again later.")
+                main_logger.critical(f"{try_username}, too many failed attempts, quitting.")
+                EventLog.record("login", "locked")
+                Parser.user_quit()
+            main_logger.warning("Username or password invalid")
+            Parser.print_clean(f"Invalid username or password: "
+                               f"{AuthenticationService.MAX_ATTEMPTS - attempt} attempts remaining")
+        Parser.print_clean("You've entered incorrect login details too many times.")
+        main_logger.critical("Too many failed login attempts")
+        EventLog.record("login", "failed", attempts=AuthenticationService.MAX_ATTEMPTS)
+        Parser.user_quit()
 
     @staticmethod
     def register(admin=False) -> bool:
@@ -142,8 +125,9 @@ class MenuHelper:
         print("Wherever you are prompted to select an option from a list, simply type in the relevant letter and press "
               "Enter. These are not case-sensitive.\n")
         print("Where sizeable datasets are displayed for you, sometimes, a paging functionality will be used. To "
-              "navigate the pages, enter A to go to the previous page, D to go to the next page, and C to exit the "
-              "browse and proceed to further options.\n")
+              "navigate the pages, enter A to go to the previous page, D to go to the next page, F or L to go to the "
+              "first or last page, J to jump to a page number, and C to exit the browse and proceed to further "
+              "options.\n")
         print("You can logout at anytime by typing in --LOGOUT, or bring up this help function by typing in --HELP.\n")
         Parser.handle_input("Press Enter to return...")
         return
@@ -173,8 +157,8 @@ class MenuHelper:
         """
         while True:
             Parser.print_clean("Any leading or trailing empty spaces will be removed.")
-            password = getpass("Enter new password: ").strip()
-            password_confirm = getpass("Enter new password again: ").strip()
+            password = Parser.secret_input("Enter new password: ").strip()
+            password_confirm = Parser.secret_input("Enter new password again: ").strip()
             if (password != password_confirm) or (password == "") or (password_confirm == ""):
                 print("Passwords do not match. Please try again.\n")
                 continue
@@ -281,47 +265,62 @@ class MenuHelper:
         if not user.handle_login_count():
             print("Error handling login.")
             Parser.user_quit()
-        user.print_hello()
-        user.print_information()
-        user.main_menu()
+        # load what the role's menus show first in the background, while the greeting is printed
+        from cache import WarmUp
+        warm_up = WarmUp.start(user.warm_up_loaders())
+        main_logger.debug(f"Started warm-up of {len(warm_up.loaders)} cache entries")
+        try:
+            user.print_hello()
+            user.print_information()
+            user.main_menu()
+        finally:
+            # logging out ends the session, the remaining loaders are not needed anymore
+            warm_up.cancel()
 
 
 class User:
+    """
+    Logged in user. The profile is shared through the ProfileStore and its personal details are only
+    decrypted when they are first used, so constructing a User is cheap.
+    """
+
+    __slots__ = ("profile",)
+
+    ID = ProfileField()
+    username = ProfileField()
+    user_type = ProfileField()
+    deactivated = ProfileField()
+    login_count = ProfileField()
+    first_name = ProfileField()
+    last_name = ProfileField()
+    phone_no = ProfileField()
+    home_address = ProfileField()
+    postcode = ProfileField()
+    birthday = ProfileField()
+
     def __init__(self, username):
         """
         initializing user login process and return a User Object
         """
-        self.username = username
-
-        # retrieving the full information from DATAbase instead of just the password for authentication
-        self.user_data = SQLQuery(
-            "SELECT ID, username, firstName, lastName, phoneNo, HomeAddress, postCode, UserType, "
-            "deactivated, birthday, LoginCount FROM Users WHERE username == ?").fetch_all(decrypter=EncryptionHelper(),
-                                                                                          parameters=(username,))[0]
-        # loading the user info into a state
-        self.ID = self.user_data[0]
-        self.username = self.user_data[1]
-        self.first_name = self.user_data[2]
-        self.last_name = self.user_data[3]
-        self.phone_no = self.user_data[4]
-        self.home_address = self.user_data[5]
-        self.postcode = self.user_data[6]
-        self.user_type = self.user_data[7]
-        self.deactivated = self.user_data[8]
-        self.birthday = self.user_data[9]
-        self.login_count = self.user_data[10]
+        self.profile = ProfileStore.load(username)
 
     def handle_login_count(self) -> bool:
-        self.login_count += 1
-        if self.login_count <= 1:
-            if self.first_login():
-                SQLQuery("UPDATE Users SET LoginCount = ? WHERE ID = ?").commit(parameters=(self.login_count, self.ID))
-                return True
-            else:
-                return False
-        else:
+        """
+        Run the first login questions for new accounts. Later logins are counted by AuthenticationService.
+        """
+        if self.login_count > 0:
+            return True
+        if self.first_login():
+            self.login_count = 1
             SQLQuery("UPDATE Users SET LoginCount = ? WHERE ID = ?").commit(parameters=(self.login_count, self.ID))
             return True
+        return False
+
+    def warm_up_loaders(self) -> list:
+        """
+        :return: list of (cache key, loader function) pairs preloaded after login, see cache.WarmUp
+        """
+        return []
 
     def print_hello(self) -> bool:
         """
@@ -334,6 +333,7 @@ class User:
         """
         Display all User information.
         """
+        from tabulate import tabulate
         print(tabulate([("User Type:", self.user_type),
                         ("First Name: ", self.first_name),
                         ("Last Name: ", self.last_name),
@@ -381,6 +381,9 @@ class User:
                 from sqlite3 import DatabaseError
                 SQLQuery("UPDATE Users SET {0} = ? WHERE username = ?".format(parameter)).commit((new_parameter_value,
                                                                                                   self.username))
+                # reload the profile so the new value is shown
+                ProfileStore.invalidate(self.ID)
+                self.profile = ProfileStore.load(self.username)
                 print("Parameter updated successfully!")
                 main_logger.info("Updated record in database.")
             except DatabaseError:
@@ -391,31 +394,43 @@ class User:
 if __name__ == '__main__':
     """Main Program starts here."""
 
+    if "--profile-startup" in sys.argv:
+        from startup import StartupProfiler
+        StartupProfiler.report()
+        sys.exit(0)
+
+    # role modules import this file as "main", register it so it is not executed a second time
+    sys.modules.setdefault("main", sys.modules["__main__"])
+
+    # log calls only enqueue the record, the files are written by a background thread
+    from loghandler import LogPipeline
+    LogPipeline.configure()
+
     # Exception handling if database not present/cannot connect
     import sqlite3
     try:
         main_logger.debug("Connecting to database...")
-        from urllib.request import pathname2url
-        database = 'file:{}?mode=rw'.format(pathname2url("GPDB.db"))
+        from urllib.parse import quote
+        database = 'file:{}?mode=rw'.format(quote("GPDB.db"))
         conn = sqlite3.connect(database, uri=True)
         main_logger.debug("Connected to database")
+        from migrations import Migrations
+        Migrations.apply()
     except sqlite3.OperationalError:
         main_logger.debug("Nonexistent Database present")
         Parser.print_clean("Database does not exist.")
         Parser.user_quit()
 
-    while True:
-        Parser.print_clean("Welcome to Group 6 GP System")
-        option_selection = Parser.selection_parser(options={"R": "register", "L": "login", "H": "help",
-                                                            "--quit": "quit"})
-
-        if option_selection == 'L':
-            main_logger.debug("Selected Login")
-            current_user = MenuHelper.login()
-            MenuHelper.dispatcher(current_user["username"], current_user["user_type"])
-        elif option_selection == 'R':
-            main_logger.debug("New user registration started")
-            result = MenuHelper.register()
-            Parser.user_quit()
-        elif option_selection == "H":
-            MenuHelper.help()
+    if "--server" in sys.argv:
+        # one process serving many terminals over TCP, see server.py
+        from server import SessionServer
+        SessionServer.main(sys.argv[1:])
+        sys.exit(0)
+
+    try:
+        MenuHelper.welcome()
+    except sqlite3.DatabaseError as e:
+        # database errors the menus do not handle end the interactive client, e.g. a malformed database file
+        main_logger.critical(f"Database error: {e}")
+        print("Database error, the application has to quit.", e)
+        Parser.user_quit()
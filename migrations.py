@@ -0,0 +1,144 @@
+import logging
+from availability import AvailabilityTemplate
+from database import Database, SQLQuery
+from holds import SlotHold
+from notifications import NotificationOutbox
+from search import VisitSearchIndex
+from slotbitmap import SlotBitmap
+
+logger = logging.getLogger("main.Migrations")
+
+
+class Migrations:
+    """
+    Upgrades of existing databases, tracked with PRAGMA user_version. GPDB.sql creates databases at the
+    latest version, older ones are upgraded by apply(), one transaction per version. Every step can run
+    again on an upgraded database without changing it, so two processes starting together are harmless.
+    """
+
+    # a text timeslot 'YYYY-MM-DD HH:MM:SS' as minutes since the epoch, see database.TimeslotCodec
+    TIMESLOT_MINUTES = ("CASE typeof(Timeslot) WHEN 'integer' THEN Timeslot "
+                        "ELSE CAST(strftime('%s', Timeslot) AS INTEGER) / 60 END")
+
+    @staticmethod
+    def version() -> int:
+        """
+        :return: schema version of the database
+        """
+        return SQLQuery("PRAGMA user_version").fetch_all()[0][0]
+
+    @staticmethod
+    def integer_timeslots() -> str:
+        """
+        Version 1: Timeslot of available_time and Visit as INTEGER minutes instead of datetime text.
+        SQLite cannot change the type of a column, so both tables are rebuilt.
+        """
+        if SlotBitmap.enabled():
+            # the bitmaps keep their dates, only the view and its triggers change
+            script = "DROP VIEW available_time;" + SlotBitmap.CREATE_SCRIPT
+        else:
+            # copied and dropped rather than renamed: renaming would also rename the references of Visit
+            script = ("CREATE TEMP TABLE available_time_old AS SELECT StaffID, Timeslot FROM available_time;"
+                      "DROP TABLE available_time;" + SlotBitmap.TABLE_SCRIPT +
+                      "INSERT INTO available_time (StaffID, Timeslot) SELECT StaffID, {0} FROM temp.available_time_old;"
+                      "DROP TABLE temp.available_time_old;").format(Migrations.TIMESLOT_MINUTES)
+        return script + """
+            CREATE TABLE Visit_new (
+                BookingNo INTEGER,
+                NHSNo varchar(10) NOT NULL CHECK(NHSNo BETWEEN 1000000000 AND 9999999999),
+                StaffID varchar(10) NOT NULL,
+                Timeslot INTEGER NOT NULL,
+                PatientInfo BLOB,
+                Confirmed char(1) NOT NULL DEFAULT 'P' CHECK(Confirmed IN ('T', 'F', 'P')),
+                Attended char(1) CHECK(Attended IN ('T', 'F')),
+                Diagnosis BLOB,
+                Notes BLOB,
+                Rating int DEFAULT 0 CHECK(Rating >= 0 OR Rating <= 5),
+                PRIMARY KEY(BookingNo AUTOINCREMENT),
+                FOREIGN KEY(StaffID, Timeslot) REFERENCES available_time(StaffID, Timeslot)
+                    ON DELETE CASCADE ON UPDATE CASCADE,
+                FOREIGN KEY(NHSNo) REFERENCES Patient(NHSNo) ON DELETE CASCADE ON UPDATE CASCADE,
+                FOREIGN KEY(StaffID) REFERENCES GP(ID) ON DELETE CASCADE ON UPDATE CASCADE
+            );
+            INSERT INTO Visit_new (BookingNo, NHSNo, StaffID, Timeslot, PatientInfo, Confirmed, Attended,
+                                   Diagnosis, Notes, Rating)
+                SELECT BookingNo, NHSNo, StaffID, {0}, PatientInfo, Confirmed, Attended, Diagnosis, Notes, Rating
+                FROM Visit;
+            -- keep the AUTOINCREMENT counter, so numbers of deleted bookings are never given out again
+            DELETE FROM sqlite_sequence WHERE name = 'Visit_new';
+            UPDATE sqlite_sequence SET name = 'Visit_new' WHERE name = 'Visit';
+            DROP TABLE Visit;
+            ALTER TABLE Visit_new RENAME TO Visit;
+            CREATE INDEX IF NOT EXISTS visit_staff_timeslot ON Visit (StaffID, Timeslot);
+            """.format(Migrations.TIMESLOT_MINUTES)
+
+    @staticmethod
+    def slot_holds() -> str:
+        """
+        Version 2: slot_hold table of the short-lived reservations, see holds.SlotHold.
+        """
+        return SlotHold.TABLE_SCRIPT
+
+    @staticmethod
+    def notification_outbox() -> str:
+        """
+        Version 3: notification_outbox table of the messages for patients, see notifications.NotificationOutbox.
+        """
+        return NotificationOutbox.TABLE_SCRIPT
+
+    @staticmethod
+    def search_index() -> str:
+        """
+        Version 4: visit_search_index table, see search.VisitSearchIndex. Visits recorded before are indexed by
+        running search.py.
+        """
+        return VisitSearchIndex.TABLE_SCRIPT
+
+    @staticmethod
+    def availability_templates() -> str:
+        """
+        Version 5: availability_rule and availability_exception tables, see availability.AvailabilityTemplate.
+        """
+        return AvailabilityTemplate.TABLE_SCRIPT
+
+    # (version, name of the method returning the script upgrading the previous version to it)
+    STEPS = (
+        (1, "integer_timeslots"),
+        (2, "slot_holds"),
+        (3, "notification_outbox"),
+        (4, "search_index"),
+        (5, "availability_templates"),
+    )
+
+    @staticmethod
+    def apply() -> list:
+        """
+        Upgrade the database to the latest version.
+
+        :return: versions applied, empty if the database was up to date
+        """
+        applied = []
+        for version, step in Migrations.STEPS:
+            if Migrations.version() >= version:
+                continue
+            script = getattr(Migrations, step)()
+            connection = Database().connection()
+            try:
+                connection.executescript("BEGIN IMMEDIATE;" + script +
+                                         "PRAGMA user_version = {0}; COMMIT;".format(version))
+            except BaseException:
+                if connection.in_transaction:
+                    connection.rollback()
+                raise
+            logger.info(f"Database upgraded to version {version} ({step})")
+            applied.append(version)
+        return applied
+
+
+if __name__ == '__main__':
+    """
+    If the file is run, it upgrades GPDB.db to the latest version.
+    """
+    before = Migrations.version()
+    applied = Migrations.apply()
+    print(f"Database version {Migrations.version()}" + (f", upgraded from {before}." if applied else ", up to date."))
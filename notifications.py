@@ -0,0 +1,70 @@
+import time
+from database import SQLQuery
+from encryption import EncryptionHelper
+
+
+class NotificationOutbox:
+    """
+    Messages for patients whose bookings were changed by the practice, e.g. cancelled because their GP
+    is off sick. The rows are written in the same transaction as the change, so no patient is missed if
+    it commits and none is told about a change which was rolled back. They are shown to the patient at
+    their next login and marked as delivered then.
+    """
+
+    CANCELLED = "cancelled"
+    REASSIGNED = "reassigned"
+
+    TABLE_SCRIPT = """
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            NotificationID INTEGER PRIMARY KEY,
+            NHSNo varchar(10) NOT NULL,
+            BookingNo INTEGER NOT NULL,
+            StaffID varchar(10) NOT NULL,
+            Timeslot INTEGER NOT NULL,
+            Kind text NOT NULL CHECK(Kind IN ('cancelled', 'reassigned')),
+            NewStaffID varchar(10),
+            NewTimeslot INTEGER,
+            CreatedAt REAL NOT NULL,
+            DeliveredAt REAL
+        );
+        CREATE INDEX IF NOT EXISTS notification_outbox_patient ON notification_outbox (NHSNo, DeliveredAt);
+        """
+
+    # parameters (NHSNo, BookingNo, StaffID, Timeslot, Kind, NewStaffID, NewTimeslot, CreatedAt), for executemany
+    INSERT_QUERY = ("INSERT INTO notification_outbox (NHSNo, BookingNo, StaffID, Timeslot, Kind, NewStaffID, "
+                    "NewTimeslot, CreatedAt) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+
+    @staticmethod
+    def undelivered(nhs_no) -> list:
+        """
+        :param nhs_no: NHS number of the patient
+        :return: [NotificationID, Kind, BookingNo, Timeslot, GP first name, GP last name, NewTimeslot,
+                  new GP first name, new GP last name] rows, oldest first
+        """
+        return SQLQuery("SELECT n.NotificationID, n.Kind, n.BookingNo, n.Timeslot, gp.firstName, gp.lastName, "
+                        "n.NewTimeslot, new_gp.firstName, new_gp.lastName FROM notification_outbox n "
+                        "JOIN Users gp ON gp.ID = n.StaffID LEFT JOIN Users new_gp ON new_gp.ID = n.NewStaffID "
+                        "WHERE n.NHSNo = ? AND n.DeliveredAt IS NULL ORDER BY n.NotificationID"
+                        ).fetch_all(decrypter=EncryptionHelper(), parameters=(nhs_no,))
+
+    @staticmethod
+    def mark_delivered(notification_ids) -> None:
+        """
+        :param list notification_ids: NotificationID of the delivered notifications
+        """
+        if notification_ids:
+            SQLQuery("UPDATE notification_outbox SET DeliveredAt = ? WHERE NotificationID IN ({0})".format(
+                ", ".join("?" * len(notification_ids)))).commit((time.time(), *notification_ids))
+
+    @staticmethod
+    def message(row) -> str:
+        """
+        :param list row: row returned by undelivered
+        :return: text telling the patient what happened to their booking
+        """
+        _, kind, booking_no, timeslot, first_name, last_name, new_timeslot, new_first_name, new_last_name = row
+        if kind == NotificationOutbox.REASSIGNED:
+            return (f"Your appointment {booking_no} with Dr {first_name} {last_name} at {timeslot} has been moved "
+                    f"to Dr {new_first_name} {new_last_name} at {new_timeslot}.")
+        return (f"Your appointment {booking_no} with Dr {first_name} {last_name} at {timeslot} has been cancelled "
+                f"by the practice, please book another one.")
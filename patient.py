@@ -1,18 +1,30 @@
-from tabulate import tabulate
 from main import User
 from encryption import EncryptionHelper
 from iohandler import Parser, Paging
-from database import SQLQuery
+from tabulate import tabulate
+from database import SQLQuery, Timeslot
+from events import EventLog
+from booking import BookingService
+from slotindex import FreeSlotIndex
+from holds import SlotHold
+from notifications import NotificationOutbox
 import datetime
-from exceptions import DBRecordError
+from exceptions import DBRecordError, BookingError
 import logging
 
 logger = logging.getLogger("main.Patient")
 
 delta = datetime.timedelta
-date_now = datetime.datetime.now().date()
-dtime_now = datetime.datetime.now()
-strptime = datetime.datetime.strptime
+
+
+# evaluated on every use, a long running server must not keep the date it was started on
+def date_now() -> datetime.date:
+    return datetime.datetime.now().date()
+
+
+def dtime_now() -> Timeslot:
+    # compared with the Timeslot columns
+    return Timeslot.now()
 
 
 class Patient(User):
@@ -20,11 +32,14 @@ class Patient(User):
     patient Class with navigation options and various functionalities.
     """
 
+    __slots__ = ()
+
     def main_menu(self) -> None:
         """
         Main Menu for Patient-type users.
         """
         logger.info("logged in as Patient")
+        self.show_notifications()
         while True:
             print("You're currently viewing main menu options for Patient {}.".format(self.username))
             option_selection = Parser.selection_parser(
@@ -70,6 +85,20 @@ class Patient(User):
             elif option_selection == "U":
                 self.edit_information()
 
+    def show_notifications(self) -> None:
+        """
+        Method to show the changes the practice made to the patient's bookings since their last login.
+        """
+        notifications = NotificationOutbox.undelivered(self.ID)
+        if not notifications:
+            return
+        print("There are changes to your appointments:")
+        for row in notifications:
+            print(NotificationOutbox.message(row))
+        NotificationOutbox.mark_delivered([row[0] for row in notifications])
+        logger.info("Patient notified of changed appointments")
+        Parser.handle_input("Press Enter to continue...")
+
     def book_appointment_start(self):
         """
         Method to view appointments in next week and choose how they book for patients.
@@ -79,7 +108,7 @@ class Patient(User):
             print("You are viewing all available appointments for the next week. "
                   "You can not book appointment for today and can only book appointment within the next 15 days. "
                   "To view appointments up to 2 weeks ahead, use 'select by date' or 'select by GP' options below")
-            result_table = self.fetch_format_appointments(date_now + delta(days=1), 8)
+            result_table = self.fetch_format_appointments(date_now() + delta(days=1), 8)
             if not result_table:
                 return False
 
@@ -97,7 +126,7 @@ class Patient(User):
                 if self.process_booking(result_table[appointment_to_book-1]):
                     return True
             if booking_selection == "E":
-                if self.process_booking(result_table[0]):
+                if self.book_earliest():
                     return True
             if booking_selection == "D":
                 if self.book_appointment_date():
@@ -109,8 +138,15 @@ class Patient(User):
                 Parser.print_clean()
                 return False
 
-    @staticmethod
-    def fetch_format_appointments(selected_date, selected_delta=1, gp_id='%'):
+    def warm_up_loaders(self) -> list:
+        """
+        :return: the index of the free slots and the list of GPs with availability, both used by booking
+        """
+        # the index keeps its own state, the cache only records that it was loaded
+        return [(("slot_index", date_now()), FreeSlotIndex.ensure_loaded),
+                (("gp_list", date_now()), BookingService.load_available_gps)]
+
+    def fetch_format_appointments(self, selected_date, selected_delta=1, gp_id='%'):
         """
         Method to give a list of the GP's slots that can be booked by patient during selected time scope
 
@@ -119,11 +155,9 @@ class Patient(User):
         :param str gp_id:  give the id of GP, select all GP with default
         :return: list of available slots, or False if no available slots are present in search criteria
         """
-        result = SQLQuery("SELECT firstName, lastName, Timeslot, available_time.StaffID FROM "
-                          "(available_time JOIN Users ON available_time.StaffID = Users.ID) WHERE "
-                          "available_time.StaffID LIKE ? AND Timeslot >= ? AND Timeslot <= ? ORDER BY Timeslot"
-                          ).fetch_all(parameters=(gp_id, selected_date, selected_date + delta(days=selected_delta)),
-                                      decrypter=EncryptionHelper())
+        with EventLog.timed("availability", "search", "Patient", days=selected_delta) as details:
+            result = BookingService.search_availability(selected_date, selected_delta, gp_id, self.ID)
+            details["rows"] = len(result)
         if len(result) == 0:
             print("There are no available appointments matching the search criteria.")
             logger.info("There are no available appointments matching the search criteria.")
@@ -132,6 +166,41 @@ class Patient(User):
         result_table = Paging.give_pointer(result)
         return result_table
 
+    def book_earliest(self):
+        """
+        Method to book one of the earliest appointments across all GPs, optionally filtered by GP
+        !IMPORTANT Should only be called from within Patient.book_appointment_start
+        """
+        print("Which GPs would you like to search?")
+        gender = Parser.selection_parser(options={"A": "search all GPs", "M": "search male GPs",
+                                                  "F": "search female GPs", "N": "search non-binary GPs",
+                                                  "--back": "back"})
+        if gender == "--back":
+            return False
+        speciality = Parser.handle_input("Enter a speciality the GP should have (press Enter for any): ").strip()
+        min_rating = Parser.list_number_parser("Enter the minimum rating of the GP (0 for any).", (0, 5),
+                                               allow_multiple=False)
+        if min_rating == "--back":
+            return False
+        with EventLog.timed("availability", "earliest", "Patient") as details:
+            result = BookingService.find_earliest(10, None if gender == "A" else gender, speciality or None,
+                                                  min_rating or None, self.ID)
+            details["rows"] = len(result)
+        if not result:
+            print("There are no available appointments matching the search criteria.")
+            logger.info("There are no available appointments matching the search criteria.")
+            Parser.handle_input("Press Enter to continue...")
+            return False
+        result_table = Paging.give_pointer(result)
+        print("You are viewing the earliest available appointments:")
+        headers_holder = ["Pointer", "GP Name", "Last Name", "Timeslot"]
+        Paging.show_page(1, result_table, 5, 4, headers_holder)
+        selected_appointment = Parser.list_number_parser("Select an appointment by the Pointer.",
+                                                         (1, len(result_table)), allow_multiple=False)
+        if selected_appointment == '--back':
+            return False
+        return self.process_booking(result_table[selected_appointment - 1])
+
     def book_appointment_date(self):
         """
         Method to select a timeslot to book appointments
@@ -165,12 +234,7 @@ class Patient(User):
         !IMPORTANT Should only be called from within Patient.book_appointment_start
         """
         while True:
-            gp_result = SQLQuery("SELECT users.firstName, users.lastName, GP.Introduction, GP.ClinicAddress, "
-                                 "GP.ClinicPostcode, GP.Gender, GP.Rating, users.ID FROM (GP INNER JOIN users ON "
-                                 "GP.ID = users.ID) WHERE users.ID IN ( SELECT DISTINCT StaffID FROM available_time "
-                                 "WHERE Timeslot >= ? AND Timeslot <= ? )"
-                                 ).fetch_all(parameters=(date_now + delta(days=1), date_now + delta(days=15)),
-                                             decrypter=EncryptionHelper())
+            gp_result = BookingService.available_gps()
 
             gp_table = Paging.give_pointer(gp_result)
             if len(gp_table) == 0:
@@ -179,7 +243,7 @@ class Patient(User):
                 Parser.handle_input("Press Enter to continue...")
                 return False
 
-            print(f"You are viewing all available GPs in 2 weeks from: {date_now} ")
+            print(f"You are viewing all available GPs in 2 weeks from: {date_now()} ")
             if not gp_table:
                 return False
 
@@ -194,7 +258,7 @@ class Patient(User):
             if selected_gp_pointer == '--back':
                 return False
             selected_gp = gp_table[selected_gp_pointer - 1][8]
-            result_table = self.fetch_format_appointments(date_now + delta(days=1), 15, selected_gp)
+            result_table = self.fetch_format_appointments(date_now() + delta(days=1), 15, selected_gp)
             if not result_table:
                 continue
             print(f"You are viewing appointments for the selected GP:")
@@ -218,45 +282,39 @@ class Patient(User):
 
         :param list selected_row: a list of details of selected time slot
         """
-        encrypt = EncryptionHelper().encrypt_to_bits
+        # other patients cannot select or book the slot while it is being confirmed
+        if not SlotHold.hold(self.ID, selected_row[4], selected_row[3]):
+            print("This timeslot has just been selected by another patient, please choose another one.")
+            logger.info("Selected timeslot is held by another patient")
+            Parser.handle_input("Press Enter to continue...")
+            return False
         while True:
             Parser.print_clean("This is time slot will be booked by you:")
             print("GP: {} {}".format(selected_row[1], selected_row[2]))
-            print("Timeslot: {}\n".format(selected_row[3]))
+            print("Timeslot: {}".format(selected_row[3]))
+            print(f"The timeslot is held for you for {SlotHold.HOLD_SECONDS // 60} minutes.\n")
             confirm = Parser.selection_parser(options={"Y": "Confirm", "N": "Go back and select again"})
             # Confirm if user wants to delete slots
             if confirm == "Y":
+                patient_info = Parser.string_parser("Please state your illness to GP before the visit: ")
                 try:
-                    SQLQuery("BEGIN TRANSACTION; INSERT INTO Visit (NHSNo, StaffID, Timeslot, Confirmed, Attended) "
-                             f"VALUES ({self.ID}, '{selected_row[4]}', '{selected_row[3]}', 'P', 'F'); "
-                             f"DELETE FROM available_time WHERE StaffID = '{selected_row[4]}'"
-                             f" AND TIMESLOT = '{selected_row[3]}'; COMMIT"
-                             ).commit(multiple_queries=True)
-                    print("Booked successfully.")
-                    logger.info("Appointment is booked Successfully")
-                    visit_result = SQLQuery("SELECT BookingNo, NHSNo, firstName, lastName, Timeslot FROM "
-                                            "(Visit JOIN Users ON VISIT.StaffID = Users.ID)"
-                                            "WHERE Timeslot = ? AND StaffID = ? "
-                                            ).fetch_all(parameters=(selected_row[3], selected_row[4]),
-                                                        decrypter=EncryptionHelper())
-                    booking_no = visit_result[0][0]
-                    logger.info("View your appointments")
-                    headers_holder = ["BookingNo", "NHSNo", "GP First Name", "Last Name", "Timeslot"]
-                    Paging.better_form(visit_result, headers_holder)
-                    Parser.handle_input("Press Enter to continue...")
-                except DBRecordError:
-                    print("Error encountered")
-                    logger.warning("Error in DB")
+                    with EventLog.timed("booking", "create", self.user_type, rows=2):
+                        booking_no = BookingService.book(self.ID, selected_row[4], selected_row[3], patient_info)
+                except BookingError as e:
+                    SlotHold.release(self.ID)
+                    print("Error encountered:", e)
+                    logger.warning(f"Booking failed: {e}")
                     Parser.handle_input("Press Enter to continue...")
                     return False
-                info_input = encrypt(Parser.string_parser("Please state your illness to GP before the visit: "))
-                SQLQuery("UPDATE Visit SET PatientInfo = ? WHERE BookingNo = ? "
-                         ).commit((info_input, booking_no))
-                print("Your information have been recorded successfully!")
+                print("Booked successfully.")
+                logger.info("Appointment is booked Successfully")
+                headers_holder = ["BookingNo", "NHSNo", "GP First Name", "Last Name", "Timeslot"]
+                Paging.better_form([[booking_no, self.ID, *selected_row[1:4]]], headers_holder)
                 Parser.handle_input("Press Enter to continue...")
                 Parser.print_clean()
                 return True
             else:
+                SlotHold.release(self.ID)
                 print("Booking cancelled.")
                 Parser.handle_input("Press Enter to continue...")
                 Parser.print_clean()
@@ -273,7 +331,7 @@ class Patient(User):
             appointments = SQLQuery("SELECT bookingNo, NHSNo, firstName, lastName, Timeslot, Confirmed, StaffID FR"
                                     "OM (visit JOIN Users ON visit.StaffID = Users.ID) WHERE NHSNo = ? AND Attended"
                                     " = ? AND Timeslot >= ? "
-                                    ).fetch_all(parameters=(self.ID, "F", dtime_now - delta(hours=1)),
+                                    ).fetch_all(parameters=(self.ID, "F", dtime_now() - delta(hours=1)),
                                                 decrypter=EncryptionHelper())
 
             confirmed_appointments = list(appt[0:5] for appt in appointments if appt[5] == "T")
@@ -315,8 +373,8 @@ class Patient(User):
 
         while stage == 1:
             Parser.print_clean("You can only check in within an hour of a scheduled confirmed appointment.")
-            check_appt = [appt[0:5] for appt in appointments if dtime_now - delta(hours=1) <=
-                          strptime(appt[4], '%Y-%m-%d %H:%M:%S') <= dtime_now + delta(hours=1)]
+            check_appt = [appt[0:5] for appt in appointments if dtime_now() - delta(hours=1) <=
+                          appt[4] <= dtime_now() + delta(hours=1)]
             if not check_appt:
                 Parser.handle_input("Press Enter to continue...")
                 stage = 0
@@ -338,14 +396,14 @@ class Patient(User):
                 confirm = Parser.selection_parser(options={"Y": "check-in", "N": "cancel check-in"})
                 if confirm == "Y":
                     try:
-                        SQLQuery("UPDATE Visit SET Attended = 'T' WHERE BookingNo = ? "
-                                 ).commit((appointment_check_in[0],))
+                        with EventLog.timed("booking", "check_in", self.user_type, rows=1):
+                            BookingService.check_in(self.ID, appointment_check_in[0])
                         print("You have been checked in successfully!.")
                         logger.info("Patient check in successfully")
                         Parser.handle_input("Press Enter to continue...")
                         return True
-                    except DBRecordError:
-                        print("Error encountered")
+                    except (DBRecordError, BookingError) as e:
+                        print("Error encountered", e)
                         logger.warning("Error in DB")
                         Parser.handle_input("Press Enter to continue...")
                 else:
@@ -363,7 +421,7 @@ class Patient(User):
         while stage == 0:
             valid_cancel = SQLQuery("SELECT BookingNo, NHSNo, lastName, Timeslot, PatientInfo, StaffID FROM (visit "
                                     "JOIN Users on visit.StaffID = Users.ID) WHERE NHSNo = ? AND Timeslot >= ?"
-                                    ).fetch_all(parameters=(self.ID, dtime_now + delta(days=5)),
+                                    ).fetch_all(parameters=(self.ID, dtime_now() + delta(days=5)),
                                                 decrypter=EncryptionHelper())
             appointments_table = Paging.give_pointer(valid_cancel)
             Parser.print_clean("You are viewing all the appointments can be cancelled.\n"
@@ -390,17 +448,15 @@ class Patient(User):
 
             if confirmation == "Y":
                 try:
-                    SQLQuery(f"BEGIN TRANSACTION; DELETE FROM visit WHERE BookingNo = {selected_row[1]}; "
-                             f"INSERT INTO available_time (StaffID,Timeslot) "
-                             f"VALUES ({selected_row[6]},{selected_row[4]}; "
-                             f"COMMIT "
-                             ).commit(multiple_queries=True)
-
+                    with EventLog.timed("booking", "cancel", self.user_type, rows=2):
+                        BookingService.cancel(self.ID, selected_row[1])
                     print("Appointment is cancelled successfully.")
                     logger.info("Appointments cancelled successfully")
-                except Exception as e:
-                    print("Database Error...", e)
-                    logger.warning("Error in DB")
+                    Parser.handle_input("Press Enter to continue...")
+                    return True
+                except (DBRecordError, BookingError) as e:
+                    print("Error encountered:", e)
+                    logger.warning(f"Cancel failed: {e}")
             else:
                 print("Cancel failed")
                 Parser.handle_input("Press Enter to continue...")
@@ -415,7 +471,7 @@ class Patient(User):
             appointments = SQLQuery(" SELECT V.bookingNo, V.Timeslot, U.firstName, V.PatientInfo, V.Attended "
                                     " FROM (visit as V JOIN Users as U ON V.StaffID = U.ID) WHERE V.NHSNo = ? "
                                     " AND V.Confirmed = 'T' AND V.Timeslot <= ?  "
-                                    ).fetch_all(decrypter=EncryptionHelper(), parameters=(self.ID, dtime_now))
+                                    ).fetch_all(decrypter=EncryptionHelper(), parameters=(self.ID, dtime_now()))
 
             attended_appointments = list(appt[0:4] for appt in appointments if appt[4] == "T")
             unattended_appointments = list(appt[0:4] for appt in appointments if appt[4] == "F")
@@ -584,7 +640,7 @@ class Patient(User):
                 Parser.print_clean()
                 return True
             else:
-                print(tabulate(visit_data, headers=headers_holder, tablefmt="fancy_grid", numalign="left"))
+                Paging.better_form(visit_data, headers_holder)
 
                 if len(list(prescription_data)) == 0:
                     Parser.print_clean("No Prescriptions Available.")
@@ -605,9 +661,10 @@ class Patient(User):
         print("You need to input additional information before you can proceed.")
         Parser.handle_input("Press Enter to continue...")
         encrypt = EncryptionHelper().encrypt_to_bits
+        encrypt_compressed = EncryptionHelper().encrypt_compressed
         Parser.print_clean("Enter your gender: ")
         gender = Parser.selection_parser(options={"M": "Male", "F": "Female", "N": "Do not disclose"})
-        info = encrypt(Parser.string_parser("Enter an intro paragraph about yourself: "))
+        info = encrypt_compressed(Parser.string_parser("Enter an intro paragraph about yourself: "))
         notice = encrypt(Parser.string_parser("Enter any allergies or important medical history: "))
         try:
             SQLQuery("INSERT INTO Patient(NHSNo, Gender, Introduction, Notice) VALUES (?, "
@@ -0,0 +1,211 @@
+import bisect
+import datetime
+import heapq
+import logging
+import sqlite3
+import time
+from booking import BookingService
+from database import Database, TimeslotCodec
+from exceptions import BookingError
+from notifications import NotificationOutbox
+from slotbitmap import SlotBitmap
+
+logger = logging.getLogger("main.Reassignment")
+
+
+class ReassignmentEngine:
+    """
+    Moves the bookings of a GP who is unavailable to the nearest free slots of other GPs.
+
+    Matching is greedy: every booking starts at its nearest eligible slot, and a priority queue
+    ordered by the shift from the original time always assigns the smallest shift first. A booking
+    whose candidate was taken meanwhile is pushed back with its next nearest candidate. Confirmed
+    bookings win ties. The plan is made and applied inside one IMMEDIATE transaction, from the slots
+    read under that lock.
+    """
+
+    # bookings are moved by at most this many days, earlier or later
+    MAX_SHIFT_DAYS = 7
+
+    DISPLACED_QUERY = ("SELECT BookingNo, NHSNo, Timeslot, Confirmed FROM Visit WHERE StaffID = ? AND Timeslot >= ? "
+                       "AND Timeslot < ? AND Confirmed != 'F' ORDER BY Timeslot")
+    FREE_QUERY = ("SELECT Timeslot, StaffID FROM available_time WHERE StaffID != ? AND Timeslot >= ? "
+                  "AND Timeslot < ? ORDER BY Timeslot, StaffID")
+    HELD_QUERY = "SELECT Timeslot, StaffID FROM slot_hold WHERE ExpiresAt > ?"
+    BUSY_QUERY = "SELECT NHSNo, Timeslot FROM Visit WHERE Timeslot >= ? AND Timeslot < ? AND Confirmed != 'F'"
+    MOVE_QUERY = "UPDATE Visit SET StaffID = ?, Timeslot = ?, Confirmed = 'P' WHERE BookingNo = ?"
+
+    @staticmethod
+    def eligible_gps(staff_id, attributes, same_gender=True, same_speciality=False) -> set:
+        """
+        :param str staff_id: ID of the GP whose bookings are moved
+        :param dict attributes: StaffID -> (Gender, Speciality, Rating), see BookingService.load_gp_attributes
+        :param bool same_gender: only GPs of the same gender
+        :param bool same_speciality: only GPs of the same speciality, if the GP has one
+        :return: IDs of the GPs the bookings can be moved to
+        """
+        gender, speciality, _ = attributes.get(staff_id, (None, "", 0))
+        return {other for other, (other_gender, other_speciality, _) in attributes.items()
+                if other != staff_id and (not same_gender or other_gender == gender)
+                and (not same_speciality or not speciality or other_speciality.casefold() == speciality.casefold())}
+
+    @staticmethod
+    def nearest(slots, timeslot, first, last):
+        """
+        :param list slots: sorted (Timeslot, StaffID) pairs, Timeslot in minutes
+        :param int timeslot: original time of the booking
+        :param int first: earliest time allowed
+        :param int last: latest time allowed
+        :return: generator of the slots between first and last, nearest to timeslot first
+        """
+        after = bisect.bisect_left(slots, (timeslot,))
+        before = after - 1
+        while True:
+            forward = slots[after] if after < len(slots) and slots[after][0] <= last else None
+            backward = slots[before] if before >= 0 and slots[before][0] >= first else None
+            if forward is None and backward is None:
+                return
+            if backward is None or (forward is not None and forward[0] - timeslot <= timeslot - backward[0]):
+                after += 1
+                yield forward
+            else:
+                before -= 1
+                yield backward
+
+    @staticmethod
+    def plan(displaced, slots, busy, earliest, max_shift) -> tuple:
+        """
+        :param list displaced: (BookingNo, NHSNo, Timeslot, Confirmed) of the bookings to move
+        :param list slots: sorted (Timeslot, StaffID) of the free slots they can be moved to
+        :param set busy: (NHSNo, Timeslot) of the existing bookings, including the displaced ones, a patient is
+                         not booked twice at a time. A displaced booking only frees its time once it is assigned.
+        :param int earliest: no booking is moved before this time
+        :param int max_shift: maximum shift of a booking in minutes
+        :return: ({BookingNo: (StaffID, Timeslot)} of the moved bookings, BookingNo of the unassigned ones)
+        """
+        candidates, queue, taken = {}, [], set()
+
+        def free(nhs_no, timeslot, slot):
+            # a patient's other bookings rule out their times, the booking's own time is free for itself
+            return slot not in taken and (slot[0] == timeslot or (nhs_no, slot[0]) not in busy)
+
+        def push(booking_no, nhs_no, timeslot, rank):
+            # the first candidate still free
+            for slot in candidates[booking_no]:
+                if free(nhs_no, timeslot, slot):
+                    heapq.heappush(queue, (abs(slot[0] - timeslot), rank, timeslot, booking_no, nhs_no, slot))
+                    return
+
+        for booking_no, nhs_no, timeslot, confirmed in displaced:
+            candidates[booking_no] = ReassignmentEngine.nearest(slots, timeslot, max(timeslot - max_shift, earliest),
+                                                                timeslot + max_shift)
+            push(booking_no, nhs_no, timeslot, 0 if confirmed == 'T' else 1)
+        assignments = {}
+        while queue:
+            _, rank, timeslot, booking_no, nhs_no, slot = heapq.heappop(queue)
+            if not free(nhs_no, timeslot, slot):
+                push(booking_no, nhs_no, timeslot, rank)
+                continue
+            taken.add(slot)
+            busy.discard((nhs_no, timeslot))
+            busy.add((nhs_no, slot[0]))
+            assignments[booking_no] = (slot[1], slot[0])
+        unassigned = [booking_no for booking_no, _, _, _ in displaced if booking_no not in assignments]
+        return assignments, unassigned
+
+    @staticmethod
+    def reassign(staff_id, start_date, end_date, same_gender=True, same_speciality=False, max_shift_days=None,
+                 restore_slots=False, cancel_rest=False) -> dict:
+        """
+        Move the upcoming bookings of the GP over a date range to the nearest free slots of other GPs, in one
+        transaction, and add a notification for every patient moved to the NotificationOutbox. Bookings which
+        cannot be moved are left as they are, or cancelled in the same transaction with cancel_rest.
+
+        :param str staff_id: ID of the GP
+        :param date start_date: first date, bookings which already started are left alone
+        :param date end_date: last date, inclusive
+        :param bool same_gender: only move bookings to GPs of the same gender
+        :param bool same_speciality: only move bookings to GPs of the same speciality, if the GP has one
+        :param int max_shift_days: maximum shift of a booking, MAX_SHIFT_DAYS by default
+        :param bool restore_slots: make the original slots of the moved bookings available again
+        :param bool cancel_rest: cancel the bookings which cannot be moved, see BookingService.cancel_range; the
+                                 free slots of the GP in the range are removed unless restore_slots is set
+        :return: {"reassigned": bookings moved, "unassigned": BookingNo of the bookings left,
+                  "restored": slots made available again}, with cancel_rest also the "cancelled", "notified" and
+                 "dropped" counts of BookingService.cancel_range
+        :raises BookingError: if the changes could not be saved, nothing is changed then
+        """
+        connection = Database().connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            report, changes = ReassignmentEngine.reassign_in(connection, staff_id, start_date, end_date, same_gender,
+                                                             same_speciality, max_shift_days, restore_slots)
+            if cancel_rest:
+                cancel_report, cancel_changes = BookingService.cancel_range_in(connection, staff_id, start_date,
+                                                                               end_date, drop_slots=not restore_slots)
+            connection.commit()
+        except sqlite3.Error as e:
+            if connection.in_transaction:
+                connection.rollback()
+            logger.error(f"Bookings of {staff_id} could not be reassigned: {e}")
+            raise BookingError("The bookings could not be reassigned.")
+        except BaseException:
+            if connection.in_transaction:
+                connection.rollback()
+            raise
+        BookingService.schedule_changed(changes)
+        logger.info(f"{report['reassigned']} bookings of {staff_id} reassigned, {len(report['unassigned'])} left")
+        if cancel_rest:
+            BookingService.schedule_changed(cancel_changes)
+            logger.info(f"{cancel_report['cancelled']} bookings of {staff_id} cancelled")
+            report = {"reassigned": report["reassigned"], "unassigned": [], "cancelled": cancel_report["cancelled"],
+                      "notified": report["reassigned"] + cancel_report["notified"],
+                      "restored": report["restored"] + cancel_report["restored"], "dropped": cancel_report["dropped"]}
+        return report
+
+    @staticmethod
+    def reassign_in(connection, staff_id, start_date, end_date, same_gender=True, same_speciality=False,
+                    max_shift_days=None, restore_slots=False) -> tuple:
+        """
+        Make the changes of reassign in the transaction open on the connection, the plan is made from the slots
+        read under its lock. The caller commits it and then passes the slot changes to
+        BookingService.schedule_changed.
+
+        :param sqlite3.Connection connection: connection of the current thread, in a BEGIN IMMEDIATE transaction
+        :return: (report as returned by reassign, slot changes as taken by FreeSlotIndex.apply)
+        """
+        max_shift = (ReassignmentEngine.MAX_SHIFT_DAYS if max_shift_days is None else max_shift_days) * 24 * 60
+        now = TimeslotCodec.encode(datetime.datetime.now())
+        start = max(TimeslotCodec.encode(TimeslotCodec.start_of(start_date)), now)
+        end = TimeslotCodec.encode(TimeslotCodec.start_of(end_date + datetime.timedelta(days=1)))
+        gps = ReassignmentEngine.eligible_gps(staff_id, BookingService.load_gp_attributes(), same_gender,
+                                              same_speciality)
+        displaced = connection.execute(ReassignmentEngine.DISPLACED_QUERY, (staff_id, start, end)).fetchall()
+        window = (max(start - max_shift, now), end + max_shift)
+        held = set(connection.execute(ReassignmentEngine.HELD_QUERY, (time.time(),)))
+        slots = [slot for slot in connection.execute(ReassignmentEngine.FREE_QUERY, (staff_id, *window))
+                 if slot[1] in gps and slot not in held]
+        busy = set(connection.execute(ReassignmentEngine.BUSY_QUERY, window))
+        assignments, unassigned = ReassignmentEngine.plan(displaced, slots, busy, now, max_shift)
+        moved = [(booking_no, nhs_no, timeslot, *assignments[booking_no])
+                 for booking_no, nhs_no, timeslot, _ in displaced if booking_no in assignments]
+        connection.executemany(ReassignmentEngine.MOVE_QUERY, [(new_staff_id, new_timeslot, booking_no)
+                                                               for booking_no, _, _, new_staff_id, new_timeslot
+                                                               in moved])
+        connection.executemany(SlotBitmap.take_slot_query(), [(new_staff_id, new_timeslot)
+                                                              for _, _, _, new_staff_id, new_timeslot in moved])
+        created = time.time()
+        connection.executemany(NotificationOutbox.INSERT_QUERY,
+                               [(nhs_no, booking_no, staff_id, timeslot, NotificationOutbox.REASSIGNED,
+                                 new_staff_id, new_timeslot, created)
+                                for booking_no, nhs_no, timeslot, new_staff_id, new_timeslot in moved])
+        changes = {"added": {}, "removed": {}}
+        for _, _, _, new_staff_id, new_timeslot in moved:
+            new_timeslot = TimeslotCodec.decode(new_timeslot)
+            changes["removed"].setdefault(new_staff_id, []).append((new_timeslot, new_timeslot))
+        if restore_slots:
+            connection.executemany(BookingService.RESTORE_SLOT_QUERY,
+                                   [(staff_id, timeslot) for _, _, timeslot, _, _ in moved])
+            changes["added"][staff_id] = [TimeslotCodec.decode(timeslot) for _, _, timeslot, _, _ in moved]
+        return ({"reassigned": len(moved), "unassigned": unassigned, "restored": len(moved) if restore_slots else 0},
+                changes)
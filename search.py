@@ -0,0 +1,127 @@
+import hashlib
+import hmac
+import re
+import unicodedata
+from database import SQLQuery, SQLTransaction
+from encryption import EncryptionHelper
+
+
+class VisitSearchIndex:
+    """
+    Encrypted inverted index over the free-text fields of a visit (diagnosis and notes).
+    Every normalised term is stored as a keyed HMAC token, so the index can be searched with
+    an exact-match lookup without decrypting any visits and without storing any readable words.
+    """
+
+    DIAGNOSIS = "D"
+    NOTES = "N"
+    FIELDS = (DIAGNOSIS, NOTES)
+
+    # terms which would match nearly every visit and only inflate the index
+    STOP_WORDS = frozenset(("a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "he", "her",
+                            "his", "in", "is", "it", "no", "not", "of", "on", "or", "she", "the", "to", "was",
+                            "were", "with"))
+    TOKEN_BYTES = 16
+
+    # created by Migrations.search_index on databases which predate it
+    TABLE_SCRIPT = """
+        CREATE TABLE IF NOT EXISTS visit_search_index (
+            Token BLOB NOT NULL,
+            Field char(1) NOT NULL CHECK(Field IN ('D', 'N')),
+            BookingNo INTEGER NOT NULL,
+            PRIMARY KEY(Token, Field, BookingNo)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS visit_search_index_booking ON visit_search_index (BookingNo, Field);
+        """
+
+    # statement removing a deleted visit from the index, run in the transaction deleting the visit
+    REMOVE_QUERY = "DELETE FROM visit_search_index WHERE BookingNo = ?"
+
+    _key = None
+
+    @staticmethod
+    def tokenize(text="") -> set:
+        """
+        :param str text: free text to split into terms
+        :return: set of normalised terms (lower case, accents removed, stop words dropped)
+        """
+        text = unicodedata.normalize("NFKD", text or "").encode("ascii", "ignore").decode().lower()
+        return {term for term in re.findall(r"[a-z0-9]+", text)
+                if len(term) > 1 and term not in VisitSearchIndex.STOP_WORDS}
+
+    @staticmethod
+    def token(term) -> bytes:
+        """
+        :param str term: normalised term
+        :return: keyed HMAC token stored in the index in place of the term
+        """
+        if VisitSearchIndex._key is None:
+            # the index key is derived from the database key, so it never has to be stored separately
+            VisitSearchIndex._key = hmac.new(EncryptionHelper().key, b"visit-search-index",
+                                             hashlib.sha256).digest()
+        return hmac.new(VisitSearchIndex._key, term.encode(), hashlib.sha256).digest()[:VisitSearchIndex.TOKEN_BYTES]
+
+    @staticmethod
+    def add_to_transaction(transaction, booking_no, field, text) -> SQLTransaction:
+        """
+        Add the statements re-indexing a field of a visit to an existing transaction,
+        so the index is committed together with the update of the visit itself.
+
+        :param SQLTransaction transaction: transaction the statements are added to
+        :param int booking_no: BookingNo of the visit
+        :param str field: VisitSearchIndex.DIAGNOSIS or VisitSearchIndex.NOTES
+        :param str text: new plain text of the field
+        """
+        tokens = [(VisitSearchIndex.token(term), field, booking_no) for term in VisitSearchIndex.tokenize(text)]
+        transaction.add("DELETE FROM visit_search_index WHERE BookingNo = ? AND Field = ?", (booking_no, field))
+        transaction.add("INSERT OR IGNORE INTO visit_search_index (Token, Field, BookingNo) VALUES (?, ?, ?)",
+                        tokens, many=True)
+        return transaction
+
+    @staticmethod
+    def search(text, fields=FIELDS, staff_id=None) -> list:
+        """
+        Find visits containing all terms of the search text.
+        Each term is a primary key seek in the index, so the cost depends on the number of matches,
+        not on the number of visits.
+
+        :param str text: search terms, e.g. "asthma inhaler"
+        :param tuple fields: fields to search in, any of VisitSearchIndex.FIELDS
+        :param str staff_id: if given, only visits with this GP are returned
+        :return: list of matching BookingNos, most recent first
+        """
+        terms = VisitSearchIndex.tokenize(text)
+        if not terms or not fields:
+            return []
+        tokens = [VisitSearchIndex.token(term) for term in terms]
+        # joined with Visit, so rows left behind by a deleted visit are never returned
+        query = "SELECT i.BookingNo FROM visit_search_index i JOIN Visit v ON v.BookingNo = i.BookingNo " \
+                "WHERE i.Token IN ({0}) AND i.Field IN ({1}) ".format(", ".join("?" * len(tokens)),
+                                                                      ", ".join("?" * len(fields)))
+        parameters = (*tokens, *fields)
+        if staff_id is not None:
+            query += "AND v.StaffID = ? "
+            parameters += (staff_id,)
+        query += "GROUP BY i.BookingNo HAVING COUNT(DISTINCT i.Token) = ? ORDER BY i.BookingNo DESC"
+        return [row[0] for row in SQLQuery(query).fetch_all(parameters=parameters + (len(tokens),))]
+
+    @staticmethod
+    def rebuild() -> int:
+        """
+        Rebuild the whole index from the Visit table, e.g. for visits recorded before the index existed.
+        :return: number of visits indexed
+        """
+        visits = SQLQuery("SELECT BookingNo, Diagnosis, Notes FROM Visit").fetch_all(decrypter=EncryptionHelper())
+        transaction = SQLTransaction().add("DELETE FROM visit_search_index")
+        for booking_no, diagnosis, notes in visits:
+            VisitSearchIndex.add_to_transaction(transaction, booking_no, VisitSearchIndex.DIAGNOSIS, diagnosis)
+            VisitSearchIndex.add_to_transaction(transaction, booking_no, VisitSearchIndex.NOTES, notes)
+        transaction.commit()
+        return len(visits)
+
+
+if __name__ == '__main__':
+    """
+    If the file is run, it will rebuild the search index from all existing visits.
+    """
+    print("Indexed {0} visits.".format(VisitSearchIndex.rebuild()))
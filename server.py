@@ -0,0 +1,210 @@
+import argparse
+import asyncio
+import concurrent.futures
+import logging
+import re
+import threading
+from terminal import Terminal, AnsiTerminal, ThreadRoutedStream
+
+logger = logging.getLogger("main.Server")
+
+
+class SessionClosed(EOFError):
+    """
+    Raised in a session when its client disconnected or was idle for too long.
+    """
+    pass
+
+
+class SocketStream:
+    """
+    Text stream of a session, collecting what is written until flush() sends it to the client in one write.
+    """
+
+    def __init__(self, writer, loop):
+        """
+        :param asyncio.StreamWriter writer: writer of the connection
+        :param loop: event loop owning the connection
+        """
+        self._writer = writer
+        self._loop = loop
+        self._buffer = []
+
+    def write(self, text) -> int:
+        self._buffer.append(text)
+        return len(text)
+
+    def flush(self) -> None:
+        if self._buffer:
+            # telnet clients expect CRLF line endings
+            self.send_bytes("".join(self._buffer).replace("\n", "\r\n").encode("utf-8"))
+            self._buffer = []
+
+    def send_bytes(self, data) -> None:
+        """
+        :param bytes data: data sent as it is, from any thread
+        """
+        try:
+            self._loop.call_soon_threadsafe(self._writer.write, data)
+        except RuntimeError:
+            # the event loop was closed, the server is stopping
+            pass
+
+
+class SocketTerminal(Terminal):
+    """
+    Terminal backend of a server session, reading the lines sent by a telnet-style client.
+    The session runs in a worker thread and waits for the event loop to deliver each line.
+    """
+
+    # telnet negotiation sent by the client, removed from the lines read
+    TELNET_COMMAND = re.compile(rb"\xff[\xfb-\xfe].|\xff[\xf0-\xfa]", re.DOTALL)
+    # IAC WILL ECHO: the server takes over echoing, so the client stops showing what is typed
+    ECHO_OFF = b"\xff\xfb\x01"
+    # IAC WONT ECHO: the client shows what is typed again
+    ECHO_ON = b"\xff\xfc\x01"
+
+    def __init__(self, reader, writer, loop, idle_timeout=None):
+        """
+        :param asyncio.StreamReader reader: reader of the connection
+        :param asyncio.StreamWriter writer: writer of the connection
+        :param loop: event loop owning the connection
+        :param float idle_timeout: seconds to wait for a line before closing the session, None waits forever
+        """
+        super().__init__(SocketStream(writer, loop))
+        self._reader = reader
+        self._loop = loop
+        self.idle_timeout = idle_timeout
+
+    def clear(self) -> None:
+        self.stream.write(AnsiTerminal.CLEAR_SEQUENCE)
+
+    def read_line(self, prompt="") -> str:
+        self.stream.write(prompt)
+        self.flush()
+        future = asyncio.run_coroutine_threadsafe(self._reader.readline(), self._loop)
+        try:
+            data = future.result(self.idle_timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise SessionClosed("idle timeout")
+        except concurrent.futures.CancelledError:
+            # pending reads are cancelled when the server stops
+            raise SessionClosed("server stopped")
+        if not data:
+            raise SessionClosed("client disconnected")
+        return SocketTerminal.TELNET_COMMAND.sub(b"", data).decode("utf-8", "replace").rstrip("\r\n")
+
+    def read_secret(self, prompt="") -> str:
+        self.flush()
+        self.stream.send_bytes(SocketTerminal.ECHO_OFF)
+        try:
+            return self.read_line(prompt)
+        finally:
+            self.stream.send_bytes(SocketTerminal.ECHO_ON)
+            self.stream.write("\n")
+
+
+class SessionServer:
+    """
+    Serves the GP system to many terminals from one process. Connections are handled by an asyncio
+    event loop; every session runs the usual menus (MenuHelper.welcome) in a thread of a shared pool,
+    so database and encryption work never blocks the loop, and all sessions share the loaded modules,
+    keys and caches (cache.cache, ProfileStore).
+    """
+
+    def __init__(self, host="127.0.0.1", port=2323, max_sessions=32, idle_timeout=900):
+        """
+        :param str host: address to listen on, the default only accepts local connections
+        :param int port: port to listen on
+        :param int max_sessions: maximum number of concurrent sessions, each one uses a thread of the pool
+        :param float idle_timeout: seconds without input after which a session is closed
+        """
+        self.host = host
+        self.port = port
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_sessions, thread_name_prefix="session")
+        self._active = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def run_session(terminal) -> None:
+        """
+        Run the menus of one session in the current worker thread.
+
+        :param SocketTerminal terminal: terminal of the session
+        """
+        Terminal.use_in_thread(terminal)
+        try:
+            from main import MenuHelper
+            MenuHelper.welcome()
+        except SystemExit:
+            # quitting or logging out ends the session only, not the server
+            pass
+        except SessionClosed as e:
+            logger.info(f"Session closed: {e}")
+        except Exception:
+            logger.exception("Session ended by an unexpected error")
+        finally:
+            terminal.flush()
+            Terminal.use_in_thread(None)
+
+    async def handle_connection(self, reader, writer) -> None:
+        peer = writer.get_extra_info("peername")
+        with self._lock:
+            accepted = self._active < self.max_sessions
+            if accepted:
+                self._active += 1
+        if not accepted:
+            writer.write(b"The server is busy, please try again later.\r\n")
+            await writer.drain()
+            writer.close()
+            return
+        logger.info(f"Session started for {peer}")
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, SessionServer.run_session,
+                                       SocketTerminal(reader, writer, loop, self.idle_timeout))
+            # the writes queued by the session thread run before this coroutine resumes
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            with self._lock:
+                self._active -= 1
+            writer.close()
+            logger.info(f"Session ended for {peer}")
+
+    async def serve(self) -> None:
+        """
+        Accept connections until cancelled.
+        """
+        # print() of the session threads has to reach their own client
+        ThreadRoutedStream.install()
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        logger.info(f"Listening on {self.host}:{self.port}")
+        print(f"GP system server listening on {self.host}:{self.port}, press Ctrl+C to stop.")
+        async with server:
+            await server.serve_forever()
+
+    @staticmethod
+    def main(arguments) -> None:
+        """
+        :param list arguments: command line arguments, e.g. ["--server", "--port", "2323"]
+        """
+        parser = argparse.ArgumentParser(description="Serve the GP system to telnet-style clients.")
+        parser.add_argument("--server", action="store_true")
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=2323)
+        parser.add_argument("--max-sessions", type=int, default=32)
+        parser.add_argument("--idle-timeout", type=float, default=900)
+        options = parser.parse_args(arguments)
+        session_server = SessionServer(options.host, options.port, options.max_sessions, options.idle_timeout)
+        try:
+            asyncio.run(session_server.serve())
+        except KeyboardInterrupt:
+            print("Server stopped.")
+        finally:
+            # stopping the loop cancelled the pending reads, so every session thread is finishing
+            session_server.executor.shutdown(wait=True)
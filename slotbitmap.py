@@ -0,0 +1,282 @@
+import datetime
+import sqlite3
+from database import Database, SQLQuery
+
+
+class SlotBitmap:
+    """
+    Alternative storage of the availability: one available_day row per GP and date, whose Slots column
+    is a 42-bit mask of the quarter-hour slots Parser.time_parser allows (bit 0 is 08:30, bit 41 is 18:45).
+
+    After migrate(), available_time is a view expanding the masks into (StaffID, Timeslot) rows, with
+    INSTEAD OF triggers turning inserts and deletes into bit operations, so the existing queries keep
+    working unchanged. revert() restores the plain available_time table.
+
+    The view cannot use the primary key of available_day, so the statements run on every booking or hold
+    take their SQL from slot_available() and take_slot_query(), which look up the single day of the slot
+    when the bitmaps are enabled. The view is only kept for compatibility.
+    """
+
+    SLOTS = 42
+    SLOT_MINUTES = 15
+    FIRST_SLOT = datetime.time(8, 30)
+    # minutes from midnight to FIRST_SLOT
+    FIRST_MINUTE = FIRST_SLOT.hour * 60 + FIRST_SLOT.minute
+    FULL_DAY = (1 << SLOTS) - 1
+
+    # SQL expressions of a Timeslot (INTEGER minutes since the epoch, see database.TimeslotCodec)
+    BIT_SQL = "(({{0}} % 1440 - {0}) / {1})".format(FIRST_MINUTE, SLOT_MINUTES)
+    DAY_SQL = "date({0} * 60, 'unixepoch')"
+    VALID_SQL = "(typeof({{0}}) = 'integer' AND {{0}} % {0} = 0 AND {1} BETWEEN 0 AND {2})".format(
+        SLOT_MINUTES, BIT_SQL, SLOTS - 1)
+
+    DAY_TABLE_SCRIPT = """
+        CREATE TABLE IF NOT EXISTS available_day (
+            StaffID varchar(10) NOT NULL CHECK(StaffID LIKE 'G%'),
+            Day date NOT NULL,
+            Slots INTEGER NOT NULL DEFAULT 0 CHECK(Slots BETWEEN 0 AND {0}),
+            PRIMARY KEY(StaffID, Day)
+        ) WITHOUT ROWID;
+        """.format(FULL_DAY)
+
+    VIEW_SCRIPT = """
+        CREATE VIEW available_time (StaffID, Timeslot) AS
+            WITH RECURSIVE slot(bit) AS (SELECT 0 UNION ALL SELECT bit + 1 FROM slot WHERE bit < {last})
+            SELECT StaffID, CAST(strftime('%s', Day) AS INTEGER) / 60 + {first} + bit * {step}
+            FROM available_day JOIN slot ON Slots & (1 << bit);
+        CREATE TRIGGER available_time_insert INSTEAD OF INSERT ON available_time BEGIN
+            SELECT RAISE(ABORT, 'Timeslot is not a quarter-hour slot between 08:30 and 18:45')
+            WHERE NOT coalesce({valid_new}, 0);
+            INSERT OR IGNORE INTO available_day (StaffID, Day, Slots) VALUES (NEW.StaffID, {day_new}, 0);
+            UPDATE available_day SET Slots = Slots | (1 << {bit_new})
+            WHERE StaffID = NEW.StaffID AND Day = {day_new};
+        END;
+        CREATE TRIGGER available_time_delete INSTEAD OF DELETE ON available_time BEGIN
+            UPDATE available_day SET Slots = Slots & ~(1 << {bit_old})
+            WHERE StaffID = OLD.StaffID AND Day = {day_old};
+        END;
+        """.format(last=SLOTS - 1, first=FIRST_MINUTE, step=SLOT_MINUTES,
+                   valid_new=VALID_SQL.format("NEW.Timeslot"), bit_new=BIT_SQL.format("NEW.Timeslot"),
+                   day_new=DAY_SQL.format("NEW.Timeslot"), bit_old=BIT_SQL.format("OLD.Timeslot"),
+                   day_old=DAY_SQL.format("OLD.Timeslot"))
+
+    CREATE_SCRIPT = DAY_TABLE_SCRIPT + VIEW_SCRIPT
+
+    # condition true if the GP ({0}) has the slot ({1}) available, both SQL expressions used once
+    ROW_AVAILABLE_SQL = "EXISTS (SELECT 1 FROM available_time WHERE StaffID = {0} AND Timeslot = {1})"
+    DAY_AVAILABLE_SQL = ("EXISTS (SELECT 1 FROM (SELECT {{0}} AS StaffID, {{1}} AS Timeslot) slot JOIN available_day "
+                         "ON available_day.StaffID = slot.StaffID AND available_day.Day = {day} WHERE {valid} "
+                         "AND available_day.Slots & (1 << {bit}))"
+                         ).format(day=DAY_SQL.format("slot.Timeslot"), valid=VALID_SQL.format("slot.Timeslot"),
+                                  bit=BIT_SQL.format("slot.Timeslot"))
+    # parameters (StaffID, Timeslot)
+    ROW_TAKE_SLOT_QUERY = "DELETE FROM available_time WHERE StaffID = ? AND Timeslot = ?"
+    DAY_TAKE_SLOT_QUERY = ("UPDATE available_day SET Slots = Slots & ~(1 << {bit}) FROM (SELECT ? AS StaffID, "
+                           "? AS Timeslot) slot WHERE available_day.StaffID = slot.StaffID AND available_day.Day = "
+                           "{day} AND {valid}").format(bit=BIT_SQL.format("slot.Timeslot"),
+                                                       day=DAY_SQL.format("slot.Timeslot"),
+                                                       valid=VALID_SQL.format("slot.Timeslot"))
+
+    TABLE_SCRIPT = """
+        CREATE TABLE available_time (
+            StaffID varchar(10) NOT NULL CHECK(StaffID LIKE 'G%'),
+            Timeslot INTEGER NOT NULL,
+            FOREIGN KEY(StaffID) REFERENCES Users(ID) ON DELETE CASCADE ON UPDATE CASCADE
+        );
+        CREATE INDEX IF NOT EXISTS available_time_timeslot ON available_time (Timeslot, StaffID);
+        """
+
+    _enabled = None  # storage found by the last call of enabled(), None until then
+
+    @staticmethod
+    def enabled() -> bool:
+        """
+        :return: True if the database stores the availability as bitmaps
+        """
+        result = SQLQuery("SELECT type FROM sqlite_master WHERE name = 'available_time'").fetch_all()
+        SlotBitmap._enabled = bool(result) and result[0][0] == "view"
+        return SlotBitmap._enabled
+
+    @staticmethod
+    def slot_available(staff_id="?", timeslot="?") -> str:
+        """
+        The storage is looked up once per process (Migrations.apply() does it at startup), migrate() and
+        revert() update it.
+
+        :param str staff_id: SQL expression of the GP's ID, a parameter by default
+        :param str timeslot: SQL expression of the Timeslot, a parameter by default
+        :return: SQL condition true if the slot is available, using the primary key of the current storage
+        """
+        if SlotBitmap._enabled is None:
+            SlotBitmap.enabled()
+        return (SlotBitmap.DAY_AVAILABLE_SQL if SlotBitmap._enabled else SlotBitmap.ROW_AVAILABLE_SQL
+                ).format(staff_id, timeslot)
+
+    @staticmethod
+    def take_slot_query() -> str:
+        """
+        :return: statement removing one available slot, parameters (StaffID, Timeslot)
+        """
+        if SlotBitmap._enabled is None:
+            SlotBitmap.enabled()
+        return SlotBitmap.DAY_TAKE_SLOT_QUERY if SlotBitmap._enabled else SlotBitmap.ROW_TAKE_SLOT_QUERY
+
+    @staticmethod
+    def bit(slot_time) -> int:
+        """
+        :param time slot_time: start of a slot
+        :return: index of the slot's bit
+        :raises ValueError: if the time is not the start of a slot
+        """
+        minutes = slot_time.hour * 60 + slot_time.minute - SlotBitmap.FIRST_MINUTE
+        if slot_time.second or minutes % SlotBitmap.SLOT_MINUTES or not 0 <= minutes < \
+                SlotBitmap.SLOTS * SlotBitmap.SLOT_MINUTES:
+            raise ValueError(f"{slot_time} is not a quarter-hour slot between 08:30 and 18:45")
+        return minutes // SlotBitmap.SLOT_MINUTES
+
+    @staticmethod
+    def mask(start_time, end_time) -> int:
+        """
+        :param time start_time: start of the first slot
+        :param time end_time: end of the last slot, 19:00 at the latest
+        :return: mask of the slots from start_time up to end_time
+        """
+        end_bit = SlotBitmap.SLOTS if end_time == datetime.time(19, 0) else SlotBitmap.bit(end_time)
+        return ((1 << end_bit) - 1) & ~((1 << SlotBitmap.bit(start_time)) - 1)
+
+    @staticmethod
+    def times(mask) -> list:
+        """
+        :param int mask: mask of slots
+        :return: start times of the slots in the mask, in ascending order
+        """
+        result = []
+        while mask:
+            lowest = mask & -mask
+            minutes = SlotBitmap.FIRST_MINUTE + (lowest.bit_length() - 1) * SlotBitmap.SLOT_MINUTES
+            result.append(datetime.time(minutes // 60, minutes % 60))
+            mask ^= lowest
+        return result
+
+    @staticmethod
+    def set_slots(staff_id, day, mask) -> None:
+        """
+        Make the slots in the mask available, leaving the other slots of the day as they are.
+
+        :param str staff_id: ID of the GP
+        :param date day: date of the slots
+        :param int mask: mask of the slots to add
+        """
+        SQLQuery("INSERT INTO available_day (StaffID, Day, Slots) VALUES (?, ?, ?) "
+                 "ON CONFLICT(StaffID, Day) DO UPDATE SET Slots = Slots | excluded.Slots"
+                 ).commit((staff_id, day, mask & SlotBitmap.FULL_DAY))
+
+    @staticmethod
+    def clear_slots(staff_id, day, mask=FULL_DAY) -> None:
+        """
+        :param str staff_id: ID of the GP
+        :param date day: date of the slots
+        :param int mask: mask of the slots to remove, the whole day by default
+        """
+        SQLQuery("UPDATE available_day SET Slots = Slots & ~? WHERE StaffID = ? AND Day = ?"
+                 ).commit((mask, staff_id, day))
+
+    @staticmethod
+    def free_slots(staff_id, day) -> int:
+        """
+        :param str staff_id: ID of the GP
+        :param date day: date to look up
+        :return: mask of the available slots of the GP on that day
+        """
+        result = SQLQuery("SELECT Slots FROM available_day WHERE StaffID = ? AND Day = ?"
+                          ).fetch_all(parameters=(staff_id, day))
+        return result[0][0] if result else 0
+
+    @staticmethod
+    def scan(start_day, end_day, staff_id=None, mask=FULL_DAY) -> list:
+        """
+        :param date start_day: first date
+        :param date end_day: last date, inclusive
+        :param str staff_id: ID of the GP, all GPs by default
+        :param int mask: only slots in this mask are returned, e.g. SlotBitmap.mask(time(9), time(12))
+        :return: [StaffID, Day, mask of the available slots] rows having at least one slot, ordered by day
+        """
+        return SQLQuery("SELECT StaffID, Day, Slots & ? FROM available_day WHERE Day BETWEEN ? AND ? "
+                        "AND StaffID LIKE ? AND Slots & ? != 0 ORDER BY Day, StaffID"
+                        ).fetch_all(parameters=(mask, start_day, end_day, staff_id or '%', mask))
+
+    @staticmethod
+    def migrate() -> int:
+        """
+        Convert the available_time table into bitmaps and replace it by the compatibility view.
+
+        :return: number of available_day rows created
+        :raises ValueError: if some timeslots cannot be stored as bits, nothing is changed then
+        """
+        if SlotBitmap.enabled():
+            return 0
+        invalid = SQLQuery("SELECT COUNT(*) FROM available_time WHERE NOT coalesce({0}, 0)"
+                           .format(SlotBitmap.VALID_SQL.format("Timeslot"))).fetch_all()[0][0]
+        if invalid:
+            raise ValueError(f"{invalid} timeslots are not quarter-hour slots between 08:30 and 18:45")
+        # the bits of different slots are distinct powers of two, so the sum of the distinct bits is their union.
+        # The table is dropped rather than renamed: renaming it would also rename the references of Visit.
+        SlotBitmap._run_script(SlotBitmap.DAY_TABLE_SCRIPT +
+                               "INSERT INTO available_day (StaffID, Day, Slots) SELECT StaffID, {0}, "
+                               "SUM(DISTINCT 1 << {1}) FROM available_time GROUP BY StaffID, {0};"
+                               "DROP TABLE available_time;".format(SlotBitmap.DAY_SQL.format("Timeslot"),
+                                                                    SlotBitmap.BIT_SQL.format("Timeslot"))
+                               + SlotBitmap.VIEW_SCRIPT)
+        SlotBitmap._enabled = True
+        return SQLQuery("SELECT COUNT(*) FROM available_day").fetch_all()[0][0]
+
+    @staticmethod
+    def revert() -> int:
+        """
+        Convert the bitmaps back into the available_time table.
+
+        :return: number of available_time rows created
+        """
+        if not SlotBitmap.enabled():
+            return 0
+        SlotBitmap._run_script("CREATE TABLE available_time_new AS SELECT StaffID, Timeslot FROM available_time;"
+                               "DROP VIEW available_time; DROP TABLE available_day;"
+                               + SlotBitmap.TABLE_SCRIPT +
+                               "INSERT INTO available_time SELECT StaffID, Timeslot FROM available_time_new "
+                               "ORDER BY Timeslot; DROP TABLE available_time_new;")
+        SlotBitmap._enabled = False
+        return SQLQuery("SELECT COUNT(*) FROM available_time").fetch_all()[0][0]
+
+    @staticmethod
+    def _run_script(script) -> None:
+        # DDL and data move in one transaction, so a failure leaves the previous storage in place
+        connection = Database().connection()
+        try:
+            connection.executescript("BEGIN IMMEDIATE;" + script + "COMMIT;")
+        except sqlite3.Error:
+            if connection.in_transaction:
+                connection.rollback()
+            raise
+
+
+if __name__ == '__main__':
+    """
+    If the file is run, it switches the availability storage, e.g. python slotbitmap.py --migrate
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Switch the availability between rows and per-day bitmaps.")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--migrate", action="store_true", help="store the availability as per-day bitmaps")
+    group.add_argument("--revert", action="store_true", help="store the availability as one row per timeslot")
+    arguments = parser.parse_args()
+    # the bitmaps expect integer timeslots
+    from migrations import Migrations
+    Migrations.apply()
+    if arguments.migrate:
+        print(f"Availability stored as bitmaps, {SlotBitmap.migrate()} GP days.")
+    elif arguments.revert:
+        print(f"Availability stored as rows, {SlotBitmap.revert()} timeslots.")
+    else:
+        storage = "bitmaps (available_day)" if SlotBitmap.enabled() else "rows (available_time)"
+        print(f"Availability is stored as {storage}.")
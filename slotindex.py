@@ -0,0 +1,312 @@
+import bisect
+import datetime
+import heapq
+import threading
+import time
+from database import SQLQuery, TimeslotCodec
+from encryption import EncryptionHelper
+
+
+class FreeSlotIndex:
+    """
+    Per-process index of the bookable slots (from tomorrow on) of all GPs, so browsing availability
+    does not scan available_time and decrypt the GP names for every search.
+
+    Slots are kept as per-day sorted lists of (Timeslot, StaffID) and per-GP sorted lists of Timeslot,
+    searched with bisect. The per-GP lists are replaced rather than changed, so stream() can iterate
+    them without holding the lock. The write paths of this process update the index directly (add_many,
+    remove_ranges and their single-slot forms); it is rebuilt from the database when it is older than MAX_AGE
+    seconds or the day changed, which picks up the writes of other processes and renamed GPs.
+    """
+
+    MAX_AGE = 120
+
+    _days = {}  # date -> sorted list of (Timeslot, StaffID)
+    _day_list = []  # sorted dates of _days
+    _gps = {}  # StaffID -> sorted list of Timeslot
+    _names = {}  # StaffID -> (firstName, lastName)
+    _loaded_at = None
+    _loaded_on = None
+    _lock = threading.RLock()
+    _load_lock = threading.Lock()
+    _journal = None  # writes made while a rebuild is in progress, None when no rebuild is
+
+    @staticmethod
+    def load() -> int:
+        """
+        Rebuild the index from the database. The structures are built without holding the lock, the writes
+        made meanwhile are recorded and applied again to the new structures once they are swapped in.
+
+        :return: number of slots indexed
+        """
+        with FreeSlotIndex._lock:
+            FreeSlotIndex._journal = []
+        try:
+            today = datetime.date.today()
+            slots = SQLQuery("SELECT Timeslot, StaffID FROM available_time WHERE Timeslot >= ? ORDER BY Timeslot"
+                             ).fetch_all(parameters=(TimeslotCodec.start_of(today + datetime.timedelta(days=1)),))
+            names = SQLQuery("SELECT ID, firstName, lastName FROM Users WHERE UserType = 'GP'"
+                             ).fetch_all(decrypter=EncryptionHelper())
+            days, gps = {}, {}
+            previous = None
+            for slot in slots:
+                # available_time has no unique key, duplicated rows are indexed once
+                if slot == previous:
+                    continue
+                previous = slot
+                days.setdefault(slot[0].date(), []).append(slot)
+                gps.setdefault(slot[1], []).append(slot[0])
+            names = {staff_id: (first_name, last_name) for staff_id, first_name, last_name in names}
+            day_list = sorted(days)
+        except BaseException:
+            with FreeSlotIndex._lock:
+                FreeSlotIndex._journal = None
+            raise
+        with FreeSlotIndex._lock:
+            FreeSlotIndex._days = days
+            FreeSlotIndex._day_list = day_list
+            FreeSlotIndex._gps = gps
+            FreeSlotIndex._names = names
+            FreeSlotIndex._loaded_at = time.monotonic()
+            FreeSlotIndex._loaded_on = today
+            journal, FreeSlotIndex._journal = FreeSlotIndex._journal, None
+            for entry in journal:
+                if entry is None:
+                    FreeSlotIndex._loaded_at = None
+                    break
+                entry[0](*entry[1:])
+        return len(slots)
+
+    @staticmethod
+    def stale() -> bool:
+        """
+        :return: True if the index was never loaded, is older than MAX_AGE or was loaded on another day
+        """
+        with FreeSlotIndex._lock:
+            return FreeSlotIndex._loaded_at is None or FreeSlotIndex._loaded_on != datetime.date.today() or \
+                time.monotonic() - FreeSlotIndex._loaded_at > FreeSlotIndex.MAX_AGE
+
+    @staticmethod
+    def ensure_loaded() -> int:
+        """
+        Load the index if it is stale. Rebuilds are made one at a time and without holding the lock, so the
+        write paths and the readers of a fresh index are not blocked by a rebuild.
+
+        :return: number of days having slots
+        """
+        if FreeSlotIndex.stale():
+            with FreeSlotIndex._load_lock:
+                # another thread may have rebuilt the index while this one was waiting
+                if FreeSlotIndex.stale():
+                    FreeSlotIndex.load()
+        with FreeSlotIndex._lock:
+            return len(FreeSlotIndex._day_list)
+
+    @staticmethod
+    def invalidate() -> None:
+        """
+        Rebuild the index on its next use, e.g. after a GP and all their slots were deleted.
+        """
+        with FreeSlotIndex._lock:
+            FreeSlotIndex._loaded_at = None
+            if FreeSlotIndex._journal is not None:
+                # the rebuild in progress may have read the database before the change
+                FreeSlotIndex._journal.append(None)
+
+    @staticmethod
+    def add(staff_id, timeslot) -> None:
+        """
+        :param str staff_id: ID of the GP
+        :param datetime timeslot: slot made available
+        """
+        FreeSlotIndex.add_many(staff_id, [timeslot])
+
+    @staticmethod
+    def add_many(staff_id, timeslots) -> None:
+        """
+        Add slots of a GP, replacing the per-GP list once for the whole batch.
+
+        :param str staff_id: ID of the GP
+        :param timeslots: slots made available
+        """
+        with FreeSlotIndex._lock:
+            if FreeSlotIndex._journal is not None:
+                FreeSlotIndex._journal.append((FreeSlotIndex._add, staff_id, list(timeslots)))
+            FreeSlotIndex._add(staff_id, timeslots)
+
+    @staticmethod
+    def _add(staff_id, timeslots) -> None:
+        """
+        :param str staff_id: ID of the GP
+        :param timeslots: slots made available, the caller holds the lock
+        """
+        if FreeSlotIndex._loaded_at is None:
+            return
+        if staff_id not in FreeSlotIndex._names:
+            # the name of a new GP is only known after a rebuild
+            FreeSlotIndex._loaded_at = None
+            return
+        slots = FreeSlotIndex._gps.get(staff_id, [])
+        existing = set(slots)
+        new = sorted({timeslot for timeslot in timeslots
+                      if timeslot.date() > FreeSlotIndex._loaded_on and timeslot not in existing})
+        if not new:
+            return
+        FreeSlotIndex._gps[staff_id] = list(heapq.merge(slots, new))
+        for timeslot in new:
+            day = timeslot.date()
+            if day not in FreeSlotIndex._days:
+                bisect.insort(FreeSlotIndex._day_list, day)
+            bisect.insort(FreeSlotIndex._days.setdefault(day, []), (timeslot, staff_id))
+
+    @staticmethod
+    def remove(staff_id, timeslot) -> None:
+        """
+        :param str staff_id: ID of the GP
+        :param datetime timeslot: slot booked or removed
+        """
+        FreeSlotIndex.remove_ranges(staff_id, [(timeslot, timeslot)])
+
+    @staticmethod
+    def remove_many(staff_id, timeslots) -> None:
+        """
+        :param str staff_id: ID of the GP
+        :param timeslots: slots booked or removed
+        """
+        FreeSlotIndex.remove_ranges(staff_id, [(timeslot, timeslot) for timeslot in timeslots])
+
+    @staticmethod
+    def remove_range(staff_id, first, last) -> None:
+        """
+        :param str staff_id: ID of the GP
+        :param datetime first: first slot removed
+        :param datetime last: last slot removed, inclusive
+        """
+        FreeSlotIndex.remove_ranges(staff_id, [(first, last)])
+
+    @staticmethod
+    def remove_ranges(staff_id, ranges) -> None:
+        """
+        Remove slots of a GP, replacing the per-GP list once for the whole batch.
+
+        :param str staff_id: ID of the GP
+        :param ranges: (first, last) pairs of the slots removed, last inclusive
+        """
+        with FreeSlotIndex._lock:
+            if FreeSlotIndex._journal is not None:
+                FreeSlotIndex._journal.append((FreeSlotIndex._remove, staff_id, list(ranges)))
+            FreeSlotIndex._remove(staff_id, ranges)
+
+    @staticmethod
+    def _remove(staff_id, ranges) -> None:
+        """
+        :param str staff_id: ID of the GP
+        :param ranges: (first, last) pairs of the slots removed, the caller holds the lock
+        """
+        if FreeSlotIndex._loaded_at is None:
+            return
+        slots = FreeSlotIndex._gps.get(staff_id, [])
+        removed = set()
+        for first, last in ranges:
+            removed.update(slots[bisect.bisect_left(slots, first):bisect.bisect_right(slots, last)])
+        if not removed:
+            return
+        for timeslot in removed:
+            day = FreeSlotIndex._days[timeslot.date()]
+            del day[bisect.bisect_left(day, (timeslot, staff_id))]
+            if not day:
+                del FreeSlotIndex._days[timeslot.date()]
+                del FreeSlotIndex._day_list[bisect.bisect_left(FreeSlotIndex._day_list, timeslot.date())]
+        FreeSlotIndex._gps[staff_id] = [timeslot for timeslot in slots if timeslot not in removed]
+
+    @staticmethod
+    def apply(changes) -> None:
+        """
+        :param dict changes: {"added": {StaffID: [Timeslot]}, "removed": {StaffID: [(first, last)]}} of the slots
+                             a committed transaction made available or took, last inclusive
+        """
+        for staff_id, ranges in changes.get("removed", {}).items():
+            FreeSlotIndex.remove_ranges(staff_id, ranges)
+        for staff_id, timeslots in changes.get("added", {}).items():
+            FreeSlotIndex.add_many(staff_id, timeslots)
+
+    @staticmethod
+    def between(start, end, staff_id=None) -> list:
+        """
+        :param datetime start: first timeslot
+        :param datetime end: last timeslot, inclusive
+        :param str staff_id: ID of the GP, all GPs by default
+        :return: (Timeslot, StaffID) of the free slots, ordered by Timeslot
+        """
+        FreeSlotIndex.ensure_loaded()
+        with FreeSlotIndex._lock:
+            if staff_id is not None:
+                slots = FreeSlotIndex._gps.get(staff_id, [])
+                return [(timeslot, staff_id) for timeslot in
+                        slots[bisect.bisect_left(slots, start):bisect.bisect_right(slots, end)]]
+            result = []
+            day_list = FreeSlotIndex._day_list
+            for position in range(bisect.bisect_left(day_list, start.date()),
+                                  bisect.bisect_right(day_list, end.date())):
+                day = FreeSlotIndex._days[day_list[position]]
+                # bounds compare before every StaffID of their timeslot, the end bound is the next minute
+                result.extend(day[bisect.bisect_left(day, (start,)):
+                                  bisect.bisect_left(day, (end + TimeslotCodec.MINUTE,))])
+            return result
+
+    @staticmethod
+    def on_day(day, staff_id=None) -> list:
+        """
+        :param date day: date to look up
+        :param str staff_id: ID of the GP, all GPs by default
+        :return: (Timeslot, StaffID) of the free slots on that day, ordered by Timeslot
+        """
+        start = TimeslotCodec.start_of(day)
+        return FreeSlotIndex.between(start, start + datetime.timedelta(days=1) - TimeslotCodec.MINUTE, staff_id)
+
+    @staticmethod
+    def stream(staff_id, after):
+        """
+        :param str staff_id: ID of the GP
+        :param datetime after: first timeslot
+        :return: generator of the (Timeslot, StaffID) of the GP from after on, ordered by Timeslot
+        """
+        with FreeSlotIndex._lock:
+            slots = FreeSlotIndex._gps.get(staff_id, [])
+        # the list is never changed, only replaced, so later writes do not affect the iteration
+        for position in range(bisect.bisect_left(slots, after), len(slots)):
+            yield slots[position], staff_id
+
+    @staticmethod
+    def earliest(count, after=None, staff_ids=None) -> list:
+        """
+        :param int count: maximum number of slots
+        :param datetime after: only slots at or after this time, default is now
+        :param staff_ids: IDs of the GPs to search, all GPs by default
+        :return: (Timeslot, StaffID) of the earliest free slots, ordered by Timeslot
+        """
+        after = after or datetime.datetime.now()
+        FreeSlotIndex.ensure_loaded()
+        if staff_ids is not None:
+            # the streams are merged lazily, only the slots up to the last one returned are visited
+            merged = heapq.merge(*(FreeSlotIndex.stream(staff_id, after) for staff_id in staff_ids))
+            return [slot for slot, _ in zip(merged, range(count))]
+        with FreeSlotIndex._lock:
+            result = []
+            day_list = FreeSlotIndex._day_list
+            for position in range(bisect.bisect_left(day_list, after.date()), len(day_list)):
+                day = FreeSlotIndex._days[day_list[position]]
+                result.extend(day[bisect.bisect_left(day, (after,)):][:count - len(result)])
+                if len(result) == count:
+                    break
+            return result
+
+    @staticmethod
+    def rows(slots) -> list:
+        """
+        :param list slots: (Timeslot, StaffID) pairs returned by the index
+        :return: [firstName, lastName, Timeslot, StaffID] rows, as returned by the availability queries
+        """
+        with FreeSlotIndex._lock:
+            names = FreeSlotIndex._names
+            return [[*names.get(staff_id, ("", "")), timeslot, staff_id] for timeslot, staff_id in slots]
@@ -0,0 +1,57 @@
+import subprocess
+import sys
+from iohandler import Paging
+
+
+class StartupProfiler:
+    """
+    Reports how long each module takes to import, for 'python main.py --profile-startup'.
+    Imports are measured in a fresh interpreter with 'python -X importtime', once for what is
+    imported before the first prompt and once for the modules that are only imported after login.
+    """
+
+    # what the application imports before showing the first prompt
+    STARTUP_IMPORTS = "import main, loghandler, search"
+    # what is imported later, after login or on first use
+    DEFERRED_IMPORTS = "import auth, admin, gp, patient, events, tabulate, cryptography.fernet"
+
+    @staticmethod
+    def measure(statement) -> list:
+        """
+        :param str statement: import statement to run in a fresh interpreter
+        :return: list of (module, self time in ms, cumulative time in ms, nesting level), in import order
+        """
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                                 capture_output=True, text=True)
+        timings = []
+        for line in process.stderr.splitlines():
+            # format: "import time:  self [us] | cumulative | imported package"
+            if not line.startswith("import time:") or "imported package" in line:
+                continue
+            self_time, cumulative, module = line[len("import time:"):].split("|")
+            # nested imports are indented by two spaces per level
+            level = (len(module) - len(module.lstrip()) - 1) // 2
+            timings.append((module.strip(), int(self_time) / 1000, int(cumulative) / 1000, level))
+        return timings
+
+    @staticmethod
+    def report(top=15) -> None:
+        """
+        Print the modules with the highest import time before the first prompt and after login.
+
+        :param int top: number of modules listed per phase
+        """
+        startup = StartupProfiler.measure(StartupProfiler.STARTUP_IMPORTS)
+        loaded = {module for module, _, _, _ in startup}
+        deferred = [timing for timing in StartupProfiler.measure(StartupProfiler.STARTUP_IMPORTS + "; "
+                                                                 + StartupProfiler.DEFERRED_IMPORTS)
+                    if timing[0] not in loaded]
+        for title, timings in (("Imported before the first prompt", startup),
+                               ("Deferred until login or first use", deferred)):
+            # the cumulative time of a top-level import includes everything it imports
+            total = sum(cumulative for _, _, cumulative, level in timings if level == 0)
+            print(f"{title}: {len(timings)} modules, {total:.1f} ms")
+            Paging.better_form([("  " * level + module, f"{self_time:.1f}", f"{cumulative:.1f}")
+                                for module, self_time, cumulative, level in
+                                sorted(timings, key=lambda timing: -timing[1])[:top]],
+                               ["Module", "Self (ms)", "Cumulative (ms)"])
@@ -0,0 +1,204 @@
+import io
+import os
+import sys
+import threading
+
+
+class Terminal:
+    """
+    I/O backend used by Parser for clearing the screen, printing and reading input.
+    Output is collected and written to the stream with a single write and flush per screen.
+
+    The backend in use can be swapped (e.g. for tests) with Terminal.use(), or for the current
+    thread only with Terminal.use_in_thread() (e.g. one backend per server session).
+    """
+
+    _current = None
+    _local = threading.local()
+
+    def __init__(self, stream=None):
+        """
+        :param stream: text stream to write to, default is sys.stdout at the time of writing
+        """
+        self._stream = stream
+
+    @property
+    def stream(self):
+        return self._stream if self._stream is not None else sys.stdout
+
+    def clear(self) -> None:
+        """
+        Clear the screen, a no-op for backends which cannot clear.
+        """
+        pass
+
+    def write(self, text="") -> None:
+        """
+        :param str text: text to write, no newline is added
+        """
+        self.stream.write(text)
+
+    def write_lines(self, *messages) -> None:
+        """
+        Write every message on its own line, as print() would, and flush once at the end.
+
+        :param messages: messages to be written
+        """
+        self.stream.write("".join(f"{message}\n" for message in messages))
+        self.flush()
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+    def read_line(self, prompt="") -> str:
+        """
+        :param str prompt: prompt written before reading
+        :return: the line entered, without the newline
+        """
+        return input(prompt)
+
+    def read_secret(self, prompt="") -> str:
+        """
+        :param str prompt: prompt written before reading
+        :return: the line entered without echoing it, e.g. a password
+        """
+        from getpass import getpass
+        return getpass(prompt)
+
+    @staticmethod
+    def detect(stream=None):
+        """
+        :param stream: text stream the terminal will write to, default is sys.stdout
+        :return: AnsiTerminal if the stream is an interactive terminal, otherwise PlainTerminal
+        """
+        stream = stream if stream is not None else sys.stdout
+        try:
+            interactive = stream.isatty()
+        except (AttributeError, ValueError):
+            interactive = False
+        if interactive and AnsiTerminal.enable_escape_sequences():
+            return AnsiTerminal(stream)
+        return PlainTerminal(stream)
+
+    @staticmethod
+    def current():
+        """
+        :return: the terminal backend of the current thread if set, otherwise the backend in use,
+                 detected on first use
+        """
+        terminal = getattr(Terminal._local, "terminal", None)
+        if terminal is not None:
+            return terminal
+        if Terminal._current is None:
+            Terminal._current = Terminal.detect()
+        return Terminal._current
+
+    @staticmethod
+    def use(terminal) -> None:
+        """
+        :param Terminal terminal: backend to use from now on, None to detect it again on next use
+        """
+        Terminal._current = terminal
+
+    @staticmethod
+    def use_in_thread(terminal) -> None:
+        """
+        :param Terminal terminal: backend used by the current thread only, None to use the shared backend again
+        """
+        Terminal._local.terminal = terminal
+
+
+class ThreadRoutedStream:
+    """
+    Replacement for sys.stdout sending what print() writes to the terminal of the current thread,
+    so output of code printing directly reaches the right session. Threads without their own
+    terminal write to the original stream.
+    """
+
+    def __init__(self, default):
+        """
+        :param default: stream used by threads without their own terminal, usually the original sys.stdout
+        """
+        self.default = default
+
+    def _target(self):
+        terminal = getattr(Terminal._local, "terminal", None)
+        return terminal.stream if terminal is not None else self.default
+
+    def write(self, text) -> int:
+        return self._target().write(text)
+
+    def flush(self) -> None:
+        self._target().flush()
+
+    def isatty(self) -> bool:
+        return False
+
+    @staticmethod
+    def install():
+        """
+        Route sys.stdout through a ThreadRoutedStream, does nothing if it is already installed.
+        :return: the installed ThreadRoutedStream
+        """
+        if not isinstance(sys.stdout, ThreadRoutedStream):
+            sys.stdout = ThreadRoutedStream(sys.stdout)
+        return sys.stdout
+
+
+class AnsiTerminal(Terminal):
+    """
+    Terminal backend for interactive terminals, clearing the screen with ANSI escape sequences
+    instead of spawning a 'clear' or 'cls' process.
+    """
+
+    # move the cursor home and erase the whole display
+    CLEAR_SEQUENCE = "\033[H\033[2J"
+
+    def clear(self) -> None:
+        self.stream.write(self.CLEAR_SEQUENCE)
+
+    @staticmethod
+    def enable_escape_sequences() -> bool:
+        """
+        Make sure the console interprets escape sequences, only needed on Windows.
+        :return: True if escape sequences are supported
+        """
+        if os.name != 'nt':
+            return True
+        try:
+            import ctypes
+            kernel32 = ctypes.windll.kernel32
+            handle = kernel32.GetStdHandle(-11)  # STD_OUTPUT_HANDLE
+            mode = ctypes.c_ulong()
+            if not kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+                return False
+            # ENABLE_VIRTUAL_TERMINAL_PROCESSING
+            return bool(kernel32.SetConsoleMode(handle, mode.value | 0x0004))
+        except (AttributeError, OSError):
+            return False
+
+
+class PlainTerminal(Terminal):
+    """
+    Terminal backend for redirected output (files, pipes), where clearing is skipped.
+    """
+    pass
+
+
+class CaptureTerminal(Terminal):
+    """
+    Terminal backend writing to memory, for tests and scripted runs.
+    """
+
+    def __init__(self):
+        super().__init__(io.StringIO())
+        self.clear_count = 0
+
+    def clear(self) -> None:
+        self.clear_count += 1
+
+    def getvalue(self) -> str:
+        """
+        :return: everything written so far
+        """
+        return self.stream.getvalue()
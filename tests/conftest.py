@@ -0,0 +1,98 @@
+import datetime
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the modules are flat at the root of the repository and are imported by their names
+sys.path.insert(0, ROOT)
+
+from cache import cache  # noqa: E402
+from database import Database, SQLTransaction, Timeslot, TimeslotCodec  # noqa: E402
+from encryption import EncryptionHelper  # noqa: E402
+from slotbitmap import SlotBitmap  # noqa: E402
+from slotindex import FreeSlotIndex  # noqa: E402
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """
+    Empty working directory holding the encryption key, the modules open GPDB.db and secure/GPDB.key
+    relative to it.
+    """
+    os.mkdir(tmp_path / "secure")
+    shutil.copy(os.path.join(ROOT, "secure", "GPDB.key"), tmp_path / "secure" / "GPDB.key")
+    shutil.copy(os.path.join(ROOT, "GPDB.sql"), tmp_path / "GPDB.sql")
+    monkeypatch.chdir(tmp_path)
+    # state kept per process, from the database of the previous test
+    Database.close_thread_connections()
+    monkeypatch.setattr(SlotBitmap, "_enabled", None)
+    FreeSlotIndex.invalidate()
+    cache.invalidate()
+    yield tmp_path
+    Database.close_thread_connections()
+    FreeSlotIndex.invalidate()
+    cache.invalidate()
+
+
+@pytest.fixture
+def database(workdir):
+    """
+    GPDB.db created from GPDB.sql, with the GPs G1 (male), G2 (male) and G3 (female) and the patients
+    1000000001 to 1000000009.
+    """
+    Database("GPDB.db").recreate_database("GPDB.sql")
+    encrypt = EncryptionHelper().encrypt_to_bits
+    transaction = SQLTransaction()
+    for number, gender in ((1, "M"), (2, "M"), (3, "F")):
+        transaction.add("INSERT INTO Users VALUES (?, ?, 'x', ?, ?, ?, ?, ?, ?, 'GP', 'F', 3)",
+                        (f"G{number}", f"gp{number}", encrypt("1980-01-01"), encrypt(f"First{number}"),
+                         encrypt(f"Last{number}"), encrypt("07000000000"), encrypt("Address"), encrypt("WC1E 6BT")))
+        transaction.add("INSERT INTO GP (ID, Gender, Rating) VALUES (?, ?, 3)", (f"G{number}", gender))
+    for number in range(1000000001, 1000000010):
+        transaction.add("INSERT INTO Users VALUES (?, ?, 'x', ?, ?, ?, ?, ?, ?, 'Patient', 'F', 3)",
+                        (str(number), f"patient{number}", encrypt("1990-01-01"), encrypt("Pat"),
+                         encrypt(f"Ient{number}"), encrypt("07000000000"), encrypt("Address"), encrypt("WC1E 6BT")))
+        transaction.add("INSERT INTO Patient (NHSNo, Gender) VALUES (?, 'M')", (str(number),))
+    transaction.commit()
+    return workdir
+
+
+@pytest.fixture(params=["rows", "bitmaps"])
+def storage(request, database):
+    """
+    The database with the availability stored as rows of available_time, and again as bitmaps.
+    """
+    if request.param == "bitmaps":
+        SlotBitmap.migrate()
+    return request.param
+
+
+def slot(days, hour, minute=0) -> Timeslot:
+    """
+    :param int days: days from today
+    :param int hour: hour of the slot
+    :param int minute: minute of the slot
+    :return: the timeslot
+    """
+    return Timeslot.combine(datetime.date.today() + datetime.timedelta(days=days), datetime.time(hour, minute))
+
+
+def add_slots(staff_id, *timeslots) -> None:
+    """
+    :param str staff_id: ID of the GP
+    :param timeslots: slots made available
+    """
+    SQLTransaction().add("INSERT INTO available_time (StaffID, Timeslot) VALUES (?, ?)",
+                         [(staff_id, timeslot) for timeslot in timeslots], many=True).commit()
+
+
+def free_slots(staff_id) -> list:
+    """
+    :param str staff_id: ID of the GP
+    :return: the available timeslots of the GP, in order
+    """
+    return [TimeslotCodec.decode(row[0]) for row in Database().connection().execute(
+        "SELECT Timeslot FROM available_time WHERE StaffID = ? ORDER BY Timeslot", (staff_id,))]
@@ -0,0 +1,120 @@
+import http.client
+import json
+import threading
+
+import pytest
+
+from api import APISessions, PooledHTTPServer
+from booking import BookingService
+from conftest import add_slots, slot
+from database import SQLQuery
+from encryption import PasswordHelper
+
+API_KEY = "test-key"
+
+
+@pytest.fixture
+def server(database, monkeypatch):
+    """
+    The API served on a free local port, every user having the password "pw".
+    """
+    monkeypatch.setattr(APISessions, "_sessions", {})
+    SQLQuery("UPDATE Users SET passCode = ?").commit((PasswordHelper.hash_pw("pw"),))
+    server = PooledHTTPServer(("127.0.0.1", 0), workers=2, api_key=API_KEY)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def request(server, method, path, body=None, token=None, api_key=API_KEY):
+    """
+    :return: (HTTP status, decoded JSON payload)
+    """
+    headers = {"Content-Type": "application/json"}
+    if api_key is not None:
+        headers["X-API-Key"] = api_key
+    if token is not None:
+        headers["Authorization"] = f"Bearer {token}"
+    connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+    try:
+        connection.request(method, path, None if body is None else json.dumps(body), headers)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def login(server, username) -> str:
+    status, payload = request(server, "POST", "/sessions", {"username": username, "password": "pw"})
+    assert status == 201
+    return payload["token"]
+
+
+def test_server_needs_an_api_key():
+    with pytest.raises(ValueError):
+        PooledHTTPServer(("127.0.0.1", 0), api_key=None)
+
+
+@pytest.mark.parametrize("api_key", [None, "", "wrong-key"])
+def test_requests_without_the_api_key_are_refused(server, api_key):
+    status, _ = request(server, "POST", "/sessions", {"username": "gp1", "password": "pw"}, api_key=api_key)
+    assert status == 401
+    assert request(server, "GET", "/gps", token=login(server, "gp1"), api_key=api_key)[0] == 401
+
+
+def test_wrong_credentials_are_refused(server):
+    assert request(server, "POST", "/sessions", {"username": "gp1", "password": "wrong"})[0] == 401
+    assert request(server, "POST", "/sessions", {"username": "nobody", "password": "pw"})[0] == 401
+
+
+@pytest.mark.parametrize("token", [None, "unknown-token"])
+def test_requests_without_a_session_are_refused(server, token):
+    status, payload = request(server, "GET", "/gps", token=token)
+    assert status == 401
+    assert "session" in payload["error"]
+
+
+def test_expired_session_is_refused(server, monkeypatch):
+    monkeypatch.setattr(APISessions, "SESSION_SECONDS", 0)
+    assert request(server, "GET", "/gps", token=login(server, "gp1"))[0] == 401
+
+
+def test_patient_cannot_book_for_another_patient(server):
+    add_slots("G1", slot(3, 9))
+    token = login(server, "patient1000000001")
+    body = {"staff_id": "G1", "timeslot": str(slot(3, 9)), "nhs_no": "1000000002"}
+    assert request(server, "POST", "/bookings", body, token)[0] == 403
+    assert SQLQuery("SELECT COUNT(*) FROM Visit").fetch_all() == [(0,)]
+    body["nhs_no"] = "1000000001"
+    assert request(server, "POST", "/bookings", body, token)[0] == 201
+
+
+def test_patient_cannot_cancel_the_booking_of_another_patient(server):
+    add_slots("G1", slot(10, 9))
+    booking_no = BookingService.book("1000000002", "G1", slot(10, 9))
+    status, _ = request(server, "POST", f"/bookings/{booking_no}/cancel", token=login(server, "patient1000000001"))
+    assert status == 404
+    assert SQLQuery("SELECT COUNT(*) FROM Visit").fetch_all() == [(1,)]
+
+
+def test_routes_are_limited_by_role(server):
+    patient, gp = login(server, "patient1000000001"), login(server, "gp1")
+    assert request(server, "POST", "/bookings/confirm", {"booking_nos": []}, patient)[0] == 403
+    assert request(server, "POST", "/gps/G1/bookings/cancel", {"start": "2030-01-01", "end": "2030-01-01"},
+                   patient)[0] == 403
+    assert request(server, "POST", "/bookings", {"staff_id": "G1", "timeslot": str(slot(3, 9))}, gp)[0] == 403
+    assert request(server, "GET", "/metrics", token=gp)[0] == 403
+
+
+def test_gp_cannot_act_for_another_gp(server):
+    add_slots("G1", slot(3, 9))
+    booking_no = BookingService.book("1000000001", "G1", slot(3, 9))
+    token = login(server, "gp2")
+    assert request(server, "POST", f"/bookings/{booking_no}/confirm", {"staff_id": "G1"}, token)[0] == 403
+    assert request(server, "POST", "/gps/G1/bookings/cancel", {"start": str(slot(3, 9).date()),
+                                                               "end": str(slot(3, 9).date())}, token)[0] == 403
+    assert SQLQuery("SELECT Confirmed FROM Visit").fetch_all() == [("P",)]
+    assert request(server, "POST", f"/bookings/{booking_no}/confirm", token=login(server, "gp1"))[0] == 200
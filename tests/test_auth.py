@@ -0,0 +1,85 @@
+from collections import OrderedDict
+
+import pytest
+
+from auth import AuthenticationService
+from database import Database, SQLQuery
+from encryption import PasswordHelper
+
+
+@pytest.fixture
+def accounts(database, monkeypatch):
+    """
+    The database with the password "pw" for every user, patient1000000001 on their second login
+    and patient1000000002 deactivated, and no failed attempts recorded.
+    """
+    monkeypatch.setattr(AuthenticationService, "_failures", OrderedDict())
+    SQLQuery("UPDATE Users SET passCode = ?, LoginCount = 0").commit((PasswordHelper.hash_pw("pw"),))
+    SQLQuery("UPDATE Users SET LoginCount = 1 WHERE ID = '1000000001'").commit(())
+    SQLQuery("UPDATE Users SET Deactivated = 'T', LoginCount = 1 WHERE ID = '1000000002'").commit(())
+    return database
+
+
+def login_count(user_id) -> int:
+    return SQLQuery("SELECT LoginCount FROM Users WHERE ID = ?").fetch_all(parameters=(user_id,))[0][0]
+
+
+def test_login_returns_the_profile_and_counts_it(accounts):
+    status, profile = AuthenticationService.authenticate("patient1000000001", "pw")
+    assert status == AuthenticationService.SUCCESS
+    assert profile.ID == "1000000001"
+    assert profile.user_type == "Patient"
+    assert login_count("1000000001") == 2
+
+
+def test_first_login_is_not_counted(accounts):
+    assert AuthenticationService.authenticate("patient1000000003", "pw")[0] == AuthenticationService.SUCCESS
+    assert login_count("1000000003") == 0
+
+
+def test_wrong_password_is_not_counted(accounts):
+    assert AuthenticationService.authenticate("patient1000000001", "wrong") == (AuthenticationService.INVALID, None)
+    assert login_count("1000000001") == 1
+    assert AuthenticationService.remaining_attempts("patient1000000001") == AuthenticationService.MAX_ATTEMPTS - 1
+
+
+def test_unknown_username_counts_as_a_failure(accounts):
+    assert AuthenticationService.authenticate("nobody", "pw") == (AuthenticationService.INVALID, None)
+    assert AuthenticationService.remaining_attempts("nobody") == AuthenticationService.MAX_ATTEMPTS - 1
+
+
+def test_deactivated_account(accounts):
+    status, profile = AuthenticationService.authenticate("patient1000000002", "pw")
+    assert status == AuthenticationService.DEACTIVATED
+    assert profile.ID == "1000000002"
+    assert login_count("1000000002") == 1
+
+
+def test_account_is_locked_without_querying(accounts, monkeypatch):
+    for _ in range(AuthenticationService.MAX_ATTEMPTS):
+        assert AuthenticationService.authenticate("patient1000000001", "wrong")[0] == AuthenticationService.INVALID
+
+    queries = []
+    connection = Database.connection
+    monkeypatch.setattr(Database, "connection", lambda self: queries.append(self) or connection(self))
+    assert AuthenticationService.authenticate("patient1000000001", "pw") == (AuthenticationService.LOCKED, None)
+    assert queries == []
+    # the lockout is per username
+    assert AuthenticationService.authenticate("patient1000000003", "pw")[0] == AuthenticationService.SUCCESS
+    assert len(queries) == 1
+
+def test_lockout_expires(accounts, monkeypatch):
+    for _ in range(AuthenticationService.MAX_ATTEMPTS):
+        AuthenticationService.record_failure("patient1000000001")
+    assert AuthenticationService.authenticate("patient1000000001", "pw")[0] == AuthenticationService.LOCKED
+    # the last failure sets the expiry of the lockout
+    monkeypatch.setattr(AuthenticationService, "LOCKOUT_SECONDS", 0)
+    AuthenticationService.record_failure("patient1000000001")
+    assert AuthenticationService.authenticate("patient1000000001", "pw")[0] == AuthenticationService.SUCCESS
+
+
+def test_successful_login_clears_the_failures(accounts):
+    for _ in range(AuthenticationService.MAX_ATTEMPTS - 1):
+        AuthenticationService.authenticate("patient1000000001", "wrong")
+    assert AuthenticationService.authenticate("patient1000000001", "pw")[0] == AuthenticationService.SUCCESS
+    assert AuthenticationService.remaining_attempts("patient1000000001") == AuthenticationService.MAX_ATTEMPTS
@@ -0,0 +1,143 @@
+import threading
+
+import pytest
+
+from booking import BookingService
+from conftest import add_slots, free_slots, slot
+from database import Database, SQLQuery
+from exceptions import BookingError
+from holds import SlotHold
+from notifications import NotificationOutbox
+from slotindex import FreeSlotIndex
+
+
+def visits() -> list:
+    return SQLQuery("SELECT BookingNo, NHSNo, StaffID, Timeslot, Confirmed FROM Visit ORDER BY BookingNo").fetch_all()
+
+
+def test_book_takes_the_slot(storage):
+    add_slots("G1", slot(3, 9), slot(3, 9, 15))
+    booking_no = BookingService.book("1000000001", "G1", slot(3, 9))
+    assert visits() == [(booking_no, "1000000001", "G1", slot(3, 9), "P")]
+    assert free_slots("G1") == [slot(3, 9, 15)]
+    assert FreeSlotIndex.on_day(slot(3, 9).date(), "G1") == [(slot(3, 9, 15), "G1")]
+
+
+def test_book_accepts_text_timeslots(storage):
+    add_slots("G1", slot(3, 9))
+    BookingService.book("1000000001", "G1", str(slot(3, 9)))
+    assert visits()[0][3] == slot(3, 9)
+
+
+def test_slot_cannot_be_booked_twice(storage):
+    add_slots("G1", slot(3, 9))
+    BookingService.book("1000000001", "G1", slot(3, 9))
+    with pytest.raises(BookingError):
+        BookingService.book("1000000002", "G1", slot(3, 9))
+    assert len(visits()) == 1
+
+
+def test_only_slots_from_tomorrow_can_be_booked(storage):
+    add_slots("G1", slot(0, 23, 45))
+    with pytest.raises(BookingError):
+        BookingService.book("1000000001", "G1", slot(0, 23, 45))
+
+
+def test_slot_held_by_another_patient_cannot_be_booked(storage):
+    add_slots("G1", slot(3, 9))
+    assert SlotHold.hold("1000000002", "G1", slot(3, 9))
+    with pytest.raises(BookingError):
+        BookingService.book("1000000001", "G1", slot(3, 9))
+    BookingService.book("1000000002", "G1", slot(3, 9))
+    assert SQLQuery("SELECT COUNT(*) FROM slot_hold").fetch_all() == [(0,)]
+
+
+def test_concurrent_bookings_of_a_slot_book_it_once(storage):
+    add_slots("G1", slot(3, 9))
+    barrier = threading.Barrier(8)
+    results = []
+
+    def book(nhs_no):
+        barrier.wait()
+        try:
+            results.append(BookingService.book(nhs_no, "G1", slot(3, 9)))
+        except BookingError:
+            results.append(None)
+        finally:
+            Database.close_thread_connections()
+
+    threads = [threading.Thread(target=book, args=(str(1000000001 + number),)) for number in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len([result for result in results if result is not None]) == 1
+    assert len(visits()) == 1
+    assert free_slots("G1") == []
+
+
+def test_confirm_many_confirms_the_first_booking_of_each_timeslot(database):
+    # inserted directly, booking() takes the slot so a timeslot would only get one pending booking
+    SQLQuery("INSERT INTO Visit (NHSNo, StaffID, Timeslot, Confirmed) VALUES (?, ?, ?, 'P')").commit(
+        ("1000000001", "G1", slot(3, 9)))
+    for nhs_no, timeslot in (("1000000002", slot(3, 9)), ("1000000003", slot(3, 10)), ("1000000004", slot(3, 11))):
+        SQLQuery("INSERT INTO Visit (NHSNo, StaffID, Timeslot, Confirmed) VALUES (?, 'G1', ?, 'P')").commit(
+            (nhs_no, timeslot))
+    report = BookingService.confirm_many("G1", [2, 1, 3, 99])
+    assert report == {"confirmed": [1, 3], "rejected": [2], "missing": [99]}
+    assert [(booking_no, confirmed) for booking_no, _, _, _, confirmed in visits()] == \
+        [(1, "T"), (2, "F"), (3, "T"), (4, "P")]
+
+
+def test_confirm_many_leaves_other_gps_alone(database):
+    SQLQuery("INSERT INTO Visit (NHSNo, StaffID, Timeslot, Confirmed) VALUES ('1000000001', 'G2', ?, 'P')").commit(
+        (slot(3, 9),))
+    assert BookingService.confirm_many("G1", [1]) == {"confirmed": [], "rejected": [], "missing": [1]}
+    assert visits()[0][4] == "P"
+
+
+def test_cancel_range_cancels_notifies_and_restores_the_slots(storage):
+    add_slots("G1", slot(3, 9), slot(3, 9, 15), slot(3, 9, 30), slot(9, 9))
+    first = BookingService.book("1000000001", "G1", slot(3, 9))
+    rejected = BookingService.book("1000000002", "G1", slot(3, 9, 15))
+    BookingService.reject("G1", rejected)
+    later = BookingService.book("1000000003", "G1", slot(9, 9))
+    report = BookingService.cancel_range("G1", slot(3, 0).date(), slot(4, 0).date())
+    assert report == {"reassigned": 0, "cancelled": 1, "notified": 1, "restored": 1, "dropped": 0}
+    # the rejected visit is the patient's history and stays
+    assert [booking_no for booking_no, *_ in visits()] == [rejected, later]
+    assert free_slots("G1") == [slot(3, 9), slot(3, 9, 30)]
+    assert [row[2] for row in NotificationOutbox.undelivered("1000000001")] == [first]
+
+
+def test_cancel_range_can_drop_the_free_slots(storage):
+    add_slots("G1", slot(3, 9), slot(3, 9, 15), slot(5, 9))
+    BookingService.book("1000000001", "G1", slot(3, 9))
+    report = BookingService.cancel_range("G1", slot(3, 0).date(), slot(3, 0).date(), drop_slots=True)
+    assert report["cancelled"] == 1 and report["dropped"] == 1 and report["restored"] == 0
+    assert free_slots("G1") == [slot(5, 9)]
+    assert FreeSlotIndex.on_day(slot(3, 0).date(), "G1") == []
+
+
+def test_cancel_range_reassigns_to_free_unheld_slots(storage):
+    add_slots("G1", slot(3, 9), slot(3, 9, 15), slot(3, 9, 30))
+    add_slots("G2", slot(3, 9), slot(3, 9, 15), slot(3, 9, 30))
+    moved = BookingService.book("1000000001", "G1", slot(3, 9))
+    held = BookingService.book("1000000002", "G1", slot(3, 9, 15))
+    assert SlotHold.hold("1000000009", "G2", slot(3, 9, 15))
+    busy = BookingService.book("1000000003", "G1", slot(3, 9, 30))
+    # the patient is already booked with G3 at that time
+    SQLQuery("INSERT INTO Visit (NHSNo, StaffID, Timeslot, Confirmed) VALUES ('1000000003', 'G3', ?, 'T')").commit(
+        (slot(3, 9, 30),))
+    report = BookingService.cancel_range("G1", slot(3, 0).date(), slot(3, 0).date(), reassign_to="G2")
+    assert report["reassigned"] == 1 and report["cancelled"] == 2
+    remaining = {booking_no: staff_id for booking_no, _, staff_id, _, _ in visits()}
+    assert remaining[moved] == "G2" and held not in remaining and busy not in remaining
+    assert free_slots("G2") == [slot(3, 9, 15), slot(3, 9, 30)]
+    notification = NotificationOutbox.undelivered("1000000001")[0]
+    assert notification[1] == NotificationOutbox.REASSIGNED and notification[7] == "First2"
+
+
+def test_cancel_range_refuses_the_same_gp(database):
+    with pytest.raises(BookingError):
+        BookingService.cancel_range("G1", slot(3, 0).date(), slot(3, 0).date(), reassign_to="G1")
@@ -0,0 +1,25 @@
+import logging
+import sqlite3
+
+import pytest
+
+from database import Database, SQLQuery, SQLTransaction
+
+
+def test_query_errors_propagate_and_roll_back(database):
+    SQLQuery("INSERT INTO slot_hold VALUES ('G1', 1, '1000000001', 0)").commit(())
+    with pytest.raises(sqlite3.IntegrityError):
+        SQLQuery("INSERT INTO slot_hold VALUES ('G1', 1, '1000000002', 0)").commit(())
+    assert not Database().connection().in_transaction
+    with pytest.raises(sqlite3.OperationalError):
+        SQLQuery("SELECT * FROM no_such_table").fetch_all()
+
+
+def test_failed_transaction_is_rolled_back_and_logged(database, caplog, capsys):
+    transaction = SQLTransaction().add("INSERT INTO slot_hold VALUES ('G1', 1, '1000000001', 0)"
+                                       ).add("INSERT INTO slot_hold VALUES ('G1', 1, '1000000002', 0)")
+    with caplog.at_level(logging.ERROR, logger="main.Database"):
+        assert not transaction.commit()
+    assert "rolled back" in caplog.text
+    assert capsys.readouterr().out == ""
+    assert SQLQuery("SELECT COUNT(*) FROM slot_hold").fetch_all() == [(0,)]
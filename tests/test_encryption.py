@@ -0,0 +1,40 @@
+import random
+
+import pytest
+
+from compression import CompressionHelper
+from encryption import EncryptionHelper
+
+
+def text(size) -> str:
+    """
+    :param int size: length of the text
+    :return: repetitive free text of the given length, like the notes of a visit
+    """
+    return ("patient reports persistent dry cough, advised to continue inhaler. " * (size // 60 + 1))[:size]
+
+
+@pytest.mark.parametrize("size, flag", [(10, b''), (95, b''), (96, b'z'), (1024, b'z'), (16384, b'x')])
+def test_compressed_encryption_round_trip(workdir, size, flag):
+    stored = EncryptionHelper().encrypt_compressed(text(size))
+    assert stored[:len(flag)] == flag
+    assert CompressionHelper.is_flagged(stored) == bool(flag)
+    assert EncryptionHelper().decrypt_message(stored) == text(size)
+
+
+def test_compression_shrinks_long_texts(workdir):
+    helper = EncryptionHelper()
+    assert len(helper.encrypt_compressed(text(4000))) < len(helper.encrypt_to_bits(text(4000))) // 4
+
+
+def test_incompressible_data_is_stored_uncompressed():
+    data = random.Random(2020).randbytes(500)
+    assert CompressionHelper.compress(data) == (b'', data)
+
+
+def test_tokens_written_before_compression_still_decrypt(workdir):
+    stored = EncryptionHelper().encrypt_to_bits(text(2000))
+    # a plain Fernet token starts with 'g', never with a codec flag
+    assert stored[:1] == b'g'
+    assert not CompressionHelper.is_flagged(stored)
+    assert EncryptionHelper().decrypt_message(stored) == text(2000)
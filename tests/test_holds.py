@@ -0,0 +1,50 @@
+import time
+
+from conftest import add_slots, slot
+from database import SQLQuery
+from holds import SlotHold
+
+
+def test_hold_hides_the_slot_from_other_patients(storage):
+    add_slots("G1", slot(3, 9))
+    assert SlotHold.hold("1000000001", "G1", slot(3, 9))
+    assert SlotHold.held("1000000002") == {(slot(3, 9), "G1")}
+    assert SlotHold.held("1000000001") == set()
+
+
+def test_slot_held_by_another_patient_cannot_be_held(storage):
+    add_slots("G1", slot(3, 9))
+    assert SlotHold.hold("1000000001", "G1", slot(3, 9))
+    assert not SlotHold.hold("1000000002", "G1", slot(3, 9))
+    # the holder can extend their hold
+    assert SlotHold.hold("1000000001", "G1", slot(3, 9))
+
+
+def test_unavailable_slot_cannot_be_held(storage):
+    add_slots("G1", slot(3, 9))
+    assert not SlotHold.hold("1000000001", "G1", slot(3, 9, 15))
+    assert not SlotHold.hold("1000000001", "G2", slot(3, 9))
+
+
+def test_a_patient_holds_one_slot_at_a_time(storage):
+    add_slots("G1", slot(3, 9), slot(3, 9, 15))
+    SlotHold.hold("1000000001", "G1", slot(3, 9))
+    SlotHold.hold("1000000001", "G1", slot(3, 9, 15))
+    assert SlotHold.held() == {(slot(3, 9, 15), "G1")}
+
+
+def test_expired_holds_are_taken_over_and_swept(storage):
+    add_slots("G1", slot(3, 9))
+    SlotHold.hold("1000000001", "G1", slot(3, 9))
+    SQLQuery("UPDATE slot_hold SET ExpiresAt = ?").commit((time.time() - 1,))
+    assert SlotHold.held() == set()
+    assert SlotHold.hold("1000000002", "G1", slot(3, 9))
+    SQLQuery("UPDATE slot_hold SET ExpiresAt = ?").commit((time.time() - 1,))
+    assert SlotHold.sweep() == 1
+
+
+def test_release(storage):
+    add_slots("G1", slot(3, 9))
+    SlotHold.hold("1000000001", "G1", slot(3, 9))
+    SlotHold.release("1000000001")
+    assert SlotHold.hold("1000000002", "G1", slot(3, 9))
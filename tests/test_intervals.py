@@ -0,0 +1,25 @@
+from intervals import IntervalSet
+
+
+def test_ranges_are_merged_and_sorted():
+    intervals = IntervalSet([(50, 60), (1, 30), (31, 31), (45, 45), (10, 20)])
+    assert intervals.ranges() == [(1, 31), (45, 45), (50, 60)]
+    assert len(intervals) == 43
+    assert intervals.min() == 1 and intervals.max() == 60
+
+
+def test_reversed_bounds_are_allowed():
+    assert IntervalSet([(8, 5)]).ranges() == [(5, 8)]
+
+
+def test_membership_and_iteration():
+    intervals = IntervalSet([(1, 3), (7, 8)])
+    assert [value for value in range(10) if value in intervals] == [1, 2, 3, 7, 8]
+    assert list(intervals) == [1, 2, 3, 7, 8]
+
+
+def test_empty_set_and_equality():
+    assert not IntervalSet()
+    assert 1 not in IntervalSet()
+    assert IntervalSet([(1, 2), (3, 4)]) == IntervalSet([(1, 4)])
+    assert IntervalSet([(1, 2)]) != IntervalSet([(1, 3)])
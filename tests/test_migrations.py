@@ -0,0 +1,86 @@
+import pytest
+
+from booking import BookingService
+from conftest import add_slots, free_slots, slot
+from database import Database, SQLQuery
+from migrations import Migrations
+from slotbitmap import SlotBitmap
+
+# available_time and Visit of the databases before version 1, with the timeslots as datetime text
+VERSION_0_SCRIPT = """
+    DROP TABLE available_time;
+    DROP TABLE Visit;
+    DROP TABLE slot_hold;
+    DROP TABLE notification_outbox;
+    DROP TABLE visit_search_index;
+    DROP TABLE availability_rule;
+    DROP TABLE availability_exception;
+    CREATE TABLE available_time (
+        StaffID varchar(10) NOT NULL CHECK(StaffID LIKE 'G%'),
+        Timeslot datetime NOT NULL
+    );
+    CREATE TABLE Visit (
+        BookingNo INTEGER,
+        NHSNo varchar(10) NOT NULL,
+        StaffID varchar(10) NOT NULL,
+        Timeslot datetime NOT NULL,
+        PatientInfo BLOB,
+        Confirmed char(1) NOT NULL DEFAULT 'P',
+        Attended char(1),
+        Diagnosis BLOB,
+        Notes BLOB,
+        Rating int DEFAULT 0,
+        PRIMARY KEY(BookingNo AUTOINCREMENT)
+    );
+    PRAGMA user_version = 0;
+    """
+
+
+@pytest.fixture
+def version_0(database):
+    Database().connection().executescript(VERSION_0_SCRIPT)
+    SQLQuery("INSERT INTO available_time VALUES ('G1', ?), ('G1', ?)").commit(
+        (str(slot(3, 9)), str(slot(3, 9, 15))))
+    for booking_no in (1, 2, 3):
+        SQLQuery("INSERT INTO Visit (NHSNo, StaffID, Timeslot, Confirmed) VALUES ('1000000001', 'G1', ?, 'T')"
+                 ).commit((str(slot(4, 9)),))
+    # the numbers of deleted bookings are not given out again
+    SQLQuery("DELETE FROM Visit WHERE BookingNo = 3").commit(())
+    return database
+
+
+def test_new_databases_are_at_the_latest_version(database):
+    assert Migrations.version() == Migrations.STEPS[-1][0]
+    assert Migrations.apply() == []
+
+
+def test_apply_upgrades_a_version_0_database(version_0):
+    assert Migrations.apply() == [1, 2, 3, 4, 5]
+    assert Migrations.version() == 5
+    assert free_slots("G1") == [slot(3, 9), slot(3, 9, 15)]
+    assert SQLQuery("SELECT BookingNo, typeof(Timeslot), Timeslot FROM Visit").fetch_all() == \
+        [(1, "integer", slot(4, 9)), (2, "integer", slot(4, 9))]
+    SQLQuery("INSERT INTO Visit (NHSNo, StaffID, Timeslot) VALUES ('1000000001', 'G1', ?)").commit((slot(5, 9),))
+    assert SQLQuery("SELECT MAX(BookingNo) FROM Visit").fetch_all() == [(4,)]
+    assert SQLQuery("SELECT COUNT(*) FROM slot_hold").fetch_all() == [(0,)]
+    assert SQLQuery("SELECT COUNT(*) FROM notification_outbox").fetch_all() == [(0,)]
+    assert SQLQuery("SELECT COUNT(*) FROM availability_rule").fetch_all() == [(0,)]
+    assert Migrations.apply() == []
+
+
+def test_upgraded_database_can_cancel_bookings(version_0):
+    Migrations.apply()
+    SQLQuery("INSERT INTO Visit (NHSNo, StaffID, Timeslot) VALUES ('1000000001', 'G1', ?)").commit((slot(10, 9),))
+    booking_no = SQLQuery("SELECT MAX(BookingNo) FROM Visit").fetch_all()[0][0]
+    BookingService.cancel("1000000001", booking_no)
+    assert free_slots("G1") == [slot(3, 9), slot(3, 9, 15), slot(10, 9)]
+
+
+def test_bitmap_storage_round_trip(database):
+    add_slots("G1", slot(3, 9), slot(3, 9, 15), slot(4, 17, 45))
+    SlotBitmap.migrate()
+    assert SlotBitmap.enabled()
+    assert free_slots("G1") == [slot(3, 9), slot(3, 9, 15), slot(4, 17, 45)]
+    SlotBitmap.revert()
+    assert not SlotBitmap.enabled()
+    assert free_slots("G1") == [slot(3, 9), slot(3, 9, 15), slot(4, 17, 45)]
@@ -0,0 +1,82 @@
+from booking import BookingService
+from conftest import add_slots, free_slots, slot
+from database import SQLQuery
+from notifications import NotificationOutbox
+from reassignment import ReassignmentEngine
+from slotindex import FreeSlotIndex
+
+DAY = 24 * 60
+
+
+def test_nearest_alternates_around_the_time():
+    slots = [(90, "G2"), (100, "G2"), (115, "G3"), (200, "G2")]
+    assert list(ReassignmentEngine.nearest(slots, 105, 0, 150)) == [(100, "G2"), (115, "G3"), (90, "G2")]
+
+
+def test_eligible_gps():
+    attributes = {"G1": ("M", "Paediatrics", 3), "G2": ("M", "paediatrics", 3), "G3": ("F", "Paediatrics", 3),
+                  "G4": ("M", "", 3)}
+    assert ReassignmentEngine.eligible_gps("G1", attributes) == {"G2", "G4"}
+    assert ReassignmentEngine.eligible_gps("G1", attributes, same_speciality=True) == {"G2"}
+    assert ReassignmentEngine.eligible_gps("G1", attributes, same_gender=False) == {"G2", "G3", "G4"}
+
+
+def test_plan_takes_the_smallest_shift_first():
+    displaced = [(1, "P1", 100, "P"), (2, "P2", 130, "P")]
+    slots = [(100, "G2"), (160, "G2")]
+    assignments, unassigned = ReassignmentEngine.plan(displaced, slots, set(), 0, DAY)
+    assert assignments == {1: ("G2", 100), 2: ("G2", 160)}
+    assert unassigned == []
+
+
+def test_plan_confirmed_bookings_win_ties():
+    displaced = [(1, "P1", 100, "P"), (2, "P2", 100, "T")]
+    assignments, unassigned = ReassignmentEngine.plan(displaced, [(100, "G2")], set(), 0, 10)
+    assert assignments == {2: ("G2", 100)}
+    assert unassigned == [1]
+
+
+def test_plan_respects_the_patients_other_bookings():
+    displaced = [(1, "P1", 100, "P")]
+    assignments, _ = ReassignmentEngine.plan(displaced, [(115, "G2"), (130, "G2")], {("P1", 100), ("P1", 115)}, 0, DAY)
+    assert assignments == {1: ("G2", 130)}
+
+
+def test_plan_keeps_the_time_of_unassigned_bookings_busy():
+    # booking 1 cannot be moved and stays, so booking 2 of the same patient cannot take its time
+    displaced = [(1, "P1", 100, "P"), (2, "P1", 200, "P")]
+    busy = {("P1", 100), ("P1", 200)}
+    assignments, unassigned = ReassignmentEngine.plan(displaced, [(100, "G2")], busy, 0, 150)
+    assert assignments == {1: ("G2", 100)}
+    assert unassigned == [2]
+
+
+def test_plan_frees_the_time_of_a_moved_booking():
+    displaced = [(1, "P1", 100, "T"), (2, "P1", 130, "P")]
+    assignments, _ = ReassignmentEngine.plan(displaced, [(100, "G2"), (115, "G3")], {("P1", 100), ("P1", 130)}, 0,
+                                             DAY)
+    assert assignments == {1: ("G2", 100), 2: ("G3", 115)}
+
+
+def test_plan_honours_the_earliest_time_and_maximum_shift():
+    displaced = [(1, "P1", 100, "P")]
+    assert ReassignmentEngine.plan(displaced, [(40, "G2"), (300, "G2")], set(), 50, 150) == ({}, [1])
+
+
+def test_reassign_moves_the_bookings_and_cancels_the_rest(storage):
+    add_slots("G1", slot(3, 9), slot(3, 9, 15), slot(3, 9, 30))
+    add_slots("G2", slot(3, 9, 15))
+    # G3 is female and not eligible for the bookings of G1
+    add_slots("G3", slot(3, 9, 30))
+    moved = BookingService.book("1000000001", "G1", slot(3, 9))
+    left = BookingService.book("1000000002", "G1", slot(3, 9, 30))
+    report = ReassignmentEngine.reassign("G1", slot(3, 0).date(), slot(3, 0).date(), restore_slots=True,
+                                         cancel_rest=True)
+    assert report == {"reassigned": 1, "unassigned": [], "cancelled": 1, "notified": 2, "restored": 2,
+                      "dropped": 0}
+    assert SQLQuery("SELECT BookingNo, StaffID, Timeslot FROM Visit").fetch_all() == [(moved, "G2", slot(3, 9, 15))]
+    assert free_slots("G2") == []
+    assert free_slots("G1") == [slot(3, 9), slot(3, 9, 15), slot(3, 9, 30)]
+    assert [row[1] for row in NotificationOutbox.undelivered("1000000001")] == [NotificationOutbox.REASSIGNED]
+    assert [row[2] for row in NotificationOutbox.undelivered("1000000002")] == [left]
+    assert FreeSlotIndex.on_day(slot(3, 0).date(), "G2") == []
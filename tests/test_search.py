@@ -0,0 +1,79 @@
+from booking import BookingService
+from conftest import add_slots, slot
+from database import SQLQuery, SQLTransaction
+from search import VisitSearchIndex
+
+
+def record(booking_no, diagnosis, notes="") -> None:
+    """
+    :param int booking_no: BookingNo of the visit
+    :param str diagnosis: plain text diagnosis indexed for the visit
+    :param str notes: plain text notes indexed for the visit
+    """
+    transaction = SQLTransaction()
+    VisitSearchIndex.add_to_transaction(transaction, booking_no, VisitSearchIndex.DIAGNOSIS, diagnosis)
+    VisitSearchIndex.add_to_transaction(transaction, booking_no, VisitSearchIndex.NOTES, notes)
+    assert transaction.commit()
+
+
+def book(nhs_no, staff_id, timeslot) -> int:
+    add_slots(staff_id, timeslot)
+    return BookingService.book(nhs_no, staff_id, timeslot)
+
+
+def test_tokenize_normalises_terms():
+    assert VisitSearchIndex.tokenize("The patient's Asthma, and an ECZÉMA flare-up (x2)") == \
+        {"patient", "asthma", "eczema", "flare", "up", "x2"}
+    assert VisitSearchIndex.tokenize(None) == set()
+
+
+def test_tokens_do_not_contain_the_terms(workdir):
+    token = VisitSearchIndex.token("asthma")
+    assert len(token) == VisitSearchIndex.TOKEN_BYTES
+    assert token == VisitSearchIndex.token("asthma") != VisitSearchIndex.token("asthmatic")
+    assert b"asthma" not in token
+
+
+def test_search_matches_all_terms(database):
+    first, second = book("1000000001", "G1", slot(10, 9)), book("1000000002", "G1", slot(10, 10))
+    record(first, "Asthma", "continue the inhaler")
+    record(second, "asthma, mild eczema")
+    assert VisitSearchIndex.search("asthma") == [second, first]
+    assert VisitSearchIndex.search("ASTHMA inhaler") == [first]
+    assert VisitSearchIndex.search("asthma fracture") == []
+    assert VisitSearchIndex.search("the and") == []
+
+
+def test_search_by_field_and_gp(database):
+    first, second = book("1000000001", "G1", slot(10, 9)), book("1000000002", "G2", slot(10, 9))
+    record(first, "migraine", "headache")
+    record(second, "headache")
+    assert VisitSearchIndex.search("headache", fields=(VisitSearchIndex.NOTES,)) == [first]
+    assert VisitSearchIndex.search("headache", fields=(VisitSearchIndex.DIAGNOSIS,)) == [second]
+    assert VisitSearchIndex.search("headache", staff_id="G1") == [first]
+    assert VisitSearchIndex.search("headache", fields=()) == []
+
+
+def test_reindexing_a_field_replaces_its_terms(database):
+    booking_no = book("1000000001", "G1", slot(10, 9))
+    record(booking_no, "suspected fracture")
+    record(booking_no, "sprain")
+    assert VisitSearchIndex.search("fracture") == []
+    assert VisitSearchIndex.search("sprain") == [booking_no]
+
+
+def test_cancelled_visit_is_removed_from_the_index(database):
+    kept, cancelled = book("1000000001", "G1", slot(10, 9)), book("1000000002", "G1", slot(10, 10))
+    record(kept, "asthma")
+    record(cancelled, "asthma")
+    BookingService.cancel("1000000002", cancelled)
+    assert VisitSearchIndex.search("asthma") == [kept]
+    assert SQLQuery("SELECT COUNT(*) FROM visit_search_index WHERE BookingNo = ?").fetch_all(
+        parameters=(cancelled,)) == [(0,)]
+
+
+def test_rows_of_a_deleted_visit_are_not_returned(database):
+    booking_no = book("1000000001", "G1", slot(10, 9))
+    record(booking_no, "asthma")
+    SQLQuery("DELETE FROM Visit WHERE BookingNo = ?").commit((booking_no,))
+    assert VisitSearchIndex.search("asthma") == []
@@ -0,0 +1,86 @@
+import datetime
+
+from conftest import add_slots, slot
+from database import SQLQuery
+from slotindex import FreeSlotIndex
+
+
+def test_load_indexes_the_slots_from_tomorrow(database):
+    add_slots("G1", slot(0, 9), slot(1, 9), slot(2, 9), slot(2, 9))
+    add_slots("G2", slot(1, 9, 15))
+    assert FreeSlotIndex.load() == 4
+    # duplicated rows are indexed once
+    assert FreeSlotIndex.between(slot(0, 0), slot(5, 0)) == [(slot(1, 9), "G1"), (slot(1, 9, 15), "G2"),
+                                                             (slot(2, 9), "G1")]
+    assert FreeSlotIndex.on_day(slot(1, 0).date(), "G2") == [(slot(1, 9, 15), "G2")]
+    assert FreeSlotIndex.rows([(slot(1, 9), "G1")]) == [["First1", "Last1", slot(1, 9), "G1"]]
+
+
+def test_between_includes_the_end(database):
+    add_slots("G1", slot(1, 9), slot(1, 9, 15), slot(1, 9, 30))
+    assert [timeslot for timeslot, _ in FreeSlotIndex.between(slot(1, 9), slot(1, 9, 15))] == \
+        [slot(1, 9), slot(1, 9, 15)]
+
+
+def test_earliest_across_gps(database):
+    add_slots("G1", slot(2, 9), slot(3, 9))
+    add_slots("G2", slot(1, 11), slot(4, 9))
+    add_slots("G3", slot(1, 10))
+    assert FreeSlotIndex.earliest(3, slot(1, 0)) == [(slot(1, 10), "G3"), (slot(1, 11), "G2"), (slot(2, 9), "G1")]
+    assert FreeSlotIndex.earliest(2, slot(1, 0), ["G1", "G2"]) == [(slot(1, 11), "G2"), (slot(2, 9), "G1")]
+
+
+def test_batched_writes(database):
+    add_slots("G1", slot(1, 9))
+    FreeSlotIndex.ensure_loaded()
+    FreeSlotIndex.add_many("G1", [slot(2, 9, 15), slot(2, 9), slot(1, 9), slot(0, 9)])
+    assert [timeslot for timeslot, _ in FreeSlotIndex.between(slot(0, 0), slot(5, 0), "G1")] == \
+        [slot(1, 9), slot(2, 9), slot(2, 9, 15)]
+    FreeSlotIndex.remove_ranges("G1", [(slot(1, 0), slot(1, 23)), (slot(2, 9, 15), slot(2, 9, 15))])
+    assert FreeSlotIndex.between(slot(0, 0), slot(5, 0)) == [(slot(2, 9), "G1")]
+    FreeSlotIndex.remove_many("G1", [slot(2, 9)])
+    assert FreeSlotIndex.earliest(5, slot(0, 0)) == []
+
+
+def test_slots_of_an_unknown_gp_trigger_a_rebuild(database):
+    FreeSlotIndex.ensure_loaded()
+    FreeSlotIndex.add("G9", slot(1, 9))
+    assert FreeSlotIndex.stale()
+
+
+def test_rebuild_is_stale_on_another_day(database, monkeypatch):
+    FreeSlotIndex.ensure_loaded()
+    assert not FreeSlotIndex.stale()
+    monkeypatch.setattr(FreeSlotIndex, "_loaded_on", datetime.date.today() - datetime.timedelta(days=1))
+    assert FreeSlotIndex.stale()
+
+
+def test_writes_during_a_rebuild_are_kept(database, monkeypatch):
+    add_slots("G1", slot(1, 9), slot(1, 9, 15))
+    FreeSlotIndex.ensure_loaded()
+    fetch_all = SQLQuery.fetch_all
+
+    def fetch_then_write(query, *args, **kwargs):
+        rows = fetch_all(query, *args, **kwargs)
+        if "available_time" in query.query:
+            # another thread books a slot and adds one after the rebuild read the table
+            FreeSlotIndex.remove("G1", slot(1, 9))
+            FreeSlotIndex.add("G1", slot(1, 10))
+        return rows
+
+    monkeypatch.setattr(SQLQuery, "fetch_all", fetch_then_write)
+    FreeSlotIndex.load()
+    assert FreeSlotIndex.between(slot(1, 0), slot(2, 0)) == [(slot(1, 9, 15), "G1"), (slot(1, 10), "G1")]
+
+
+def test_invalidate_during_a_rebuild_leaves_the_index_stale(database, monkeypatch):
+    fetch_all = SQLQuery.fetch_all
+
+    def fetch_then_invalidate(query, *args, **kwargs):
+        rows = fetch_all(query, *args, **kwargs)
+        FreeSlotIndex.invalidate()
+        return rows
+
+    monkeypatch.setattr(SQLQuery, "fetch_all", fetch_then_invalidate)
+    FreeSlotIndex.load()
+    assert FreeSlotIndex.stale()
@@ -0,0 +1,43 @@
+import datetime
+import sqlite3
+import warnings
+
+from database import SQLQuery, Timeslot, TimeslotCodec
+
+
+def test_encode_decode_round_trip():
+    timeslot = Timeslot(2024, 3, 31, 9, 45)
+    minutes = TimeslotCodec.encode(timeslot)
+    assert minutes == (timeslot - datetime.datetime(1970, 1, 1)) // datetime.timedelta(minutes=1)
+    assert TimeslotCodec.decode(minutes) == timeslot
+    assert type(TimeslotCodec.decode(minutes)) is Timeslot
+
+
+def test_encode_ignores_seconds():
+    assert TimeslotCodec.encode(datetime.datetime(2024, 1, 1, 9, 0, 59)) == \
+        TimeslotCodec.encode(datetime.datetime(2024, 1, 1, 9))
+
+
+def test_start_of_and_arithmetic_stay_timeslots():
+    start = TimeslotCodec.start_of(datetime.date(2024, 5, 1))
+    assert start == datetime.datetime(2024, 5, 1)
+    assert type(start) is Timeslot
+    assert type(start + datetime.timedelta(minutes=15)) is Timeslot
+    assert type(Timeslot.of(datetime.datetime(2024, 5, 1, 10))) is Timeslot
+
+
+def test_timeslot_is_passed_as_minutes_and_other_datetimes_are_not():
+    connection = sqlite3.connect(":memory:")
+    timeslot = Timeslot(2024, 5, 1, 10, 15)
+    assert connection.execute("SELECT ?", (timeslot,)).fetchone()[0] == TimeslotCodec.encode(timeslot)
+    with warnings.catch_warnings():
+        # the default datetime adapter of sqlite3 is deprecated from Python 3.12 on
+        warnings.simplefilter("ignore", DeprecationWarning)
+        assert connection.execute("SELECT typeof(?)", (datetime.datetime(2024, 5, 1, 10, 15),)).fetchone()[0] == "text"
+
+
+def test_fetch_all_decodes_timeslot_columns(workdir):
+    timeslot = Timeslot(2024, 5, 1, 10, 15)
+    rows = SQLQuery("SELECT ? AS Timeslot, ? AS Other").fetch_all(parameters=(timeslot, 5))
+    assert rows == [(timeslot, 5)]
+    assert type(rows[0][0]) is Timeslot
@@ -0,0 +1,132 @@
+import threading
+from database import SQLQuery
+from encryption import EncryptionHelper
+
+
+class EncryptedField:
+    """
+    Profile attribute stored encrypted in the Users table, decrypted on first access only.
+    """
+
+    def __init__(self, column):
+        """
+        :param str column: column of the Users table holding the encrypted value
+        """
+        self.column = column
+
+    def __get__(self, profile, owner):
+        if profile is None:
+            return self
+        if self.column not in profile._decrypted:
+            value = profile._encrypted.get(self.column)
+            if isinstance(value, bytes):
+                value = EncryptionHelper().decrypt_message(value)
+            profile._decrypted[self.column] = value
+        return profile._decrypted[self.column]
+
+    def __set__(self, profile, value):
+        profile._decrypted[self.column] = value
+
+
+class UserProfile:
+    """
+    Profile of a user as stored in the Users table. The plain columns are read directly,
+    the personal details are kept encrypted until they are first used.
+    """
+
+    __slots__ = ("ID", "username", "user_type", "deactivated", "login_count", "_encrypted", "_decrypted")
+
+    # plain columns first, in the order of the slots, then the encrypted ones
+    PLAIN_COLUMNS = ("ID", "username", "UserType", "Deactivated", "LoginCount")
+    ENCRYPTED_COLUMNS = ("firstName", "lastName", "phoneNo", "HomeAddress", "postCode", "birthday")
+
+    first_name = EncryptedField("firstName")
+    last_name = EncryptedField("lastName")
+    phone_no = EncryptedField("phoneNo")
+    home_address = EncryptedField("HomeAddress")
+    postcode = EncryptedField("postCode")
+    birthday = EncryptedField("birthday")
+
+    def __init__(self, row):
+        """
+        :param row: Users row with the columns of UserProfile.PLAIN_COLUMNS + UserProfile.ENCRYPTED_COLUMNS
+        """
+        self.ID, self.username, self.user_type, self.deactivated, self.login_count = row[:5]
+        self._encrypted = dict(zip(UserProfile.ENCRYPTED_COLUMNS, row[5:]))
+        self._decrypted = {}
+
+
+class ProfileField:
+    """
+    Attribute of a User object read from and written to its UserProfile.
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, user, owner):
+        if user is None:
+            return self
+        return getattr(user.profile, self.name)
+
+    def __set__(self, user, value):
+        setattr(user.profile, self.name, value)
+
+
+class ProfileStore:
+    """
+    Per-process cache of user profiles keyed by user ID, so constructing a User for a profile already
+    seen (e.g. a GP booking for a patient) does not query the database again.
+    """
+
+    QUERY = "SELECT {0} FROM Users WHERE username = ?".format(
+        ", ".join(UserProfile.PLAIN_COLUMNS + UserProfile.ENCRYPTED_COLUMNS))
+
+    _profiles = {}  # ID -> UserProfile
+    _ids = {}  # username -> ID
+    _lock = threading.Lock()
+
+    @staticmethod
+    def load(username) -> UserProfile:
+        """
+        :param str username: username of the account
+        :return: the cached profile, or the profile read from the database
+        :raises IndexError: if there is no account with this username
+        """
+        with ProfileStore._lock:
+            user_id = ProfileStore._ids.get(username)
+            if user_id is not None:
+                return ProfileStore._profiles[user_id]
+        # the encrypted columns are returned as they are stored, UserProfile decrypts them when used
+        return ProfileStore.add(SQLQuery(ProfileStore.QUERY).fetch_all(parameters=(username,))[0])
+
+    @staticmethod
+    def add(row) -> UserProfile:
+        """
+        :param row: Users row with the columns of ProfileStore.QUERY
+        :return: the profile created from the row, now cached
+        """
+        profile = UserProfile(row)
+        with ProfileStore._lock:
+            ProfileStore._profiles[profile.ID] = profile
+            ProfileStore._ids[profile.username] = profile.ID
+        return profile
+
+    @staticmethod
+    def invalidate(user_id=None, username=None) -> None:
+        """
+        Remove a profile after its row was updated or deleted, both arguments None removes all profiles.
+
+        :param str user_id: ID of the user
+        :param str username: username of the user, if the ID is not known
+        """
+        with ProfileStore._lock:
+            if user_id is None and username is None:
+                ProfileStore._profiles.clear()
+                ProfileStore._ids.clear()
+                return
+            if user_id is None:
+                user_id = ProfileStore._ids.get(username)
+            profile = ProfileStore._profiles.pop(user_id, None)
+            if profile is not None:
+                ProfileStore._ids.pop(profile.username, None)